@@ -0,0 +1,61 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'video_builder'))
+
+from builder import generate_scripts
+from config.config import Config
+
+# times turning generated configs into scripts, the time per video should stay
+# about the same however many videos there are
+video_counts = [1250, 2500, 5000, 10000, 20000]
+
+
+def get_raw_config(video_count: int) -> dict:
+    videos = {}
+    for index in range(video_count):
+        videos[f'part{index}'] = {
+            'variables': {'duration': 5 + index % 10, 'fade_start': '$(expr $duration - 2)'},
+            'options': ['-f lavfi', '-i color=c=black', 'blank_audio', '-t $duration', 'encoding', 'fade'],
+        }
+        # every tenth video combines the parts before it
+        if index % 10 == 9:
+            videos[f'block{index}'] = {'combine': [f'part{part}' for part in range(index - 9, index + 1)]}
+
+    return {
+        'shared_variables': {'fps': 24, 'audio_rate': 44100, 'assets': '/mnt/assets'},
+        'shared_options': ['-y', '-v warning'],
+        'option_templates': {
+            'blank_audio': '-f lavfi -i anullsrc=channel_layout=stereo:sample_rate=$audio_rate',
+            'encoding': '-c:v h264\n-c:a aac\n-ac 2\n-ar $audio_rate\n-r $fps',
+            'fade': '-af "afade=t=out:st=$fade_start:d=2"',
+        },
+        'videos': videos,
+    }
+
+
+def time_scripts_generated(video_count: int) -> float:
+    export_path = tempfile.mkdtemp()
+    try:
+        config = Config(get_raw_config(video_count), export_path, 'generate.bash')
+        started = time.perf_counter()
+        generate_scripts(config)
+        return time.perf_counter() - started
+    finally:
+        shutil.rmtree(export_path)
+
+
+def main() -> None:
+    print(f'{"videos":>8} {"seconds":>9} {"ms per video":>13}')
+    for video_count in video_counts:
+        # every tenth video is a combination
+        total = video_count + video_count // 10
+        elapsed = time_scripts_generated(video_count)
+        print(f'{total:>8} {elapsed:>9.2f} {elapsed / total * 1000:>13.3f}')
+
+
+if __name__ == '__main__':
+    main()
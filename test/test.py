@@ -1,12 +1,35 @@
+import io
+import json
+import threading
+import time
 import unittest
 from unittest import mock
 
 import build_videos
-from bash_writer.builders import FFmpegOptionBuilder, StaticBashCodeBuilder, BashCodeBuilder, VideoListVariableBuilder
-from build_videos import are_cli_arguments_valid
-from config.builder import build_video_configs_from_config
-from config.config import VideoConfig, Config
-from config.preprocessors import VideoConfigScriptDirAdder, VideoConfigTitleAdder, VideoConfigListPreprocessor
+from builder import get_compiled_video_config_preprocessors, report_script_changes
+from bash_writer.builders import FFmpegOptionBuilder, StaticBashCodeBuilder, BashCodeBuilder, VideoListVariableBuilder, \
+    FFmpegConcatBuilder, get_concat_filter
+from build_videos import are_cli_arguments_valid, parse_cli_arguments
+from config.builder import build_video_configs_from_config, select_target_videos
+from config.chunks import expand_chunked_videos, get_chunk_options
+from config.config import VideoConfig, Config, VideoConfigError, default_preview_options
+from config.matrix import VideoMatrix
+from config.media import MediaInfo, MediaProber
+from config.preprocessors import VideoConfigScriptDirAdder, VideoConfigTitleAdder, VideoConfigListPreprocessor, \
+    VideoConfigInputFingerprintAdder, VideoConfigIntermediateProfileAdder, VideoConfigOptionReferenceReplacer, \
+    VideoConfigVariableReferenceReplacer, VideoConfigVariablePrepender, VideoConfigVariableAppender, \
+    VideoConfigOptionPrepender, VideoConfigRenderRateAdder
+from config.profiles import IntermediateProfile, get_video_profiles
+from config.streams import expand_split_videos, get_stream_options, get_mux_options
+from config.variables import VariableResolver
+from executor.commands import FFmpegCommandBuilder, add_thread_options, get_expected_duration, \
+    get_static_duration, get_still_image_encoding
+from executor.fingerprint import VideoFingerprinter
+from executor.graph import VideoDependencyGraph, VideoDependencyError
+from executor.resources import ThreadBudget, MemoryGate, parse_size
+from executor.result import VideoBuildResult
+from executor.runners import FFmpegRunner
+from executor.scheduler import JobScheduler, JobAdmission
 
 
 class TestMainExecuted(unittest.TestCase):
@@ -31,6 +54,27 @@ class TestValidateArguments(unittest.TestCase):
         self.assertFalse(are_cli_arguments_valid(["something!!!", "", ""]))
 
 
+class TestParseCliArguments(unittest.TestCase):
+    def test_targets_empty_by_default(self):
+        parsed = parse_cli_arguments(['build_videos.py', 'config.yaml', 'export'])
+        self.assertEqual([], parsed.targets)
+
+    def test_targets_and_jobs_parsed(self):
+        parsed = parse_cli_arguments(['build_videos.py', 'config.yaml', 'export', 'prestream', 'intro', '-j', '4'])
+        self.assertEqual(['prestream', 'intro'], parsed.targets)
+        self.assertEqual(4, parsed.jobs)
+
+    def test_cache_options_parsed(self):
+        parsed = parse_cli_arguments(['build_videos.py', 'config.yaml', 'export', '--cache-dir', 'cache',
+                                      '--cache-size', '2G'])
+        self.assertEqual('cache', parsed.cache_dir)
+        self.assertEqual(2 * 1024 ** 3, parsed.cache_size)
+
+    def test_preview_parsed(self):
+        self.assertFalse(parse_cli_arguments(['build_videos.py', 'config.yaml', 'export']).preview)
+        self.assertTrue(parse_cli_arguments(['build_videos.py', 'config.yaml', 'export', '--preview']).preview)
+
+
 class TextEmptyVideoConfigClass(unittest.TestCase):
     def setUp(self) -> None:
         self.title = "things"
@@ -255,6 +299,237 @@ class TestBuildVideoConfigs(unittest.TestCase):
             self.assertIn('/', config.get_script_path())
 
 
+class TestBuildTargetVideoConfigs(unittest.TestCase):
+    def setUp(self) -> None:
+        self.videos = {
+            'intro': {'options': ['-i intro.png']},
+            'trailer': {'options': ['-i trailer.mp4']},
+            'countdown': {'variables': {'duration': '$(expr 60 - $trailer_length)'}},
+            'unused': {'options': ['-i unused.mp4']},
+            'block': {'combine': ['intro', 'countdown']},
+            'prestream': {'combine': ['block', 'intro']},
+        }
+        self.config = Config({'videos': self.videos}, 'export', 'generate.bash')
+
+    def test_target_parts_selected_transitively(self):
+        selected = select_target_videos(self.videos, ['prestream'])
+        self.assertEqual(['intro', 'trailer', 'countdown', 'block', 'prestream'], list(selected.keys()))
+
+    def test_multiple_targets_selected(self):
+        selected = select_target_videos(self.videos, ['intro', 'unused'])
+        self.assertEqual(['intro', 'unused'], list(selected.keys()))
+
+    def test_unknown_target_raises(self):
+        with self.assertRaises(VideoConfigError):
+            select_target_videos(self.videos, ['missing'])
+
+    def test_only_target_configs_built(self):
+        preprocessors = [VideoConfigTitleAdder()]
+        configs = build_video_configs_from_config(self.config, preprocessors, ['countdown'])
+        self.assertEqual(['trailer', 'countdown'], [config.get_title() for config in configs])
+
+    def test_all_configs_built_without_targets(self):
+        configs = build_video_configs_from_config(self.config, [VideoConfigTitleAdder()], [])
+        self.assertEqual(len(self.videos), len(configs))
+
+
+class TestReportScriptChanges(unittest.TestCase):
+    def _report(self, changed, removed=()):
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            report_script_changes(changed, list(removed), 3000)
+        return stderr.getvalue()
+
+    def test_few_changes_named(self):
+        self.assertEqual('Updated 2 of 3000 scripts: export_intro.bash, export_outro.bash\n'
+                         'Removed 1 orphaned scripts: export_old.bash\n',
+                         self._report(['export_intro.bash', 'export_outro.bash'], ['export_old.bash']))
+
+    def test_many_changes_counted(self):
+        scripts = [f'export_video{index}.bash' for index in range(2751)]
+        self.assertEqual('Updated 2751 of 3000 scripts\nRemoved 2751 orphaned scripts\n',
+                         self._report(scripts, scripts))
+
+
+class TestPreviewConfig(unittest.TestCase):
+    def setUp(self) -> None:
+        self.raw_config = {
+            'shared_options': ['-y'],
+            'option_templates': {'encoding': '-c:v libx264\n-preset slow'},
+            'videos': {
+                'intro': {'options': ['-f lavfi', '-i anullsrc', 'encoding', '-t 5']},
+                'result': {'combine': ['intro', 'intro']},
+            },
+        }
+
+    def _build(self, preview: bool):
+        config = Config(self.raw_config, 'export', 'generate.bash', preview=preview)
+        videos = build_video_configs_from_config(config, get_compiled_video_config_preprocessors(config))
+        return {video.get_title(): video for video in videos}
+
+    def test_output_options_replaced(self):
+        videos = self._build(preview=True)
+        self.assertEqual(['-y', '-f lavfi', '-i anullsrc', '-c:v libx264', '-preset slow', '-t 5',
+                          *default_preview_options], videos['intro'].get_options())
+        self.assertEqual(['-y'], videos['result'].get_options())
+
+    def test_preview_settings_used(self):
+        self.raw_config['preview'] = {
+            'options': ['-s 320x180'],
+            'shared_options': ['-v warning'],
+            'option_templates': {'encoding': '-c:v libx264\n-preset veryfast'},
+        }
+        self.assertEqual(['-y', '-v warning', '-f lavfi', '-i anullsrc', '-c:v libx264', '-preset veryfast', '-t 5',
+                          '-s 320x180'], self._build(preview=True)['intro'].get_options())
+        self.assertEqual(['-y', '-f lavfi', '-i anullsrc', '-c:v libx264', '-preset slow', '-t 5'],
+                         self._build(preview=False)['intro'].get_options())
+
+    def test_files_kept_apart_from_final_videos(self):
+        final, preview = self._build(preview=False), self._build(preview=True)
+        self.assertEqual('export_intro.bash', final['intro'].get_script_name())
+        self.assertEqual('export_intro.preview.bash', preview['intro'].get_script_name())
+        self.assertEqual('$video_title.preview.mp4', preview['intro'].get_variables()['output_file'])
+        self.assertEqual(['intro.preview.mp4', 'intro.preview.mp4'], preview['result'].get_part_files())
+        self.assertEqual(['intro.mp4', 'intro.mp4'], final['result'].get_part_files())
+
+    def test_unknown_preview_setting_rejected(self):
+        self.raw_config['preview'] = {'resolution': '320x180'}
+        with self.assertRaises(VideoConfigError):
+            self._build(preview=True)
+
+
+class TestVideoMatrix(unittest.TestCase):
+    def setUp(self) -> None:
+        self.config = Config({
+            'videos': {
+                'intro': {'options': ['-i intro.png']},
+                'trailer_{name}': {
+                    'matrix': [{'name': 'whiplash', 'start': 5}, {'name': 'midsommar', 'start': 0}],
+                    'variables': {'video': 'trailers/$name.mp4'},
+                    'options': ['-ss $start', '-i $video', '-t 15'],
+                },
+                'block': {'combine': ['intro', 'trailer_midsommar']},
+            }
+        }, 'export', 'generate.bash')
+
+    def test_matrix_expanded_in_place(self):
+        self.assertEqual(['intro', 'trailer_whiplash', 'trailer_midsommar', 'block'], list(self.config.get_videos()))
+        self.assertEqual(4, len(self.config.get_videos()))
+        self.assertNotIn('trailer_{name}', self.config.get_videos())
+
+    def test_parameters_become_variables(self):
+        video = self.config.get_videos()['trailer_whiplash']
+        self.assertEqual({'video': 'trailers/$name.mp4', 'name': 'whiplash', 'start': '5'}, video['variables'])
+        self.assertEqual(['-ss $start', '-i $video', '-t 15'], video['options'])
+
+    def test_only_targets_expanded(self):
+        with mock.patch.object(VideoMatrix, 'get_video', wraps=VideoMatrix.get_video, autospec=True) as get_video:
+            configs = build_video_configs_from_config(self.config, [VideoConfigTitleAdder()], ['block'])
+        self.assertEqual(['intro', 'trailer_midsommar', 'block'], [config.get_title() for config in configs])
+        self.assertEqual(['trailer_midsommar'], [call.args[1] for call in get_video.call_args_list])
+
+    def test_duplicate_title_raises(self):
+        config = Config({'videos': {'trailer_whiplash': {}, 'trailer_{name}': {'matrix': [{'name': 'whiplash'}]}}},
+                        'export', 'generate.bash')
+        with self.assertRaises(VideoConfigError):
+            list(config.get_videos())
+
+    def test_missing_parameter_raises(self):
+        config = Config({'videos': {'trailer_{name}': {'matrix': [{'video': 'a.mp4'}]}}}, 'export', 'generate.bash')
+        with self.assertRaises(VideoConfigError):
+            list(config.get_videos())
+
+    def test_title_without_parameter_raises(self):
+        with self.assertRaises(VideoConfigError):
+            Config({'videos': {'trailer': {'matrix': [{'name': 'a'}]}}}, 'export', 'generate.bash').get_videos()
+
+
+class TestVideoConfigInputFingerprintAdder(unittest.TestCase):
+    def setUp(self) -> None:
+        self.fingerprinted = []
+        self.preprocessor = VideoConfigInputFingerprintAdder(self.fingerprint)
+
+    def fingerprint(self, inputs):
+        self.fingerprinted.append(inputs)
+        return 'input-fingerprint'
+
+    def test_resolved_inputs_fingerprinted(self):
+        config = {
+            'variables': {'assets': '/mnt/assets', 'image': '$assets/{video_title}.png', 'rate': 44100},
+            'options': ['-loop 1', '-i $image', '-f lavfi -i anullsrc=sample_rate=$rate', '-t 5'],
+        }
+        config = self.preprocessor.process(config, 'thanks')
+        self.assertEqual([['/mnt/assets/thanks.png', 'anullsrc=sample_rate=44100']], self.fingerprinted)
+        self.assertEqual('input-fingerprint', config['variables']['input_md5'])
+        self.assertEqual(['/mnt/assets/thanks.png', 'anullsrc=sample_rate=44100'], config['inputs'])
+
+    def test_other_options_not_resolved(self):
+        config = {
+            'variables': {'fade': '$(exit 1)'},
+            'options': ['-i image.png', '-af "afade=st=$fade"'],
+        }
+        with mock.patch('subprocess.run') as run:
+            self.preprocessor.process(config, 'video')
+        run.assert_not_called()
+
+    def test_combinations_not_fingerprinted(self):
+        config = self.preprocessor.process({'variables': {}, 'combine': ['intro']}, 'result')
+        self.assertNotIn('input_md5', config['variables'])
+
+
+class StaticMediaProber(MediaProber):
+    def __init__(self, probes: dict):
+        self.probes = probes
+
+    def prefetch(self, paths):
+        pass
+
+    def probe(self, path):
+        return MediaInfo(self.probes[path]) if path in self.probes else None
+
+    def close(self):
+        pass
+
+
+class TestMediaInfo(unittest.TestCase):
+    def setUp(self) -> None:
+        self.media = MediaInfo({
+            'streams': [
+                {'codec_type': 'video', 'codec_name': 'h264', 'width': 1920, 'height': 1080,
+                 'avg_frame_rate': '30000/1001'},
+                {'codec_type': 'audio', 'codec_name': 'aac', 'channel_layout': 'stereo'},
+            ],
+            'format': {'duration': '15.023000'},
+        })
+
+    def test_stream_details(self):
+        self.assertEqual('h264', self.media.get_codec('video'))
+        self.assertEqual('aac', self.media.get_codec('audio'))
+        self.assertEqual((1920, 1080), self.media.get_resolution())
+        self.assertEqual('stereo', self.media.get_audio_layout())
+
+    def test_frame_rate_fraction(self):
+        self.assertAlmostEqual(29.97, float(self.media.get_frame_rate()), places=2)
+
+    def test_duration(self):
+        self.assertAlmostEqual(15.023, self.media.get_duration())
+
+    def test_image_without_audio(self):
+        media = MediaInfo({'streams': [{'codec_type': 'video', 'codec_name': 'png', 'avg_frame_rate': '0/0'}]})
+        self.assertIsNone(media.get_codec('audio'))
+        self.assertIsNone(media.get_frame_rate())
+        self.assertIsNone(media.get_duration())
+
+    def test_video_config_input_media(self):
+        prober = StaticMediaProber({'trailer.mp4': {'streams': [{'codec_type': 'video', 'codec_name': 'h264'}]}})
+        video = VideoConfig({'title': 'trailer', 'inputs': ['trailer.mp4', 'anullsrc']}, prober)
+        media = video.get_input_media()
+        self.assertEqual('h264', media['trailer.mp4'].get_codec('video'))
+        self.assertIsNone(media['anullsrc'])
+
+    def test_config_without_prober(self):
+        self.assertIsNone(Config({}, 'export', 'generate.bash').probe_media('trailer.mp4'))
+
+
 class TestFFmpegOptionBuilder(unittest.TestCase):
     def setUp(self) -> None:
         options = [
@@ -274,6 +549,239 @@ class TestFFmpegOptionBuilder(unittest.TestCase):
         self.assertIn('something', self.output, 'the first element should be in the output')
 
 
+class TestFFmpegConcatBuilder(unittest.TestCase):
+    def test_stream_copy_used_when_parts_match(self):
+        code = FFmpegConcatBuilder(['-c:v libx264'], ['intro.mp4', 'outro.mp4']).build()
+        self.assertIn('concat_videos_copy ${videos[@]}', code)
+        self.assertIn('concat_videos ${concat_inputs[@]}', code)
+
+    def test_filtered_combination_not_stream_copied(self):
+        code = FFmpegConcatBuilder(['-vf "scale=1920:1080"'], ['intro.mp4', 'outro.mp4']).build()
+        self.assertNotIn('concat_videos_copy', code)
+        self.assertIn('concat_videos ${concat_inputs[@]}', code)
+
+    def test_split_parts_passed_once(self):
+        code = FFmpegConcatBuilder([], ['darkness.mp4', 'intro.mp4', 'darkness.mp4'],
+                                   split_parts=['darkness.mp4']).build()
+        self.assertIn('concat_inputs=( darkness.mp4 intro.mp4 )', code)
+
+    def test_other_repeated_parts_passed_for_every_use(self):
+        code = FFmpegConcatBuilder([], ['trailer.mp4', 'intro.mp4', 'trailer.mp4']).build()
+        self.assertIn('concat_inputs=( trailer.mp4 intro.mp4 trailer.mp4 )', code)
+
+    def test_concat_filter_splits_split_parts(self):
+        concat_filter = get_concat_filter(['darkness.mp4', 'intro.mp4', 'darkness.mp4'], ['darkness.mp4'])
+        self.assertEqual('[0:v]split=2[v0_0][v0_1];[0:a]asplit=2[a0_0][a0_1];'
+                         '[v0_0][a0_0][1:v][1:a][v0_1][a0_1]concat=n=3:v=1:a=1[v][a]', concat_filter)
+
+    def test_concat_filter_opens_other_repeated_parts_again(self):
+        concat_filter = get_concat_filter(['darkness.mp4', 'trailer.mp4', 'darkness.mp4', 'trailer.mp4'],
+                                          ['darkness.mp4'])
+        self.assertEqual('[0:v]split=2[v0_0][v0_1];[0:a]asplit=2[a0_0][a0_1];'
+                         '[v0_0][a0_0][1:v][1:a][v0_1][a0_1][2:v][2:a]concat=n=4:v=1:a=1[v][a]', concat_filter)
+
+    def test_concat_filter_without_repeated_parts(self):
+        self.assertEqual('[0:v][0:a][1:v][1:a]concat=n=2:v=1:a=1[v][a]', get_concat_filter(['intro.mp4', 'outro.mp4']))
+
+
+class TestIntermediateProfiles(unittest.TestCase):
+    def get_config(self, videos: dict) -> Config:
+        return Config({
+            'intermediate_profiles': {
+                'stream': {'video_codec': 'libx264', 'fps': 30, 'keyframe_interval': 60, 'sample_rate': 48000},
+                'archive': {'video_codec': 'ffv1'},
+            },
+            'videos': videos,
+        }, 'export', 'generate.bash')
+
+    def test_profile_options(self):
+        profile = IntermediateProfile('stream', {'video_codec': 'libx264', 'fps': 30, 'keyframe_interval': 60,
+                                                 'options': ['-crf 18']})
+        self.assertEqual(['-c:v libx264', '-r 30', '-flags +cgop', '-g 60', '-keyint_min 60', '-sc_threshold 0',
+                          '-crf 18'], profile.get_options())
+
+    def test_unknown_setting_raises(self):
+        with self.assertRaises(VideoConfigError):
+            IntermediateProfile('stream', {'bitrate': '6M'})
+
+    def test_nested_parts_use_profile(self):
+        profiles = get_video_profiles(self.get_config({
+            'intro': {}, 'outro': {}, 'unrelated': {},
+            'credits': {'combine': ['outro']},
+            'result': {'combine': ['intro', 'credits'], 'intermediate_profile': 'stream'},
+        }))
+        self.assertEqual(['credits', 'intro', 'outro', 'result'], sorted(profiles))
+
+    def test_part_with_different_profiles_raises(self):
+        with self.assertRaises(VideoConfigError):
+            get_video_profiles(self.get_config({
+                'intro': {},
+                'stream': {'combine': ['intro'], 'intermediate_profile': 'stream'},
+                'archive': {'combine': ['intro'], 'intermediate_profile': 'archive'},
+            }))
+
+    def test_unknown_profile_raises(self):
+        with self.assertRaises(VideoConfigError):
+            get_video_profiles(self.get_config({'result': {'combine': ['intro'], 'intermediate_profile': 'missing'}}))
+
+    def test_profile_options_appended_to_parts(self):
+        profile = IntermediateProfile('stream', {'video_codec': 'libx264'})
+        preprocessor = VideoConfigIntermediateProfileAdder({'intro': profile, 'result': profile})
+        self.assertEqual(['-t 5', '-c:v libx264', '-flags +cgop'],
+                         preprocessor.process({'options': ['-t 5']}, 'intro')['options'])
+        self.assertEqual('stream', preprocessor.process({'combine': ['intro']}, 'result')['intermediate_profile'])
+
+    def test_filtered_combination_raises(self):
+        preprocessor = VideoConfigIntermediateProfileAdder({'result': IntermediateProfile('stream', {})})
+        with self.assertRaises(VideoConfigError):
+            preprocessor.process({'combine': ['intro'], 'options': ['-vf "scale=1280:720"']}, 'result')
+
+    def test_combination_always_stream_copied(self):
+        code = FFmpegConcatBuilder([], ['intro.mp4'], always_stream_copy=True).build()
+        self.assertIn('concat_videos_copy ${videos[@]}', code)
+        self.assertNotIn('can_stream_copy', code)
+
+
+class TestChunkedVideos(unittest.TestCase):
+    def test_chunked_video_expanded(self):
+        videos = expand_chunked_videos({
+            'intro': {'options': ['-t 5']},
+            'long': {'chunks': 2, 'variables': {'image': '{video_title}.png'}, 'options': ['-i $image', '-t 60']},
+        })
+        self.assertEqual(['intro', 'long_chunk0', 'long_chunk1', 'long'], list(videos))
+        self.assertEqual({'combine': ['long_chunk0', 'long_chunk1'], 'chunked': True}, videos['long'])
+        self.assertEqual([1, 2], videos['long_chunk1']['chunk'])
+        self.assertEqual({'image': 'long.png'}, videos['long_chunk1']['variables'])
+        self.assertNotIn('chunks', videos['long_chunk1'])
+
+    def test_chunked_combination_raises(self):
+        with self.assertRaises(VideoConfigError):
+            expand_chunked_videos({'result': {'chunks': 2, 'combine': ['intro']}})
+
+    def test_invalid_chunk_count_raises(self):
+        with self.assertRaises(VideoConfigError):
+            expand_chunked_videos({'long': {'chunks': 0}})
+
+    def test_chunk_options(self):
+        options, variables = get_chunk_options('long', ['-loop 1', '-i image.png', '-f lavfi -i anullsrc',
+                                                        '-t $duration', '-vf "fps=30"'], {'duration': '100'}, 1, 3)
+        self.assertEqual(['-copyts', '-loop 1', '-ss $chunk_start -i image.png',
+                          '-f lavfi -ss $chunk_start -i anullsrc', '-vf "fps=30"', '-to $chunk_end'], options)
+        self.assertEqual({'chunk_start': '33', 'chunk_end': '66'}, variables)
+
+    def test_chunks_add_up(self):
+        chunks = [get_chunk_options('long', ['-i image.png', '-t 100'], {}, index, 3)[1] for index in range(3)]
+        self.assertEqual([('0', '33'), ('33', '66'), ('66', '100')],
+                         [(chunk['chunk_start'], chunk['chunk_end']) for chunk in chunks])
+
+    def test_fractional_and_clock_durations(self):
+        _, variables = get_chunk_options('long', ['-i image.png', '-t 90.5'], {}, 1, 2)
+        self.assertEqual({'chunk_start': '45', 'chunk_end': '90.5'}, variables)
+        _, variables = get_chunk_options('long', ['-i image.png', '-t $duration'], {'duration': '00:20:00'}, 0, 2)
+        self.assertEqual({'chunk_start': '0', 'chunk_end': '600'}, variables)
+
+    def test_duration_known_while_building_left_to_bash(self):
+        _, variables = get_chunk_options('long', ['-i image.png', '-t $duration'],
+                                         {'duration': '$(( $intro_length * 2 ))'}, 1, 2)
+        resolver = VariableResolver({'duration': '$(( $intro_length * 2 ))', **variables}, {'intro_length': '10'})
+        self.assertEqual('10', resolver.resolve('chunk_start'))
+        self.assertEqual('20', resolver.resolve('chunk_end'))
+
+    def test_invalid_duration_raises(self):
+        with self.assertRaises(VideoConfigError):
+            get_chunk_options('long', ['-i image.png', '-t $duration'], {'duration': 'forever'}, 0, 2)
+
+    def test_input_duration_used(self):
+        options = ['-loop 1', '-i image.png', '-t 5', '-f lavfi -i anullsrc', '-shortest']
+        options, variables = get_chunk_options('darkness', options, {}, 1, 2)
+        self.assertEqual(['-copyts', '-loop 1', '-ss $chunk_start -i image.png', '-t 5',
+                          '-f lavfi -ss $chunk_start -i anullsrc', '-shortest', '-to $chunk_end'], options)
+        self.assertEqual({'chunk_start': '2', 'chunk_end': '5'}, variables)
+
+    def test_missing_duration_raises(self):
+        with self.assertRaises(VideoConfigError):
+            get_chunk_options('long', ['-t 5', '-i image.png', '-t 6', '-i other.png'], {}, 0, 2)
+
+    def test_chunked_combination_always_stream_copied(self):
+        video = VideoConfig({'combine': ['long_chunk0'], 'chunked': True})
+        self.assertTrue(video.is_always_stream_copied())
+        self.assertFalse(VideoConfig({'combine': ['intro']}).is_always_stream_copied())
+
+
+class TestSplitStreams(unittest.TestCase):
+    options = ['-loop 1', '-i $image', '-i $music', '-t 5', '-vf "fps=30"', '-c:v libx264', '-af "volume=0.5"',
+               '-c:a aac']
+    variables = {'image': 'countdown.png', 'music': 'background.mp3'}
+
+    def test_split_video_expanded(self):
+        videos = expand_split_videos({
+            'intro': {'options': ['-t 5']},
+            'countdown': {'split_streams': True, 'variables': {'image': '{video_title}.png'}, 'options': ['-t 5']},
+        })
+        self.assertEqual(['intro', 'countdown_video', 'countdown_audio', 'countdown'], list(videos))
+        self.assertEqual({'mux': ['countdown_video', 'countdown_audio']}, videos['countdown'])
+        self.assertEqual('audio', videos['countdown_audio']['stream'])
+        self.assertEqual({'image': 'countdown.png'}, videos['countdown_video']['variables'])
+        self.assertNotIn('split_streams', videos['countdown_video'])
+
+    def test_split_combination_raises(self):
+        with self.assertRaises(VideoConfigError):
+            expand_split_videos({'result': {'split_streams': True, 'combine': ['intro']}})
+        with self.assertRaises(VideoConfigError):
+            expand_split_videos({'result': {'split_streams': True, 'chunks': 2}})
+
+    def test_stream_options(self):
+        video = get_stream_options('countdown', self.options, self.variables, 'video')
+        audio = get_stream_options('countdown', self.options, self.variables, 'audio')
+        self.assertEqual(['-loop 1', '-i $image', '-t 5', '-vf "fps=30"', '-c:v libx264', '-an'], video)
+        self.assertEqual(['-i $music', '-t 5', '-af "volume=0.5"', '-c:a aac', '-vn'], audio)
+
+    def test_audio_change_keeps_video_options(self):
+        options = [option.replace('volume=0.5', 'volume=0.8') for option in self.options]
+        variables = {**self.variables, 'music': 'other.mp3'}
+        self.assertEqual(get_stream_options('countdown', self.options, self.variables, 'video'),
+                         get_stream_options('countdown', options, variables, 'video'))
+
+    def test_input_with_both_streams_kept(self):
+        options = get_stream_options('clip', ['-y', '-i clip.mp4', '-c:a aac'], {}, 'video')
+        self.assertEqual(['-y', '-i clip.mp4', '-an'], options)
+
+    def test_multi_line_template_kept_with_its_option(self):
+        # the countdown template of example.yaml
+        countdown = '\n'.join([
+            '-vf "fps=$fps,drawtext=fontfile=\'$font_file\'',
+            '     :fontcolor=$font_color:fontsize=$font_size',
+            '     :x=(w-text_w)/2:y=(h-text_h)/2',
+            "     :text='%{eif\\:(($countdown_start-t)/60)\\:d\\:2}'\"",
+        ])
+        options = VideoConfigOptionReferenceReplacer({'countdown': countdown}).process({'options': [
+            '-loop 1', '-i $image', '-i $music', '-t 5', '-af "volume=0.07"', 'countdown', '-strict 2',
+        ]}, 'countdown')['options']
+        video = get_stream_options('countdown', options, self.variables, 'video')
+        audio = get_stream_options('countdown', options, self.variables, 'audio')
+        self.assertEqual(['-loop 1', '-i $image', '-t 5', *countdown.splitlines(), '-strict 2', '-an'], video)
+        self.assertEqual(['-i $music', '-t 5', '-af "volume=0.07"', '-strict 2', '-vn'], audio)
+
+    def test_mapped_inputs_raise(self):
+        with self.assertRaises(VideoConfigError):
+            get_stream_options('countdown', [*self.options, '-map 0:v'], self.variables, 'video')
+
+    def test_missing_stream_input_raises(self):
+        with self.assertRaises(VideoConfigError):
+            get_stream_options('countdown', ['-loop 1', '-i $image', '-t 5'], self.variables, 'audio')
+
+    def test_dropped_input_duration_raises(self):
+        with self.assertRaises(VideoConfigError):
+            get_stream_options('countdown', ['-loop 1', '-t 5', '-i $image', '-i $music'], self.variables, 'audio')
+
+    def test_muxed_video(self):
+        self.assertEqual(['-i a.mp4', '-i b.mp4', '-map 0:v', '-map 1:a', '-c copy'],
+                         get_mux_options(['a.mp4', 'b.mp4']))
+        video = VideoConfig({'mux': ['countdown_video', 'countdown_audio']})
+        self.assertEqual(['countdown_video', 'countdown_audio'], video.get_dependencies({'countdown_video', 'countdown_audio'}))
+        self.assertFalse(video.is_combination())
+
+
 class TestVideoConfigListPreprocessor(unittest.TestCase):
     def test_abstract_class_raises_when_used(self):
         preprocessor = VideoConfigListPreprocessor()
@@ -281,6 +789,70 @@ class TestVideoConfigListPreprocessor(unittest.TestCase):
             preprocessor.process({}, '')
 
 
+class TestVideoConfigPreprocessors(unittest.TestCase):
+    def test_templates_replaced_with_their_options(self):
+        preprocessor = VideoConfigOptionReferenceReplacer({'encoding': '-c:v h264\n-r $fps', 'audio': '-an'})
+        config = preprocessor.process({'options': ['-y', 'encoding', {'first': '-t 5'}, 'audio']}, 'intro')
+        self.assertEqual(['-y', '-c:v h264', '-r $fps', {'first': '-t 5'}, '-an'], config['options'])
+
+    def test_variable_references_replaced(self):
+        preprocessor = VideoConfigVariableReferenceReplacer({'{video_title}': 'intro', '{other}': 'outro'})
+        config = preprocessor.process({'variables': {'files': '{video_title}.mp4 {other}.mp4', 'duration': 5}}, 'intro')
+        self.assertEqual({'files': 'intro.mp4 outro.mp4', 'duration': '5'}, config['variables'])
+
+    def test_video_filter_rendered_at_render_fps(self):
+        config = VideoConfigRenderRateAdder().process({'render_fps': 1, 'options': [
+            '-loop 1', '-i $image', '-t 1200', '-vf "fps=$fps,drawtext=text=%{eif\\:$start-t\\:d}"', '-r $fps',
+        ]}, 'countdown')
+        self.assertEqual('-vf "fps=1,settb=AVTB,setpts=PTS+1,drawtext=text=%{eif\\:$start-t\\:d},fps=1"',
+                         config['options'][3])
+        self.assertEqual('-r $fps', config['options'][4])
+
+    def test_fps_filter_added_to_video_filter(self):
+        config = VideoConfigRenderRateAdder().process({'render_fps': 2, 'options': ['-i $image', '-vf scale=1280:-2',
+                                                                                   '-r 24']}, 'slides')
+        self.assertEqual(['-i $image', '-vf fps=2,settb=AVTB,setpts=PTS+1,scale=1280:-2,fps=2', '-r 24'],
+                         config['options'])
+
+    def test_filter_over_several_lines_ended_on_its_last_line(self):
+        config = VideoConfigRenderRateAdder().process({'render_fps': 1, 'options': [
+            '-i $image', '-vf "fps=$fps,drawtext=fontfile=\'$font_file\'', ":text='%{eif\\:$start-t\\:d}'\"", '-r 24',
+        ]}, 'countdown')
+        self.assertEqual(['-i $image', '-vf "fps=1,settb=AVTB,setpts=PTS+1,drawtext=fontfile=\'$font_file\'',
+                          ":text='%{eif\\:$start-t\\:d}',fps=1\"", '-r 24'], config['options'])
+
+    def test_render_fps_needs_output_frame_rate_and_filter(self):
+        with self.assertRaises(VideoConfigError):
+            VideoConfigRenderRateAdder().process({'render_fps': 1, 'options': ['-i $image', '-vf scale=1280:-2']}, 'a')
+        with self.assertRaises(VideoConfigError):
+            VideoConfigRenderRateAdder().process({'render_fps': 1, 'options': ['-i $image', '-r 24']}, 'a')
+        with self.assertRaises(VideoConfigError):
+            VideoConfigRenderRateAdder().process({'render_fps': 0, 'options': ['-i $image', '-vf scale=1:1', '-r 24']},
+                                                 'a')
+        with self.assertRaises(VideoConfigError):
+            VideoConfigRenderRateAdder().process({'render_fps': 1, 'options': ['-i $image', '-vf "scale=1:1', '-r 24']},
+                                                 'a')
+
+    def test_raw_config_unchanged(self):
+        config = Config({
+            'shared_variables': {'fps': 24},
+            'shared_options': ['-y'],
+            'videos': {'intro': {'variables': {'image': '{video_title}.png'}, 'options': ['-i $image']}},
+        }, 'export', 'generate.bash')
+        build_video_configs_from_config(config, [
+            VideoConfigTitleAdder(),
+            VideoConfigVariablePrepender(config.get_variables()),
+            VideoConfigVariableAppender({'output_file': '$video_title.mp4'}),
+            VideoConfigOptionPrepender(config.get_options()),
+        ])
+        self.assertEqual({'intro': {'variables': {'image': '{video_title}.png'}, 'options': ['-i $image']}},
+                         config.get_videos())
+
+    def test_video_config_has_no_attribute_dict(self):
+        with self.assertRaises(AttributeError):
+            VideoConfig({'title': 'intro'}).title = 'outro'
+
+
 class TestBashCodeWriter(unittest.TestCase):
     def test_bash_code_writer_throws_on_write(self):
         writer = BashCodeBuilder()
@@ -330,3 +902,500 @@ class TestVideoVariableListBuilderWithCombine(unittest.TestCase):
             last = first + 3 + 1
             extension = self.output[first:last]
             self.assertEqual('.mp4', extension)
+
+
+class TestVideoDependencyGraph(unittest.TestCase):
+    def setUp(self) -> None:
+        self.videos = [
+            VideoConfig({'title': 'result', 'combine': ['intro', 'countdown', 'intro']}),
+            VideoConfig({'title': 'countdown', 'variables': {'duration': '$(expr 60 - $intro_length)'}}),
+            VideoConfig({'title': 'intro'}),
+            VideoConfig({'title': 'unrelated'}),
+        ]
+        self.graph = VideoDependencyGraph(self.videos)
+
+    def test_parts_are_ordered_before_combination(self):
+        titles = self.graph.get_titles()
+        self.assertLess(titles.index('intro'), titles.index('result'))
+        self.assertLess(titles.index('countdown'), titles.index('result'))
+
+    def test_length_reference_is_a_dependency(self):
+        self.assertEqual(['intro'], self.graph.get_dependencies('countdown'))
+
+    def test_repeated_parts_are_listed_once(self):
+        self.assertEqual(['intro', 'countdown'], self.graph.get_dependencies('result'))
+
+    def test_dependents_listed(self):
+        self.assertEqual(['countdown', 'result'], self.graph.get_dependents('intro'))
+
+    def test_unknown_part_raises(self):
+        with self.assertRaises(VideoDependencyError):
+            VideoDependencyGraph([VideoConfig({'title': 'result', 'combine': ['missing']})])
+
+    def test_cycle_raises(self):
+        with self.assertRaises(VideoDependencyError):
+            VideoDependencyGraph([
+                VideoConfig({'title': 'first', 'combine': ['second']}),
+                VideoConfig({'title': 'second', 'combine': ['first']}),
+            ])
+
+
+class TestJobScheduler(unittest.TestCase):
+    def setUp(self) -> None:
+        self.graph = VideoDependencyGraph([
+            VideoConfig({'title': 'part1'}),
+            VideoConfig({'title': 'part2'}),
+            VideoConfig({'title': 'part3'}),
+            VideoConfig({'title': 'result', 'combine': ['part1', 'part2', 'part3']}),
+        ])
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most_running = 0
+        self.finished = []
+
+    def job(self, video, dependency_results):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+            self.finished.append(video.get_title())
+        return VideoBuildResult(video.get_title(), VideoBuildResult.BUILT, 1)
+
+    def test_independent_videos_run_in_parallel(self):
+        JobScheduler(self.graph, 3).run(self.job)
+        self.assertEqual(3, self.most_running)
+
+    def test_job_limit_respected(self):
+        JobScheduler(self.graph, 2).run(self.job)
+        self.assertEqual(2, self.most_running)
+
+    def test_combination_runs_after_parts(self):
+        JobScheduler(self.graph, 4).run(self.job)
+        self.assertEqual('result', self.finished[-1])
+
+    def test_combination_receives_part_results(self):
+        received = {}
+
+        def job(video, dependency_results):
+            received[video.get_title()] = dependency_results
+            return VideoBuildResult(video.get_title(), VideoBuildResult.BUILT, 1)
+
+        JobScheduler(self.graph, 2).run(job)
+        self.assertEqual(['part1', 'part2', 'part3'], list(received['result'].keys()))
+
+    def test_combination_cancelled_when_part_fails(self):
+        def job(video, dependency_results):
+            status = VideoBuildResult.FAILED if video.get_title() == 'part2' else VideoBuildResult.BUILT
+            return VideoBuildResult(video.get_title(), status)
+
+        cancelled = []
+        results = JobScheduler(self.graph, 2, on_cancel=cancelled.append).run(job)
+        self.assertEqual(VideoBuildResult.CANCELLED, results['result'].get_status())
+        self.assertTrue(results['part3'].is_successful())
+        self.assertEqual(['result'], cancelled)
+
+    def test_zero_jobs_not_allowed(self):
+        with self.assertRaises(ValueError):
+            JobScheduler(self.graph, 0)
+
+
+class TestVariableResolver(unittest.TestCase):
+    def setUp(self) -> None:
+        self.resolver = VariableResolver({
+            'assets': '/mnt/my assets',
+            'image': '$assets/image.png',
+            'duration': 31,
+            'fade_start': '$(expr $duration - 30)',
+            'color': '"#ffffff"',
+            'early': '$late',
+            'late': 'value',
+            'video_title': 'intro',
+            'output_file': '${video_title}.mp4',
+        }, {'intro_length': '5'})
+
+    def test_references_resolved(self):
+        self.assertEqual('/mnt/my assets/image.png', self.resolver.resolve('image'))
+
+    def test_command_substitution_resolved(self):
+        self.assertEqual('1', self.resolver.resolve('fade_start'))
+
+    def test_quotes_removed(self):
+        self.assertEqual('#ffffff', self.resolver.resolve('color'))
+
+    def test_variables_declared_later_resolved(self):
+        self.assertEqual('value', self.resolver.resolve('early'))
+
+    def test_braced_reference_resolved(self):
+        self.assertEqual('intro.mp4', self.resolver.resolve('output_file'))
+
+    def test_environment_resolved(self):
+        self.assertEqual('5', self.resolver.resolve('intro_length'))
+
+    def test_unquoted_expansion_split(self):
+        self.assertEqual(['-i', '/mnt/my', 'assets/image.png'], self.resolver.split('-i $image'))
+
+    def test_quoted_expansion_not_split(self):
+        self.assertEqual(['-i', '/mnt/my assets/image.png'], self.resolver.split('-i "$image"'))
+
+    def test_single_quotes_not_expanded(self):
+        self.assertEqual(['$image'], self.resolver.split("'$image'"))
+
+    def test_backslash_kept_in_double_quotes(self):
+        self.assertEqual(['drawtext=text=a\\:b'], self.resolver.split('"drawtext=text=a\\:b"'))
+
+    def test_single_quotes_kept_in_double_quotes(self):
+        self.assertEqual(["font='/mnt/my assets/image.png'"], self.resolver.split('"font=\'$image\'"'))
+
+    def test_circular_reference_raises(self):
+        resolver = VariableResolver({'first': '$second', 'second': '$(expr $third + 1)', 'third': '$first'})
+        with self.assertRaisesRegex(VideoConfigError, 'first -> second -> third -> first'):
+            resolver.resolve('first')
+
+    def test_arithmetic_evaluated_without_shell(self):
+        resolver = VariableResolver({'duration': 31, 'fade': '$(expr $duration - 30)',
+                                     'half': '$(( (duration + 1) / 2 ))',
+                                     'rounded': '$(( -7 / 2 )) $(( -7 % 2 )) $(expr 3 \\* 4)'})
+        with mock.patch('subprocess.run') as run:
+            self.assertEqual(['1', '16', '-3 -1 12'], [resolver.resolve(name) for name in ['fade', 'half', 'rounded']])
+        run.assert_not_called()
+
+    def test_other_commands_run_in_shell(self):
+        self.assertEqual('3', VariableResolver({'length': '$(expr length abc)'}).resolve('length'))
+
+    def test_variables_resolved_in_dependency_order(self):
+        resolver = VariableResolver({
+            'early': '$late',
+            'late': 'my value',
+            'start': '$(expr $intro_length - $late_number)',
+            'late_number': 2,
+        }, dynamic=['intro_length'])
+        self.assertEqual({
+            'late': "'my value'",
+            'early': "'my value'",
+            'late_number': '2',
+            'start': '$(expr $intro_length - $late_number)',
+        }, resolver.resolve_variables())
+        self.assertEqual(['late', 'early', 'late_number', 'start'], list(resolver.resolve_variables()))
+
+
+class TestFFmpegCommandBuilder(unittest.TestCase):
+    def get_command(self, raw_config: dict):
+        video = VideoConfig(raw_config)
+        return FFmpegCommandBuilder(video, VariableResolver(video.get_variables())).build()
+
+    def test_generate_command(self):
+        command = self.get_command({
+            'title': 'intro',
+            'variables': {'duration': 5, 'output_file': 'intro.mp4'},
+            'options': ['-y', '-t $duration', '-vf "scale=1920:1080,', 'setsar=1:1"'],
+        })
+        self.assertEqual(['ffmpeg', '-y', '-t', '5', '-vf', 'scale=1920:1080, \tsetsar=1:1', 'intro.mp4'], command)
+
+    def test_concat_command_uses_all_parts(self):
+        command = self.get_command({
+            'title': 'result',
+            'variables': {'output_file': 'result.mp4'},
+            'options': ['-c:v h264'],
+            'combine': ['intro', 'outro', 'intro'],
+            'split_parts': ['intro.mp4'],
+        })
+        self.assertEqual(['-i', 'intro.mp4', '-i', 'outro.mp4', '-filter_complex'], command[2:7])
+        self.assertIn('concat=n=3:v=1:a=1', command[command.index('-filter_complex') + 1])
+        self.assertEqual(['-c:v', 'h264', 'result.mp4'], command[-3:])
+
+    def test_stream_copy_command_uses_concat_demuxer(self):
+        video = VideoConfig({'title': 'result', 'variables': {'output_file': 'result.mp4'}, 'options': ['-v warning'],
+                             'combine': ['intro', 'outro']})
+        builder = FFmpegCommandBuilder(video, VariableResolver(video.get_variables()))
+        self.assertTrue(builder.can_stream_copy())
+        self.assertEqual(['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', '.result.concat', '-map', '0',
+                          '-v', 'warning', '-c:v', 'copy', '-c:a', 'copy', 'result.mp4'], builder.build_stream_copy())
+
+    def test_filtered_combination_not_stream_copied(self):
+        video = VideoConfig({'title': 'result', 'options': ['-af "volume=2"'], 'combine': ['intro', 'outro']})
+        self.assertFalse(FFmpegCommandBuilder(video, VariableResolver(video.get_variables())).can_stream_copy())
+
+
+class TestFFmpegRunner(unittest.TestCase):
+    def test_unexpected_error_fails_video(self):
+        runner = FFmpegRunner('export', mock.Mock())
+        with mock.patch.object(FFmpegRunner, '_build', side_effect=ValueError('no duration')):
+            with mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                result = runner.run(VideoConfig({'title': 'intro'}), {})
+        self.assertEqual(VideoBuildResult.FAILED, result.get_status())
+        self.assertIn('Failed to build intro: no duration', stderr.getvalue())
+
+
+class TestVideoFingerprinter(unittest.TestCase):
+    def get_fingerprints(self, intro_duration: int = 5) -> dict:
+        graph = VideoDependencyGraph([
+            VideoConfig({'title': 'intro', 'variables': {'duration': intro_duration, 'output_file': 'intro.mp4'},
+                         'options': ['-t $duration']}),
+            VideoConfig({'title': 'countdown', 'variables': {'duration': '$(expr 60 - $intro_length)',
+                                                             'output_file': 'countdown.mp4'},
+                         'options': ['-t $duration']}),
+            VideoConfig({'title': 'part', 'variables': {'output_file': 'part.mp4'}, 'combine': ['intro', 'countdown']}),
+            VideoConfig({'title': 'result', 'variables': {'output_file': 'result.mp4'}, 'combine': ['part', 'intro']}),
+            VideoConfig({'title': 'unrelated', 'variables': {'output_file': 'unrelated.mp4'}, 'options': ['-t 5']}),
+        ])
+        return {video.get_title(): video.get_fingerprint() for video in VideoFingerprinter(graph).fingerprint().get_videos()}
+
+    def test_fingerprints_stable(self):
+        self.assertEqual(self.get_fingerprints(), self.get_fingerprints())
+
+    def test_every_video_fingerprinted(self):
+        self.assertEqual(5, len(set(self.get_fingerprints().values())))
+
+    def test_change_reaches_nested_combinations(self):
+        before, after = self.get_fingerprints(5), self.get_fingerprints(6)
+        for title in ['intro', 'countdown', 'part', 'result']:
+            self.assertNotEqual(before[title], after[title])
+
+    def test_change_does_not_reach_unrelated_videos(self):
+        self.assertEqual(self.get_fingerprints(5)['unrelated'], self.get_fingerprints(6)['unrelated'])
+
+    def test_command_substitution_not_run(self):
+        resolver = VariableResolver({'file': 'a.png', 'path': '$(readlink -f $file)'}, run_commands=False)
+        self.assertEqual('$(readlink -f $file)', resolver.resolve('path'))
+        self.assertEqual({'file': 'a.png'}, resolver.get_unresolved_dependencies())
+
+    def test_values_of_code_left_to_bash_fingerprinted(self):
+        def get_countdown(total: int) -> VideoConfig:
+            graph = VideoDependencyGraph([
+                VideoConfig({'title': 'probed', 'variables': {'output_file': 'probed.mp4'}, 'options': ['-i a.mp4']}),
+                VideoConfig({'title': 'countdown', 'variables': {
+                    'total': total, 'duration': '$(expr $total - $probed_length)', 'output_file': 'countdown.mp4',
+                }, 'options': ['-t $duration']}),
+            ])
+            return VideoFingerprinter(graph).fingerprint().get_video('countdown')
+
+        self.assertEqual('$(expr $total - $probed_length)', get_countdown(60).get_variables()['duration'])
+        self.assertNotEqual(get_countdown(60).get_fingerprint(), get_countdown(70).get_fingerprint())
+
+    def test_only_short_parts_split(self):
+        graph = VideoDependencyGraph([
+            VideoConfig({'title': 'darkness', 'variables': {'output_file': 'darkness.mp4'},
+                         'options': ['-f lavfi', '-i color', '-t 5']}),
+            VideoConfig({'title': 'countdown', 'variables': {'output_file': 'countdown.mp4'},
+                         'options': ['-f lavfi', '-i color', '-t 1200']}),
+            VideoConfig({'title': 'trailer', 'variables': {'output_file': 'trailer.mp4'}, 'options': ['-i a.mp4']}),
+            VideoConfig({'title': 'result', 'variables': {'output_file': 'result.mp4'},
+                         'combine': ['darkness', 'countdown', 'trailer', 'darkness', 'countdown', 'trailer']}),
+        ])
+        result = VideoFingerprinter(graph).fingerprint().get_video('result')
+        self.assertEqual(['darkness.mp4'], result.get_split_parts())
+
+    def test_variables_resolved(self):
+        graph = VideoDependencyGraph([
+            VideoConfig({'title': 'intro', 'variables': {'output_file': 'intro.mp4'},
+                         'options': ['-f lavfi', '-i anullsrc', '-t 5']}),
+            VideoConfig({'title': 'probed', 'variables': {'output_file': 'probed.mp4'}, 'options': ['-i a.mp4']}),
+            VideoConfig({'title': 'countdown', 'variables': {
+                'duration': '$(expr 60 - $intro_length - $probed_length)',
+                'fade': '$(expr 60 - $intro_length)',
+                'output_file': 'countdown.mp4',
+            }, 'options': ['-t $duration']}),
+        ])
+        variables = VideoFingerprinter(graph).fingerprint().get_video('countdown').get_variables()
+        self.assertEqual('55', variables['fade'])
+        self.assertEqual('$(expr 60 - $intro_length - $probed_length)', variables['duration'])
+
+
+class TestStaticDuration(unittest.TestCase):
+    def test_looped_image_lasts_output_duration(self):
+        command = ['ffmpeg', '-loop', '1', '-i', 'image.png', '-t', '31', 'countdown.mp4']
+        self.assertEqual(31, get_static_duration(command))
+
+    def test_shortest_generated_source_duration(self):
+        command = ['ffmpeg', '-loop', '1', '-i', 'image.png', '-t', '5', '-f', 'lavfi', '-i', 'anullsrc',
+                   '-shortest', 'darkness.mp4']
+        self.assertEqual(5, get_static_duration(command))
+
+    def test_video_file_input_not_static(self):
+        command = ['ffmpeg', '-loop', '1', '-i', 'image.png', '-i', 'music.mp3', '-t', '31', 'countdown.mp4']
+        self.assertIsNone(get_static_duration(command))
+
+    def test_endless_video_not_static(self):
+        self.assertIsNone(get_static_duration(['ffmpeg', '-loop', '1', '-i', 'image.png', 'endless.mp4']))
+
+    def test_generated_source_with_duration_not_static(self):
+        command = ['ffmpeg', '-f', 'lavfi', '-i', 'sine=d=3', '-t', '5', 'beep.mp4']
+        self.assertIsNone(get_static_duration(command))
+
+
+class TestStillImageEncoding(unittest.TestCase):
+    def _get_encoding(self, command):
+        return get_still_image_encoding(command, '.card.still.mp4', '.card.still_end.mp4', '.card.still')
+
+    def test_image_segment_encoded_once_and_repeated(self):
+        command = ['ffmpeg', '-y', '-loop', '1', '-i', 'thanks.png', '-f', 'lavfi', '-i', 'anullsrc', '-t', '8',
+                   '-c:v', 'h264', '-r', '24', 'thanks.mp4']
+        encoding = self._get_encoding(command)
+        self.assertEqual([['ffmpeg', '-y', '-loop', '1', '-i', 'thanks.png', '-f', 'lavfi', '-i', 'anullsrc',
+                           '-c:v', 'h264', '-r', '24', '-an', '-frames:v', '48', '.card.still.mp4']],
+                         encoding.get_segment_commands())
+        self.assertEqual("file '.card.still.mp4'\n" * 4, encoding.get_concat_list())
+        self.assertEqual(['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', '.card.still', '-f', 'lavfi',
+                          '-i', 'anullsrc', '-c:v', 'h264', '-r', '24', '-map', '0:v', '-map', '1:a', '-c:v', 'copy',
+                          '-t', '8.0', 'thanks.mp4'], encoding.get_mux_command())
+
+    def test_remaining_frames_encoded_as_end_segment(self):
+        command = ['ffmpeg', '-loop', '1', '-i', 'image.png', '-t', '5', '-f', 'lavfi', '-i', 'anullsrc',
+                   '-shortest', 'darkness.mp4']
+        encoding = self._get_encoding(command)
+        # images are read at 25 frames per second by default
+        self.assertEqual(['50', '25'], [segment[-2] for segment in encoding.get_segment_commands()])
+        self.assertEqual("file '.card.still.mp4'\n" * 2 + "file '.card.still_end.mp4'\n", encoding.get_concat_list())
+        self.assertNotIn('-shortest', encoding.get_mux_command())
+
+    def test_filtered_image_encoded_whole(self):
+        command = ['ffmpeg', '-loop', '1', '-i', 'image.png', '-t', '30', '-vf', 'drawtext=text=%{pts}', 'count.mp4']
+        self.assertIsNone(self._get_encoding(command))
+
+    def test_image_with_music_encoded_whole(self):
+        command = ['ffmpeg', '-loop', '1', '-i', 'image.png', '-i', 'music.mp3', '-t', '30', 'song.mp4']
+        self.assertIsNone(self._get_encoding(command))
+
+    def test_short_image_encoded_whole(self):
+        command = ['ffmpeg', '-loop', '1', '-i', 'image.png', '-t', '3', '-r', '24', 'flash.mp4']
+        self.assertIsNone(self._get_encoding(command))
+
+
+class TestThreadBudget(unittest.TestCase):
+    def test_single_job_gets_all_cores(self):
+        budget = ThreadBudget(32, 1, 5)
+        self.assertEqual(32, budget.reserve('video', 15))
+
+    def test_equal_jobs_split_cores_evenly(self):
+        budget = ThreadBudget(32, 4, 10)
+        threads = [budget.reserve(f'video{index}', 15) for index in range(4)]
+        self.assertEqual([8, 8, 8, 8], threads)
+
+    def test_longer_job_gets_more_threads(self):
+        budget = ThreadBudget(32, 3, 3)
+        trailer = budget.reserve('trailer', 15)
+        countdown = budget.reserve('countdown', 1200)
+        self.assertGreater(countdown, trailer)
+
+    def test_reserved_threads_never_exceed_cores(self):
+        budget = ThreadBudget(8, 4, 4)
+        threads = [budget.reserve(f'video{index}', weight) for index, weight in enumerate([1, 1000, 1, 1000])]
+        self.assertLessEqual(sum(threads), 8)
+        self.assertTrue(all(thread >= 1 for thread in threads))
+
+    def test_released_threads_reused(self):
+        budget = ThreadBudget(16, 2, 3)
+        budget.reserve('first', 10)
+        budget.reserve('second', 10)
+        budget.release('first')
+        self.assertEqual(8, budget.reserve('third', 10))
+
+    def test_last_job_not_waiting_for_missing_jobs(self):
+        budget = ThreadBudget(16, 4, 2)
+        budget.skip('up_to_date')
+        self.assertEqual(16, budget.reserve('only', 10))
+
+    def test_repeated_reservations_counted_once(self):
+        budget = ThreadBudget(16, 2, 2)
+        budget.reserve('first', 10)
+        budget.release('first')
+        # still image videos reserve threads for each of their commands
+        self.assertEqual(8, budget.reserve('first', 10))
+
+    def test_skipped_videos_free_their_slots(self):
+        budget = ThreadBudget(16, 4, 4)
+        for title in ['cancelled1', 'cancelled2', 'cancelled3']:
+            budget.skip(title)
+        self.assertEqual(16, budget.reserve('last', 10))
+
+
+class TestThreadOptions(unittest.TestCase):
+    def test_thread_options_added(self):
+        command = add_thread_options(['ffmpeg', '-i', 'in.png', 'out.mp4'], 4)
+        self.assertEqual(['ffmpeg', '-filter_threads', '4', '-i', 'in.png', '-threads', '4', 'out.mp4'], command)
+
+    def test_filter_complex_threads_added_for_filter_complex(self):
+        command = add_thread_options(['ffmpeg', '-filter_complex', 'concat', 'out.mp4'], 4)
+        self.assertIn('-filter_complex_threads', command)
+
+    def test_explicit_thread_options_respected(self):
+        original = ['ffmpeg', '-filter_threads', '2', '-i', 'in.png', '-threads', '1', 'out.mp4']
+        self.assertEqual(original, add_thread_options(original, 4))
+
+    def test_expected_duration_parsed(self):
+        self.assertEqual(1200, get_expected_duration(['ffmpeg', '-t', '20:00', 'out.mp4']))
+        self.assertEqual(5.5, get_expected_duration(['ffmpeg', '-t', '5.5', 'out.mp4']))
+        self.assertIsNone(get_expected_duration(['ffmpeg', 'out.mp4']))
+
+
+class TestMemoryGate(unittest.TestCase):
+    def setUp(self) -> None:
+        gigabyte = 1024 ** 3
+        history = json.dumps({'concat': 3 * gigabyte, 'scale': 2 * gigabyte, 'card': gigabyte // 4})
+        with mock.patch('builtins.open', mock.mock_open(read_data=history)):
+            self.gate = MemoryGate('memory.json', 4 * gigabyte)
+
+    def test_video_admitted_when_it_fits(self):
+        with mock.patch('psutil.virtual_memory', return_value=mock.Mock(available=16 * 1024 ** 3)):
+            self.assertTrue(self.gate.admit('scale'))
+            self.assertTrue(self.gate.admit('card'))
+
+    def test_video_held_back_over_ceiling(self):
+        with mock.patch('psutil.virtual_memory', return_value=mock.Mock(available=16 * 1024 ** 3)):
+            self.assertTrue(self.gate.admit('concat'))
+            self.assertFalse(self.gate.admit('scale'))
+
+    def test_released_memory_reused(self):
+        with mock.patch('psutil.virtual_memory', return_value=mock.Mock(available=16 * 1024 ** 3)):
+            self.gate.admit('concat')
+            self.gate.release('concat')
+            self.assertTrue(self.gate.admit('scale'))
+
+    def test_video_held_back_without_available_memory(self):
+        with mock.patch('psutil.virtual_memory', return_value=mock.Mock(available=1024 ** 3)):
+            self.assertFalse(self.gate.admit('scale'))
+
+    def test_forced_video_admitted(self):
+        with mock.patch('psutil.virtual_memory', return_value=mock.Mock(available=0)):
+            self.assertTrue(self.gate.admit('concat', force=True))
+
+    def test_unknown_video_expected_to_use_most_seen(self):
+        self.assertEqual(3 * 1024 ** 3, self.gate.get_estimate('new_video'))
+
+    def test_size_parsed(self):
+        self.assertEqual(8 * 1024 ** 3, parse_size('8G'))
+        self.assertEqual(512 * 1024 ** 2, parse_size('512MB'))
+        self.assertEqual(1000, parse_size('1000'))
+
+
+class TestJobSchedulerAdmission(unittest.TestCase):
+    class OneAtATime(JobAdmission):
+        def __init__(self):
+            self.running = set()
+
+        def admit(self, title: str, force: bool = False) -> bool:
+            if self.running and not force:
+                return False
+            self.running.add(title)
+            return True
+
+        def release(self, title: str) -> None:
+            self.running.remove(title)
+
+    def test_admission_limits_running_jobs(self):
+        graph = VideoDependencyGraph([VideoConfig({'title': f'video{index}'}) for index in range(3)])
+        running = []
+        most_running = []
+
+        def job(video, dependency_results):
+            running.append(video)
+            most_running.append(len(running))
+            time.sleep(0.02)
+            running.remove(video)
+            return VideoBuildResult(video.get_title(), VideoBuildResult.BUILT)
+
+        results = JobScheduler(graph, 3, self.OneAtATime()).run(job)
+        self.assertEqual(1, max(most_running))
+        self.assertEqual(3, len(results))
@@ -1,17 +1,39 @@
+import io
+import json
 import os
 import shutil
+import sqlite3
+import stat
 import subprocess
 import tempfile
+import time
 import unittest
+from typing import List
+from unittest import mock
 
 import psutil
+import yaml
 
-from bash_writer.builders import VideoListVariableBuilder
-from bash_writer.writers import StaticBashCodeBuilder, BashScriptWriter, write_main_script
+from bash_writer import bash_code
+from bash_writer.builders import BashVariableBuilder, VideoListVariableBuilder
+from bash_writer.writers import StaticBashCodeBuilder, BashScriptWriter, write_main_script, get_video_script_builders, \
+    generate_bash
 from build_videos import are_cli_arguments_valid
+import builder
 from builder import load_yaml_config_from_file, build_videos, get_static_video_config_preprocessors
+from config import compiled
 from config.builder import build_video_configs_from_config
-from config.config import Config, VideoConfig
+from config.config import Config, VideoConfig, VideoConfigError
+from config.includes import ShardParseCache, get_shard_stat, shard_cache_file_name
+from config.variables import VariableResolver
+from executor.cache import ArtifactCache, replace_file
+from executor.commands import FFmpegCommandBuilder
+from executor import fingerprint
+from executor.fingerprint import InputFingerprinter, VideoFingerprinter
+from executor.graph import VideoDependencyGraph
+from executor.manifest import BuildManifest, manifest_file_name
+from executor.probes import ProbeCache
+from executor.resources import MemoryGate
 
 
 class TestYamlConfigLoader(unittest.TestCase):
@@ -38,6 +60,287 @@ class TestYamlConfigLoader(unittest.TestCase):
         open_files_after = psutil.Process().open_files()
         self.assertEqual(open_files_before, open_files_after)
 
+    def test_libyaml_loader_used_when_available(self):
+        self.assertEqual(getattr(yaml, 'CFullLoader', yaml.FullLoader), builder.yaml_loader)
+
+
+class TestCompiledConfigCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.temp_dir, 'config.yaml')
+        with open(os.path.join(self.temp_dir, 'image.png'), 'w') as file:
+            file.write('image')
+        self.raw_config = {
+            'shared_variables': {'fps': 24},
+            'videos': {
+                'intro': {'options': ['-loop 1', '-i image.png', '-t 5', '-r $fps']},
+                'outro': {'chunks': 2, 'options': ['-f lavfi', '-i anullsrc', '-t 4']},
+            },
+        }
+        self._write_config()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.temp_dir)
+
+    def _write_config(self) -> None:
+        with open(self.config_path, 'w') as file:
+            yaml.dump(self.raw_config, file)
+
+    def _load(self, targets=None):
+        with mock.patch('builder.parse_yaml_config', wraps=builder.parse_yaml_config) as parse:
+            config, videos = builder.load_video_configs(self.config_path, self.temp_dir, targets)
+        # wait for the sources probed in the background
+        for video in videos:
+            for source in video.get_inputs():
+                config.probe_media(source)
+        return parse.called, config, {video.get_title(): video for video in videos}
+
+    def test_unchanged_config_not_parsed_again(self):
+        _, _, first = self._load()
+        parsed, config, second = self._load()
+        self.assertFalse(parsed)
+        self.assertEqual({'fps': 24}, config.get_variables())
+        self.assertEqual(['intro', 'outro_chunk0', 'outro_chunk1', 'outro'], list(second))
+        self.assertEqual(first['intro'].get_options(), second['intro'].get_options())
+        self.assertEqual(first['intro'].get_variables(), second['intro'].get_variables())
+
+    def test_changed_config_parsed_again(self):
+        self._load()
+        self.raw_config['shared_variables']['fps'] = 30
+        self._write_config()
+        parsed, _, videos = self._load()
+        self.assertTrue(parsed)
+        self.assertEqual('30', videos['intro'].get_variables()['fps'])
+
+    def test_other_targets_compiled_again(self):
+        self._load()
+        parsed, _, videos = self._load(['intro'])
+        self.assertTrue(parsed)
+        self.assertEqual(['intro'], list(videos))
+
+    def test_inputs_fingerprinted_again(self):
+        _, _, before = self._load()
+        with open(os.path.join(self.temp_dir, 'image.png'), 'w') as file:
+            file.write('changed image')
+        parsed, _, after = self._load()
+        self.assertFalse(parsed)
+        self.assertNotEqual(before['intro'].get_variables()['input_md5'], after['intro'].get_variables()['input_md5'])
+
+    def test_matrix_files_found_again(self):
+        os.mkdir(os.path.join(self.temp_dir, 'trailers'))
+        self.raw_config['shared_variables']['trailers'] = 'trailers'
+        self.raw_config['videos']['trailer_{name}'] = {
+            'matrix': {'glob': '$trailers/*.mp4', 'variable': 'video'},
+            'options': ['-i $video', '-t 15'],
+        }
+        self._write_config()
+        for name in ['whiplash', 'midsommar']:
+            with open(os.path.join(self.temp_dir, 'trailers', f'{name}.mp4'), 'w') as file:
+                file.write(name)
+
+        _, _, videos = self._load()
+        self.assertEqual('trailers/midsommar.mp4', videos['trailer_midsommar'].get_variables()['video'])
+        self.assertEqual(['trailers/midsommar.mp4'], videos['trailer_midsommar'].get_inputs())
+        self.assertFalse(self._load()[0])
+
+        with open(os.path.join(self.temp_dir, 'trailers', 'nightcrawler.mp4'), 'w') as file:
+            file.write('nightcrawler')
+        parsed, _, videos = self._load()
+        self.assertTrue(parsed)
+        self.assertIn('trailer_nightcrawler', videos)
+
+    def test_cache_kept_as_json(self):
+        self._load()
+        with open(os.path.join(self.temp_dir, compiled.compiled_config_file_name)) as file:
+            cached = json.load(file)
+        self.assertIn('intro', [video['title'] for video in cached['compiled']['videos']])
+
+    def test_unreadable_cache_compiled_again(self):
+        with open(os.path.join(self.temp_dir, compiled.compiled_config_file_name), 'wb') as file:
+            file.write(b'\x80\x04not json')
+        parsed, _, videos = self._load()
+        self.assertTrue(parsed)
+        self.assertIn('intro', videos)
+
+    def test_version_change_compiles_again(self):
+        self._load()
+        with mock.patch('config.compiled.compiled_config_version', compiled.compiled_config_version + 1):
+            parsed, _, _ = self._load()
+        self.assertTrue(parsed)
+
+
+class TestConfigIncludes(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.temp_dir, 'config.yaml')
+        os.mkdir(os.path.join(self.temp_dir, 'shows'))
+        self._write('config.yaml', {
+            'shared_variables': {'fps': 24},
+            'include': ['shows/drama.yaml', 'shows/comedy.yaml'],
+            'videos': {'intro': {'options': ['-f lavfi', '-i anullsrc', '-t 5']}},
+        })
+        self._write('shows/drama.yaml', {'videos': {
+            'drama_episode': {'options': ['-f lavfi', '-i anullsrc', '-t 40', '-r $fps']},
+            'drama': {'combine': ['intro', 'drama_episode']},
+        }})
+        self._write('shows/comedy.yaml', {'videos': {
+            'comedy_{name}': {'matrix': [{'name': 'pilot'}, {'name': 'finale'}], 'options': ['-t 20']},
+        }})
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, name: str, contents: dict) -> None:
+        with open(os.path.join(self.temp_dir, name), 'w') as file:
+            yaml.dump(contents, file, sort_keys=False)
+
+    def _load(self, targets=None):
+        # returns the videos of the shards parsed and the titles of the videos built
+        with mock.patch('builder.parse_yaml_config', wraps=builder.parse_yaml_config) as parse:
+            _, videos = builder.load_video_configs(self.config_path, self.temp_dir, targets)
+        parsed = [yaml.load(call.args[0], Loader=yaml.FullLoader) for call in parse.call_args_list]
+        parsed_shards = [[*contents['videos']] for contents in parsed if 'include' not in contents]
+        return parsed_shards, [video.get_title() for video in videos]
+
+    def test_all_shards_loaded_without_targets(self):
+        _, titles = self._load()
+        self.assertEqual(['intro', 'drama_episode', 'drama', 'comedy_pilot', 'comedy_finale'], titles)
+
+    def test_only_shards_of_targets_loaded(self):
+        parsed, titles = self._load(['drama'])
+        self.assertEqual(['intro', 'drama_episode', 'drama'], titles)
+        self.assertEqual([['drama_episode', 'drama']], parsed)
+
+    def test_unchanged_shards_not_parsed_again(self):
+        self._load()
+        parsed, titles = self._load(['comedy_finale'])
+        self.assertEqual(['comedy_finale'], titles)
+        self.assertEqual([], parsed)
+
+    def test_changed_shard_parsed_again(self):
+        self._load()
+        self._write('shows/drama.yaml', {'videos': {
+            'drama_episode': {'options': ['-f lavfi', '-i anullsrc', '-t 45']},
+        }})
+        parsed, titles = self._load()
+        self.assertEqual([['drama_episode']], parsed)
+        self.assertEqual(['intro', 'drama_episode', 'comedy_pilot', 'comedy_finale'], titles)
+
+    def test_shard_videos_kept_as_json(self):
+        self._load()
+        cache = ShardParseCache(os.path.join(self.temp_dir, shard_cache_file_name))
+        path = os.path.join(self.temp_dir, 'shows', 'drama.yaml')
+        with sqlite3.connect(os.path.join(self.temp_dir, shard_cache_file_name)) as connection:
+            videos, = connection.execute('SELECT videos FROM shards WHERE path = ?', (path,)).fetchone()
+        connection.close()
+        self.assertEqual(['drama_episode', 'drama'], [*json.loads(videos)])
+        self.assertEqual(json.loads(videos), cache.get_videos(path, get_shard_stat(path)))
+
+    def test_shard_videos_which_arent_json_parsed_again(self):
+        self._load()
+        path = os.path.join(self.temp_dir, 'shows', 'drama.yaml')
+        with sqlite3.connect(os.path.join(self.temp_dir, shard_cache_file_name)) as connection:
+            connection.execute('UPDATE shards SET videos = ? WHERE path = ?', (b'\x80\x04not json', path))
+        connection.close()
+        parsed, titles = self._load(['drama'])
+        self.assertEqual([['drama_episode', 'drama']], parsed)
+        self.assertEqual(['intro', 'drama_episode', 'drama'], titles)
+
+    def test_video_defined_twice_rejected(self):
+        self._write('shows/comedy.yaml', {'videos': {'drama_episode': {'options': ['-t 20']}}})
+        with self.assertRaises(VideoConfigError):
+            self._load()
+
+    def test_shard_defining_more_than_videos_rejected(self):
+        self._write('shows/comedy.yaml', {'shared_variables': {'fps': 30}})
+        with self.assertRaises(VideoConfigError):
+            self._load()
+
+    def test_missing_shard_rejected(self):
+        os.unlink(os.path.join(self.temp_dir, 'shows', 'comedy.yaml'))
+        with self.assertRaises(VideoConfigError):
+            self._load()
+
+
+class TestIncrementalScripts(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.temp_dir, 'config.yaml')
+        self.raw_config = {
+            'videos': {
+                'intro': {'options': ['-f lavfi', '-i anullsrc', '-t 5']},
+                'outro': {'options': ['-f lavfi', '-i anullsrc', '-t 3']},
+                'result': {'combine': ['intro', 'outro']},
+            },
+        }
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.temp_dir)
+
+    def _write_scripts(self, targets=None, preview=False) -> str:
+        with open(self.config_path, 'w') as file:
+            yaml.dump(self.raw_config, file)
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            builder.write_scripts(*builder.load_video_configs(self.config_path, self.temp_dir, targets, preview))
+        return stderr.getvalue()
+
+    def _get_modification_time(self, script_name: str) -> int:
+        return os.stat(os.path.join(self.temp_dir, script_name)).st_mtime_ns
+
+    def test_unchanged_scripts_not_written(self):
+        self.assertIn('Updated 4 of 4 scripts', self._write_scripts())
+        modified = self._get_modification_time('export_intro.bash')
+        self.assertEqual('Updated 0 of 4 scripts\n', self._write_scripts())
+        self.assertEqual(modified, self._get_modification_time('export_intro.bash'))
+
+    def test_only_changed_scripts_written(self):
+        self._write_scripts()
+        self.raw_config['videos']['outro']['options'][-1] = '-t 4'
+        report = self._write_scripts()
+        # the fingerprint of the combination changes along with its part
+        self.assertEqual('Updated 2 of 4 scripts: export_outro.bash, export_result.bash\n', report)
+
+    def test_orphaned_scripts_removed(self):
+        self._write_scripts()
+        del self.raw_config['videos']['result']
+        report = self._write_scripts()
+        self.assertIn('Removed 1 orphaned scripts: export_result.bash', report)
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, 'export_result.bash')))
+
+    def test_scripts_of_other_targets_kept(self):
+        self._write_scripts()
+        self.assertNotIn('Removed', self._write_scripts(['intro']))
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, 'export_result.bash')))
+
+    def test_preview_scripts_kept_apart(self):
+        self._write_scripts()
+        report = self._write_scripts(preview=True)
+        self.assertIn('Updated 4 of 4 scripts', report)
+        self.assertNotIn('Removed', report)
+        self.assertEqual('Updated 0 of 4 scripts\n', self._write_scripts())
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, 'generate.preview.bash')))
+        with open(os.path.join(self.temp_dir, 'export_result.preview.bash')) as file:
+            self.assertIn('intro.preview.mp4', file.read())
+
+    def test_split_stream_changed_alone(self):
+        self.raw_config['videos']['split'] = {
+            'split_streams': True,
+            'options': ['-f lavfi', '-i color=c=black', '-f lavfi', '-i anullsrc', '-t 5', '-af "volume=0.5"'],
+        }
+        self.assertIn('Updated 7 of 7 scripts', self._write_scripts())
+        self.raw_config['videos']['split']['options'][-1] = '-af "volume=0.8"'
+        report = self._write_scripts()
+        # the muxed video changes along with its audio, the video stream is kept
+        self.assertEqual('Updated 2 of 7 scripts: export_split_audio.bash, export_split.bash\n', report)
+        with open(os.path.join(self.temp_dir, 'export_split.bash')) as file:
+            self.assertIn('-map 1:a', file.read())
+
+    def test_orphaned_preview_scripts_removed(self):
+        self._write_scripts(preview=True)
+        del self.raw_config['videos']['result']
+        report = self._write_scripts(preview=True)
+        self.assertIn('Removed 1 orphaned scripts: export_result.preview.bash', report)
+
 
 class TestBashScript(unittest.TestCase):
     def setUp(self) -> None:
@@ -331,6 +634,67 @@ class TestCombineWithBlankVideos(unittest.TestCase):
         self.assertEqual(str(self.video1['duration'] + self.video2['duration']), str(actual))
 
 
+class TestChunkedVideoLength(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.temp_dir, 'config.yaml')
+        with open(self.config_path, 'w') as file:
+            yaml.dump({
+                'shared_options': ['-y', '-v warning'],
+                'videos': {
+                    'long': {
+                        'chunks': 2,
+                        'options': ['-f lavfi', '-i color=size=320x240:rate=24:color=black', '-f lavfi',
+                                    '-i anullsrc=channel_layout=stereo:sample_rate=44100', '-t 10', '-c:v h264',
+                                    '-c:a aac', '-r 24'],
+                    },
+                },
+            }, file)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.temp_dir)
+
+    def _probe_duration(self, name: str) -> float:
+        output = subprocess.check_output(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of',
+                                          'default=noprint_wrappers=1:nokey=1', os.path.join(self.temp_dir, name)])
+        return float(output.decode('UTF-8'))
+
+    def test_chunks_add_up_to_video_length(self):
+        self.assertEqual(0, build_videos(self.config_path, self.temp_dir))
+        self.assertAlmostEqual(5, self._probe_duration('long_chunk1.mp4'), delta=0.2)
+        self.assertAlmostEqual(10, self._probe_duration('long.mp4'), delta=0.2)
+
+
+class TestRenderRateFrames(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.temp_dir, 'config.yaml')
+        # the brightness changes once a second, just after every full second
+        options = ['-y', '-v warning', '-f lavfi', '-i color=size=16x16:rate=24:color=black', '-t 3',
+                   '-vf "geq=lum=20*trunc(10-T)"', '-r 24', '-c:v h264', '-pix_fmt yuv420p']
+        with open(self.config_path, 'w') as file:
+            yaml.dump({'videos': {'full': {'options': options}, 'rendered': {'render_fps': 1, 'options': options}}},
+                      file)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.temp_dir)
+
+    def _get_brightness(self, name: str) -> List[int]:
+        frames = subprocess.check_output(['ffmpeg', '-v', 'error', '-i', os.path.join(self.temp_dir, name), '-f',
+                                          'rawvideo', '-pix_fmt', 'gray', '-'])
+        return [frames[index] for index in range(0, len(frames), 16 * 16)]
+
+    def test_rendered_frames_match_full_rate_render(self):
+        self.assertEqual(0, build_videos(self.config_path, self.temp_dir))
+        full = self._get_brightness('full.mp4')
+        rendered = self._get_brightness('rendered.mp4')
+        self.assertEqual(72, len(full))
+        self.assertEqual(len(full), len(rendered))
+        # only the first frame of every second, which shows its very start, may differ
+        mismatches = [index for index, (a, b) in enumerate(zip(full, rendered)) if abs(a - b) > 4]
+        self.assertTrue(all(index % 24 == 0 for index in mismatches), mismatches)
+
+
 class TestValidateArguments(unittest.TestCase):
     def setUp(self) -> None:
         self.temp_dir = '/tmp/python_test'
@@ -348,6 +712,11 @@ class TestValidateArguments(unittest.TestCase):
         with tempfile.NamedTemporaryFile() as f:
             self.assertFalse(are_cli_arguments_valid(["something!!!", f.name, self.temp_dir + "_dont_exist"]))
 
+    def test_validate_arguments_true_with_options_first(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self.assertTrue(are_cli_arguments_valid(["something!!!", "--preview", f.name, self.temp_dir]))
+            self.assertTrue(are_cli_arguments_valid(["something!!!", "-j", "8", f.name, self.temp_dir]))
+
 
 class TestVideoVariableListBuilderWithCombine(unittest.TestCase):
     def setUp(self) -> None:
@@ -406,3 +775,511 @@ class TestVideoVariableListBuilder(TestVideoVariableListBuilderWithCombine):
                 'file': 'dankmemes.jpg'
             }
         }
+
+
+class TestPythonCommandMatchesBashScript(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.mkdtemp()
+        self.bin_dir = os.path.join(self.temp_dir, 'bin')
+        os.mkdir(self.bin_dir)
+        self.arguments_file = os.path.join(self.temp_dir, 'arguments')
+
+        # stand-ins which record the ffmpeg arguments instead of encoding
+        self._write_executable('ffmpeg', f'printf "%s\\0" "$@" > {self.arguments_file}; touch "${{@: -1}}"')
+        self.probes_file = os.path.join(self.temp_dir, 'probes')
+        self._write_executable('ffprobe', f'echo "$@" >> {self.probes_file}; echo 5')
+
+        self.raw_config = {
+            'shared_options': ['-y', '-v warning'],
+            'shared_variables': {
+                'assets': '/mnt/assets',
+                'fps': 24,
+                'darkness_img': '$assets/blackness.png',
+            },
+            'option_templates': {
+                'countdown': """-vf "fps=$fps,drawtext=fontfile='$assets/font.ttf'
+     :text='%{eif\\:(($countdown_start-t)/60)\\:d\\:2}'\""""
+            },
+            'videos': {
+                'countdown_first': {
+                    'variables': {
+                        'duration': 31,
+                        'countdown_start': 30,
+                        'audio_fade_start': '$(expr $duration - 30)',
+                    },
+                    'options': [
+                        '-loop 1',
+                        '-i "$darkness_img"',
+                        '-t $duration',
+                        '-af "volume=0.07,afade=t=out:st=$audio_fade_start:d=25"',
+                        'countdown',
+                    ]
+                }
+            }
+        }
+        config = Config(self.raw_config, self.temp_dir, 'generate.bash')
+        videos = build_video_configs_from_config(config, get_static_video_config_preprocessors(config))
+        [self.video] = VideoFingerprinter(VideoDependencyGraph(videos)).fingerprint().get_videos()
+        with BashScriptWriter(self.video.get_script_path()) as writer:
+            writer.write(get_video_script_builders(self.video))
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.temp_dir)
+
+    def _write_executable(self, name: str, code: str) -> None:
+        path = os.path.join(self.bin_dir, name)
+        with open(path, 'w') as file:
+            file.write(f'#!/bin/bash\n{code}\n')
+        os.chmod(path, 0o755)
+
+    def test_python_command_matches_bash_command(self):
+        environment = {**os.environ, 'PATH': f'{self.bin_dir}:{os.environ["PATH"]}'}
+        subprocess.run(['bash', self.video.get_script_name()], cwd=self.temp_dir, env=environment, check=True)
+        with open(self.arguments_file) as file:
+            bash_arguments = file.read().split('\0')[:-1]
+
+        resolver = VariableResolver(self.video.get_variables())
+        python_command = FFmpegCommandBuilder(self.video, resolver).build()
+
+        self.assertEqual(bash_arguments, python_command[1:])
+
+    def _build_with_python(self) -> int:
+        config_path = os.path.join(self.temp_dir, 'config.yaml')
+        with open(config_path, 'w') as file:
+            yaml.dump(self.raw_config, file)
+
+        with mock.patch.dict(os.environ, {'PATH': f'{self.bin_dir}:{os.environ["PATH"]}'}):
+            return build_videos(config_path, self.temp_dir, executor='python')
+
+    def test_python_executor_builds_video(self):
+        self.assertEqual(0, self._build_with_python())
+        self.assertTrue(os.path.isfile(os.path.join(self.temp_dir, 'countdown_first.mp4')))
+
+    def test_python_executor_skips_up_to_date_video(self):
+        self._build_with_python()
+        os.unlink(self.arguments_file)
+        self._build_with_python()
+        self.assertFalse(os.path.exists(self.arguments_file))
+
+    def test_python_executor_restores_video_from_cache(self):
+        cache = ArtifactCache(os.path.join(self.temp_dir, 'cache'), 1024 ** 3)
+        config_path = os.path.join(self.temp_dir, 'config.yaml')
+        with open(config_path, 'w') as file:
+            yaml.dump(self.raw_config, file)
+
+        other_export = os.path.join(self.temp_dir, 'other')
+        os.mkdir(other_export)
+        with mock.patch.dict(os.environ, {'PATH': f'{self.bin_dir}:{os.environ["PATH"]}'}):
+            build_videos(config_path, self.temp_dir, executor='python', cache=cache)
+            os.unlink(self.arguments_file)
+            self.assertEqual(0, build_videos(config_path, other_export, executor='python', cache=cache))
+
+        self.assertFalse(os.path.exists(self.arguments_file))
+        self.assertTrue(os.path.isfile(os.path.join(other_export, 'countdown_first.mp4')))
+
+    def test_bash_script_records_video_in_manifest(self):
+        environment = {**os.environ, 'PATH': f'{self.bin_dir}:{os.environ["PATH"]}'}
+        subprocess.run(['bash', self.video.get_script_name()], cwd=self.temp_dir, env=environment, check=True)
+
+        entry = BuildManifest(os.path.join(self.temp_dir, manifest_file_name)).get('countdown_first.mp4')
+        self.assertEqual(self.video.get_fingerprint(), entry.get_fingerprint())
+        self.assertEqual(31, entry.get_duration())
+
+    def test_looped_image_duration_not_probed(self):
+        environment = {**os.environ, 'PATH': f'{self.bin_dir}:{os.environ["PATH"]}'}
+        subprocess.run(['bash', self.video.get_script_name()], cwd=self.temp_dir, env=environment, check=True)
+        self._build_with_python()
+        self.assertFalse(os.path.exists(self.probes_file))
+
+    def test_up_to_date_video_not_probed(self):
+        environment = {**os.environ, 'PATH': f'{self.bin_dir}:{os.environ["PATH"]}'}
+        self.video = self.video.with_variables({'static_duration': ''})
+        with BashScriptWriter(self.video.get_script_path()) as writer:
+            writer.write(get_video_script_builders(self.video))
+        subprocess.run(['bash', self.video.get_script_name()], cwd=self.temp_dir, env=environment, check=True)
+        os.unlink(self.probes_file)
+
+        process = subprocess.run(['bash', self.video.get_script_name()], cwd=self.temp_dir, env=environment,
+                                 check=True, stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual('5', process.stdout.strip())
+        self.assertFalse(os.path.exists(self.probes_file))
+
+    def test_bash_executor_not_probing_sources(self):
+        image_path = os.path.join(self.temp_dir, 'blackness.png')
+        open(image_path, 'w').close()
+        self.raw_config['shared_variables']['darkness_img'] = image_path
+        config_path = os.path.join(self.temp_dir, 'config.yaml')
+        with open(config_path, 'w') as file:
+            yaml.dump(self.raw_config, file)
+
+        with mock.patch.dict(os.environ, {'PATH': f'{self.bin_dir}:{os.environ["PATH"]}'}):
+            self.assertEqual(0, build_videos(config_path, self.temp_dir, executor='bash'))
+        self.assertFalse(os.path.exists(self.probes_file))
+
+    def test_bash_script_skips_video_recorded_in_manifest(self):
+        environment = {**os.environ, 'PATH': f'{self.bin_dir}:{os.environ["PATH"]}'}
+        subprocess.run(['bash', self.video.get_script_name()], cwd=self.temp_dir, env=environment, check=True)
+        os.unlink(self.arguments_file)
+        subprocess.run(['bash', self.video.get_script_name()], cwd=self.temp_dir, env=environment, check=True)
+        self.assertFalse(os.path.exists(self.arguments_file))
+
+
+class TestBashManifestSnippets(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.mkdtemp()
+        self.manifest_path = os.path.join(self.temp_dir, manifest_file_name)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.temp_dir)
+
+    def _run(self, code: str, path: str = os.environ['PATH']) -> subprocess.CompletedProcess:
+        variables = {'output_file': '"it\'s.mp4"', 'fingerprint': '"finger\'print"', 'manifest': self.manifest_path,
+                     'static_duration': '5'}
+        script = generate_bash([StaticBashCodeBuilder(bash_code.script_beginning), BashVariableBuilder(variables),
+                                StaticBashCodeBuilder(code)])
+        return subprocess.run([shutil.which('bash'), '-c', script], cwd=self.temp_dir, env={**os.environ, 'PATH': path},
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    def test_quotes_in_names_recorded(self):
+        open(os.path.join(self.temp_dir, "it's.mp4"), 'w').close()
+        self.assertEqual(0, self._run(bash_code.metadata_writer).returncode)
+        self.assertEqual("finger'print", BuildManifest(self.manifest_path).get("it's.mp4").get_fingerprint())
+
+        process = self._run(bash_code.skip_regenerate_existing_video)
+        self.assertEqual(0, process.returncode)
+        self.assertIn('already up to date', process.stderr)
+
+    def test_missing_sqlite3_fails_before_encoding(self):
+        process = self._run(bash_code.skip_regenerate_existing_video, path=self.temp_dir)
+        self.assertEqual(1, process.returncode)
+        self.assertIn('sqlite3', process.stderr)
+        self.assertNotIn('Generating', process.stderr)
+
+
+class TestStreamCopyConcat(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.mkdtemp()
+        self.bin_dir = os.path.join(self.temp_dir, 'bin')
+        os.mkdir(self.bin_dir)
+        self.arguments_file = os.path.join(self.temp_dir, 'arguments')
+
+        self._write_executable('ffmpeg', f'printf "%s\\0" "$@" > {self.arguments_file}; touch "${{@: -1}}"')
+        # every part reports the same streams
+        self._write_executable('ffprobe', 'case "$*" in\n'
+                                          '  *format=duration*) echo 5;;\n'
+                                          '  *json*) echo \'{"streams": [{"codec_type": "video", "codec_name": "h264"}]}\';;\n'
+                                          '  *) echo "stream|video|h264";;\n'
+                                          'esac')
+
+        self.raw_config = {
+            'shared_options': ['-v warning'],
+            'videos': {
+                'intro': {'options': ['-f lavfi', '-i anullsrc', '-t 5']},
+                'outro': {'options': ['-f lavfi', '-i anullsrc', '-t 3']},
+                'result': {'combine': ['intro', 'outro', 'intro']},
+            }
+        }
+        self.config_path = os.path.join(self.temp_dir, 'config.yaml')
+        self._write_config()
+
+    def _write_config(self) -> None:
+        with open(self.config_path, 'w') as file:
+            yaml.dump(self.raw_config, file)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.temp_dir)
+
+    def _write_executable(self, name: str, code: str) -> None:
+        path = os.path.join(self.bin_dir, name)
+        with open(path, 'w') as file:
+            file.write(f'#!/bin/bash\n{code}\n')
+        os.chmod(path, 0o755)
+
+    def _get_arguments(self):
+        with open(self.arguments_file) as file:
+            return file.read().split('\0')[:-1]
+
+    def test_matching_parts_stream_copied(self):
+        with mock.patch.dict(os.environ, {'PATH': f'{self.bin_dir}:{os.environ["PATH"]}'}):
+            self.assertEqual(0, build_videos(self.config_path, self.temp_dir, executor='python'))
+        python_arguments = self._get_arguments()
+
+        with open(os.path.join(self.temp_dir, '.result.concat')) as file:
+            self.assertEqual("file 'intro.mp4'\nfile 'outro.mp4'\nfile 'intro.mp4'\n", file.read())
+        self.assertIn('concat', python_arguments)
+        self.assertNotIn('-filter_complex', python_arguments)
+
+        self.assertEqual(self._get_bash_arguments(), self._without_thread_options(python_arguments))
+
+    def test_filtered_combination_opens_repeated_part_once(self):
+        self.raw_config['videos']['result']['options'] = ['-af "volume=2"']
+        self._write_config()
+        with mock.patch.dict(os.environ, {'PATH': f'{self.bin_dir}:{os.environ["PATH"]}'}):
+            self.assertEqual(0, build_videos(self.config_path, self.temp_dir, executor='python'))
+        python_arguments = self._get_arguments()
+
+        self.assertEqual(2, python_arguments.count('-i'))
+        self.assertEqual(self._get_bash_arguments(), self._without_thread_options(python_arguments))
+
+    def test_chunked_video_stream_copied(self):
+        self.raw_config['videos']['long'] = {'chunks': 2, 'options': ['-f lavfi', '-i anullsrc', '-t 9']}
+        self._write_config()
+        with mock.patch.dict(os.environ, {'PATH': f'{self.bin_dir}:{os.environ["PATH"]}'}):
+            self.assertEqual(0, build_videos(self.config_path, self.temp_dir, executor='python', targets=['long']))
+        self.assertTrue(os.path.isfile(os.path.join(self.temp_dir, 'long_chunk1.mp4')))
+
+        with open(os.path.join(self.temp_dir, '.long.concat')) as file:
+            self.assertEqual("file 'long_chunk0.mp4'\nfile 'long_chunk1.mp4'\n", file.read())
+        self.assertIn('copy', self._get_arguments())
+
+    def test_still_image_segment_repeated(self):
+        with open(os.path.join(self.temp_dir, 'thanks.png'), 'w') as file:
+            file.write('image')
+        self.raw_config['videos']['thanks'] = {'options': ['-loop 1', '-i thanks.png', '-f lavfi', '-i anullsrc',
+                                                           '-t 8', '-r 24']}
+        self._write_config()
+        with mock.patch.dict(os.environ, {'PATH': f'{self.bin_dir}:{os.environ["PATH"]}'}):
+            self.assertEqual(0, build_videos(self.config_path, self.temp_dir, executor='python', targets=['thanks']))
+
+        arguments = self._get_arguments()
+        self.assertEqual(['-i', '.thanks.still'], arguments[arguments.index('concat') + 3:][:2])
+        self.assertIn('copy', arguments)
+        self.assertTrue(os.path.isfile(os.path.join(self.temp_dir, 'thanks.mp4')))
+        # the segments are only needed while building
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, '.thanks.still.mp4')))
+
+    def _get_bash_arguments(self):
+        environment = {**os.environ, 'PATH': f'{self.bin_dir}:{os.environ["PATH"]}'}
+        os.unlink(os.path.join(self.temp_dir, 'result.mp4'))
+        subprocess.run(['bash', 'export_result.bash'], cwd=self.temp_dir, env=environment, check=True,
+                       stdout=subprocess.DEVNULL)
+        return self._get_arguments()
+
+    @staticmethod
+    def _without_thread_options(arguments):
+        # thread options are only added by the python executor
+        thread_options = [index for index, argument in enumerate(arguments)
+                          if argument in ('-filter_threads', '-filter_complex_threads', '-threads')]
+        return [argument for index, argument in enumerate(arguments)
+                if index not in thread_options and index - 1 not in thread_options]
+
+
+class TestMemoryGateRecordsPeakMemory(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.mkdtemp()
+        self.history_path = os.path.join(self.temp_dir, 'memory.json')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.temp_dir)
+
+    def test_peak_memory_stored_between_builds(self):
+        allocated = 100 * 1024 ** 2
+        gate = MemoryGate(self.history_path, 1024 ** 4)
+        gate.poll_interval = 0.05
+        code = f'import time; memory = bytearray({allocated}); time.sleep(0.5)'
+        process = gate.run('hungry', ['python3', '-c', code])
+
+        self.assertEqual(0, process.returncode)
+        self.assertGreater(MemoryGate(self.history_path, 1024 ** 4).get_estimate('hungry'), allocated)
+
+
+class TestArtifactCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = ArtifactCache(os.path.join(self.temp_dir, 'cache'), 10)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.temp_dir)
+
+    def _store(self, fingerprint: str, contents: str) -> None:
+        path = os.path.join(self.temp_dir, fingerprint + '.mp4')
+        with open(path, 'w') as file:
+            file.write(contents)
+        self.cache.store(fingerprint, path, 5)
+
+    def test_restored_video_matches_stored_one(self):
+        self._store('intro', 'video')
+        destination = os.path.join(self.temp_dir, 'restored.mp4')
+        artifact = self.cache.restore('intro', destination)
+
+        self.assertEqual(5, artifact.get_duration())
+        with open(destination) as file:
+            self.assertEqual('video', file.read())
+
+    def test_unknown_fingerprint_not_restored(self):
+        self.assertIsNone(self.cache.restore('missing', os.path.join(self.temp_dir, 'restored.mp4')))
+
+    def test_least_recently_used_video_evicted(self):
+        self._store('first', 'four')
+        self._store('second', 'four')
+        self.cache.get('first')
+        self._store('third', 'four')
+
+        self.assertIsNotNone(self.cache.get('first'))
+        self.assertIsNone(self.cache.get('second'))
+        self.assertLessEqual(self.cache.get_size(), 10)
+
+    def test_only_evicted_videos_make_room(self):
+        self._store('oldest', 'four')
+        self._store('middle', 'sixsix')
+        self._store('newest', 'fivef')
+
+        self.assertIsNone(self.cache.get('middle'))
+        self.assertIsNotNone(self.cache.get('oldest'))
+        self.assertEqual(9, self.cache.get_size())
+
+    def test_stored_video_stays_writable(self):
+        self._store('intro', 'video')
+        self.assertTrue(os.stat(os.path.join(self.temp_dir, 'intro.mp4')).st_mode & stat.S_IWUSR)
+
+    def test_rebuilding_restored_video_keeps_cache_intact(self):
+        self._store('intro', 'video')
+        destination = os.path.join(self.temp_dir, 'restored.mp4')
+        self.cache.restore('intro', destination)
+        self._store('other', 'new')
+        replace_file(os.path.join(self.temp_dir, 'other.mp4'), destination)
+
+        with open(self.cache.get('intro').get_path()) as file:
+            self.assertEqual('video', file.read())
+
+
+class TestBuildManifest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.mkdtemp()
+        self.video_path = os.path.join(self.temp_dir, 'video.mp4')
+        with open(self.video_path, 'w') as file:
+            file.write('video')
+        self.manifest = BuildManifest(os.path.join(self.temp_dir, manifest_file_name))
+        self.manifest.record('video.mp4', self.video_path, 'fingerprint', 5)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.temp_dir)
+
+    def test_recorded_video_up_to_date(self):
+        entry = self.manifest.get_up_to_date_entry('video.mp4', self.video_path, 'fingerprint')
+        self.assertEqual(5, entry.get_duration())
+
+    def test_video_with_other_fingerprint_outdated(self):
+        self.assertIsNone(self.manifest.get_up_to_date_entry('video.mp4', self.video_path, 'other'))
+
+    def test_changed_video_outdated(self):
+        with open(self.video_path, 'a') as file:
+            file.write('changed')
+        self.assertIsNone(self.manifest.get_up_to_date_entry('video.mp4', self.video_path, 'fingerprint'))
+
+    def test_missing_video_outdated(self):
+        os.unlink(self.video_path)
+        self.assertIsNone(self.manifest.get_up_to_date_entry('video.mp4', self.video_path, 'fingerprint'))
+
+    def test_entries_persisted(self):
+        manifest = BuildManifest(os.path.join(self.temp_dir, manifest_file_name))
+        self.assertEqual('fingerprint', manifest.get('video.mp4').get_fingerprint())
+
+
+class TestInputFingerprinter(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.mkdtemp()
+        self.asset_path = os.path.join(self.temp_dir, 'thanks.png')
+        with open(self.asset_path, 'w') as file:
+            file.write('image')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.temp_dir)
+
+    def _get_fingerprint(self) -> str:
+        return InputFingerprinter(self.temp_dir).get_fingerprint(['thanks.png', 'anullsrc'])
+
+    def test_unchanged_input_not_hashed_again(self):
+        first = self._get_fingerprint()
+        with mock.patch.object(fingerprint, 'get_file_digest') as get_file_digest:
+            second = self._get_fingerprint()
+        get_file_digest.assert_not_called()
+        self.assertEqual(first, second)
+
+    def test_changed_input_changes_fingerprint(self):
+        first = self._get_fingerprint()
+        with open(self.asset_path, 'w') as file:
+            file.write('other image')
+        self.assertNotEqual(first, self._get_fingerprint())
+
+    def test_touched_input_hashed_again_with_same_fingerprint(self):
+        first = self._get_fingerprint()
+        os.utime(self.asset_path, ns=(0, 0))
+        with mock.patch.object(fingerprint, 'get_file_digest', wraps=fingerprint.get_file_digest) as get_file_digest:
+            second = self._get_fingerprint()
+        get_file_digest.assert_called_once()
+        self.assertEqual(first, second)
+
+    def test_manifest_not_created_without_file_inputs(self):
+        InputFingerprinter(self.temp_dir).get_fingerprint(['anullsrc'])
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, manifest_file_name)))
+
+
+class TestProbeCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.mkdtemp()
+        self.bin_dir = os.path.join(self.temp_dir, 'bin')
+        os.mkdir(self.bin_dir)
+        self.probes_file = os.path.join(self.temp_dir, 'probes')
+        ffprobe = os.path.join(self.bin_dir, 'ffprobe')
+        with open(ffprobe, 'w') as file:
+            file.write(f'#!/bin/bash\necho "${{@: -1}}" >> {self.probes_file}\n'
+                       'echo \'{"streams": [{"codec_type": "video", "codec_name": "h264"}], '
+                       '"format": {"duration": "15.0"}}\'\n')
+        os.chmod(ffprobe, 0o755)
+
+        for name in ['whiplash.mp4', 'nightcrawler.mp4']:
+            with open(os.path.join(self.temp_dir, name), 'w') as file:
+                file.write(name)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.temp_dir)
+
+    def _probe(self, path: str):
+        with mock.patch.dict(os.environ, {'PATH': f'{self.bin_dir}:{os.environ["PATH"]}'}):
+            cache = ProbeCache(self.temp_dir, InputFingerprinter(self.temp_dir))
+            cache.prefetch(['whiplash.mp4', 'nightcrawler.mp4'])
+            media = cache.probe(path)
+            # wait for the background probes too
+            for source in ['whiplash.mp4', 'nightcrawler.mp4']:
+                cache.probe(source)
+            return media
+
+    def _get_probed_files(self):
+        with open(self.probes_file) as file:
+            return file.read().splitlines()
+
+    def test_closed_cache_stops_probing(self):
+        with open(os.path.join(self.bin_dir, 'ffprobe'), 'a') as file:
+            file.write('sleep 0.1\n')
+        with mock.patch.dict(os.environ, {'PATH': f'{self.bin_dir}:{os.environ["PATH"]}'}):
+            cache = ProbeCache(self.temp_dir, InputFingerprinter(self.temp_dir), workers=1)
+            cache.prefetch(['whiplash.mp4', 'nightcrawler.mp4'])
+            cache.close()
+            time.sleep(0.5)
+        # the second probe was still waiting for the first one
+        probed = self._get_probed_files() if os.path.exists(self.probes_file) else []
+        self.assertNotIn(os.path.join(self.temp_dir, 'nightcrawler.mp4'), probed)
+
+    def test_inputs_probed_in_background(self):
+        media = self._probe('whiplash.mp4')
+        self.assertEqual('h264', media.get_codec('video'))
+        self.assertEqual(15.0, media.get_duration())
+        self.assertEqual(2, len(self._get_probed_files()))
+
+    def test_probes_cached_between_builds(self):
+        self._probe('whiplash.mp4')
+        os.unlink(self.probes_file)
+        self.assertEqual(15.0, self._probe('whiplash.mp4').get_duration())
+        self.assertFalse(os.path.exists(self.probes_file))
+
+    def test_changed_input_probed_again(self):
+        self._probe('whiplash.mp4')
+        os.unlink(self.probes_file)
+        with open(os.path.join(self.temp_dir, 'whiplash.mp4'), 'w') as file:
+            file.write('other trailer')
+        self._probe('whiplash.mp4')
+        self.assertEqual([os.path.realpath(os.path.join(self.temp_dir, 'whiplash.mp4'))], self._get_probed_files())
+
+    def test_generated_source_not_probed(self):
+        self.assertIsNone(self._probe('anullsrc'))
@@ -1,19 +1,15 @@
+from manifest_schema import manifest_schema
+
 concat_function_1 = """\
-# combine all files from arguments with ffmpeg using filter_complex and map
+# combine all files from arguments with ffmpeg using filter_complex and map,
+# every file is passed once however often it is used in $concat_filter
 function concat_videos() {
-  videos=("$@")
-
-  lim=`expr ${#videos[@]} - 1`
-  filter_complex=""
-
-  for i in `seq 0 $lim`; do
-      filter_complex="$filter_complex[$i:v][$i:a]"
-  done
+  inputs=("$@")
 
   ffmpeg \\
     -y \\
-    ${videos[@]/#/-i } \\
-    -filter_complex "${filter_complex}concat=n=${#videos[@]}:v=1:a=1[a][v]" \\
+    ${inputs[@]/#/-i } \\
+    -filter_complex "$concat_filter" \\
     -map "[v]" \\
     -map "[a]" \\\
 """
@@ -22,31 +18,108 @@ concat_function_2 = """\
 }
 """
 
+stream_match_functions = """\
+# the parts can be joined without re-encoding them when all of their streams
+# match in codec, resolution, frame rate, sample rate and time base
+function stream_signature() {
+  ffprobe -v error -of compact=nokey=1 \\
+    -show_entries stream=codec_type,codec_name,profile,width,height,pix_fmt,r_frame_rate,time_base,sample_rate,channel_layout \\
+    "$1"
+}
+
+function can_stream_copy() {
+  first_signature=$(stream_signature "$1") || return 1
+  [ -n "$first_signature" ] || return 1
+  for video in "$@"; do
+    [ "$(stream_signature "$video")" = "$first_signature" ] || return 1
+  done
+}
+"""
+
+stream_copy_function_1 = """\
+# join all files from arguments with the concat demuxer, copying their streams
+function concat_videos_copy() {
+  concat_list=.$video_title.concat
+  printf "file '%s'\\n" "$@" > $concat_list
+
+  ffmpeg \\
+    -y \\
+    -f concat \\
+    -safe 0 \\
+    -i $concat_list \\
+    -map 0 \\\
+"""
+stream_copy_function_2 = """\
+    -c:v copy \\
+    -c:a copy \\
+    $output_file
+}
+"""
+
+concat_call = """\
+concat_videos ${concat_inputs[@]}\
+"""
+
+stream_copy_call = """\
+concat_videos_copy ${videos[@]}\
+"""
+
+stream_copy_concat_call = """\
+if can_stream_copy ${videos[@]}; then
+    concat_videos_copy ${videos[@]}
+else
+    concat_videos ${concat_inputs[@]}
+fi\
+"""
+
 video_script_output = """\
 ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 $output_file | cut -d. -f1\
 """
 
+# durations known from the config or recorded in the build manifest spare
+# probing the video
+video_length_lookup = f"""\
+video_length=${{video_length:-${{static_duration:-$({video_script_output})}}}}\
+"""
+
+sqlite_check = """\
+if ! command -v sqlite3 > /dev/null; then
+    >&2 echo "The sqlite3 command line tool is needed to keep track of built videos, please install it."
+    exit 1
+fi\
+"""
+
+# quotes in file names would end the sql strings early
+manifest_values = """\
+sql_output_file=${output_file//\\'/\\'\\'}
+sql_fingerprint=${fingerprint//\\'/\\'\\'}\
+"""
+
 skip_regenerate_existing_video = f"""\
-# if the md5 stored in the video file matches this scripts md5, there is no
-# need to regenerate the video as it is up to date.
-if [ -f "$output_file" ] && [ "$script_md5" = "$video_md5" ]; then
+{sqlite_check}
+{manifest_values}
+# if the build manifest entry of the video matches this videos fingerprint and
+# the video file hasn't changed since, there is no need to regenerate the video
+# as it is up to date.
+video_md5=""
+video_length=""
+if [ -f "$output_file" ]; then
+    video_stat=$(stat -c "%s %Y" "$output_file")
+    video_entry=$(sqlite3 -cmd ".timeout 30000" "$manifest" "SELECT fingerprint, duration FROM outputs \\
+        WHERE output = '$sql_output_file' AND size || ' ' || mtime = '$video_stat'" 2>/dev/null || true)
+    video_md5=${{video_entry%%|*}}
+    video_length=${{video_entry#*|}}
+fi
+if [ -f "$output_file" ] && [ -n "$fingerprint" ] && [ "$fingerprint" = "$video_md5" ]; then
     >&2 echo "$output_file already up to date, skipping it!"
-    {video_script_output}
-    exit 1
+    {video_length_lookup}
+    echo $video_length
+    exit 0
 fi
+video_length=""
 >&2 echo "Generating $output_file..."
-"""
-
-concat_video_md5 = """\
-# for concatenated videos, generate the script hash from the combination of all
-# consumed video scripts
-for video in "${videos[@]}"
-do
-    dir=$(dirname $script_path)
-    name=export_$(echo $video | cut -d"." -f1 | xargs).bash
-    script_md5=${script_md5}$(md5sum $dir/$name | cut -d" " -f1)
-done
-script_md5=$(echo $script_md5 | md5sum | cut -d" " -f1)
+# the old video may be a hard link of a cached video, never write through it
+rm -f "$output_file"
 """
 
 script_beginning = """\
@@ -54,9 +127,16 @@ script_beginning = """\
 set -e -u
 """
 
-metadata_writer = """\
-# save generation script md5 in generated videos "artist" metadata field
-exiftool $output_file -artist="$script_md5" 1>/dev/null
-# remove the backup file created by exiftool
-rm ${output_file}_original
+metadata_writer = f"""\
+# save the fingerprint and duration of the video in the build manifest next to it
+{video_length_lookup}
+{manifest_values}
+video_stat=($(stat -c "%s %Y" "$output_file"))
+sqlite3 -cmd ".timeout 30000" "$manifest" "{manifest_schema}
+INSERT OR REPLACE INTO outputs (output, fingerprint, size, mtime, duration) \\
+VALUES ('$sql_output_file', '$sql_fingerprint', ${{video_stat[0]}}, ${{video_stat[1]}}, ${{video_length:-NULL}});"
+"""
+
+video_length_output = """\
+echo $video_length\
 """
@@ -1,7 +1,8 @@
-from typing import List, Dict, final
+import re
+from typing import Collection, List, Dict, final
 
 from bash_writer import bash_code
-from config.config import VideoConfig
+from config.config import VideoConfig, get_video_file_name
 
 
 class BashCodeBuilder:
@@ -74,17 +75,103 @@ class FFmpegGenerateBuilder(BashCodeBuilder):
         ])
 
 
+def get_unique_parts(parts: List[str]) -> List[str]:
+    return [*dict.fromkeys(parts)]
+
+
+# parts up to this many seconds long are decoded once and split into a copy
+# for every use. The filter graph holds on to the frames of a split part until
+# its last use, so longer parts, and parts of unknown length, are opened again.
+split_part_max_duration = 10
+
+
+def get_concat_inputs(parts: List[str], split_parts: Collection[str] = ()) -> List[str]:
+    return [part for index, part in enumerate(parts) if part not in split_parts or part not in parts[:index]]
+
+
+def get_concat_filter(parts: List[str], split_parts: Collection[str] = ()) -> str:
+    # every use of a part is an input of its own, except for split parts: their
+    # decoded streams are split into as many copies as the part is used
+    uses = {part: parts.count(part) for part in get_unique_parts(parts) if part in split_parts}
+    uses = {part: count for part, count in uses.items() if count > 1}
+
+    splits = []
+    streams = ''
+    inputs: Dict[str, int] = {}
+    used = {part: 0 for part in uses}
+    input_count = 0
+    for part in parts:
+        if part not in uses or part not in inputs:
+            inputs[part] = input_count
+            input_count += 1
+        index = inputs[part]
+        if part in uses:
+            if used[part] == 0:
+                video_labels = ''.join([f'[v{index}_{use}]' for use in range(uses[part])])
+                audio_labels = ''.join([f'[a{index}_{use}]' for use in range(uses[part])])
+                splits += [f'[{index}:v]split={uses[part]}{video_labels}',
+                           f'[{index}:a]asplit={uses[part]}{audio_labels}']
+            streams += f'[v{index}_{used[part]}][a{index}_{used[part]}]'
+            used[part] += 1
+        else:
+            streams += f'[{index}:v][{index}:a]'
+
+    return ';'.join([*splits, f'{streams}concat=n={len(parts)}:v=1:a=1[v][a]'])
+
+
+_filter_option = re.compile(r'(^|\s)-(vf|af|filter(:\S+)?|filter_complex|lavfi)(\s|$)')
+
+
+def has_filter_options(options: str) -> bool:
+    # filtered streams can't be stream copied
+    return _filter_option.search(options) is not None
+
+
 @final
 class FFmpegConcatBuilder(BashCodeBuilder):
-    def __init__(self, options: List[str]):
+    def __init__(self, options: List[str], parts: List[str], always_stream_copy: bool = False,
+                 split_parts: Collection[str] = ()):
         self._option_builder = FFmpegOptionBuilder(options)
+        self._parts = parts
+        self._always_stream_copy = always_stream_copy
+        self._split_parts = split_parts
+
+    def _build_filter_variables(self) -> str:
+        return BashVariableBuilder({
+            'concat_inputs': f'( {" ".join(get_concat_inputs(self._parts, self._split_parts))} )',
+            'concat_filter': f'"{get_concat_filter(self._parts, self._split_parts)}"',
+        }).build()
+
+    def _build_stream_copy(self) -> List[str]:
+        return [
+            bash_code.stream_copy_function_1,
+            f'{self._option_builder.build()} \\',
+            bash_code.stream_copy_function_2,
+        ]
+
+    def _build_always_stream_copy(self) -> str:
+        return '\n'.join([
+            *self._build_stream_copy(),
+            '',
+            bash_code.stream_copy_call,
+            '\n'
+        ])
 
     def build(self):
+        if self._always_stream_copy:
+            return self._build_always_stream_copy()
+
+        options = self._option_builder.build()
+        stream_copy = not has_filter_options(options)
         return '\n'.join([
+            self._build_filter_variables(),
             bash_code.concat_function_1,
-            f'{self._option_builder.build()} \\',
+            f'{options} \\',
             bash_code.concat_function_2,
-            '\nconcat_videos ${videos[@]}\n\n'
+            *([bash_code.stream_match_functions, *self._build_stream_copy()] if stream_copy else []),
+            '',
+            bash_code.stream_copy_concat_call if stream_copy else bash_code.concat_call,
+            '\n'
         ])
 
 
@@ -93,14 +180,13 @@ class VideoListVariableBuilder(BashCodeBuilder):
     def __init__(self, config: VideoConfig):
         self._config = config
 
-    def _get_video_parts(self):
+    def _get_video_files(self):
         if self._config.is_combination():
-            return self._config.get_combine()
-        return [self._config.get_title()]
+            return self._config.get_part_files()
+        return [get_video_file_name(self._config.get_title(), self._config.get_namespace())]
 
     def _get_variable_contents(self):
-        titles = [title + '.mp4' for title in self._get_video_parts()]
-        return ' '.join(titles)
+        return ' '.join(self._get_video_files())
 
     def build(self):
         return BashVariableBuilder({
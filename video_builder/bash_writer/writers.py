@@ -1,17 +1,45 @@
-from typing import List, final
+import glob
+import os
+import re
+from typing import Container, List, Optional, final
 
 from bash_writer import bash_code
 from bash_writer.builders import BashCodeBuilder
 from bash_writer.builders import StaticBashCodeBuilder, VideoScriptCallBuilder, BashVariableBuilder, \
     FFmpegGenerateBuilder, FFmpegConcatBuilder, VideoListVariableBuilder
-from config.config import VideoConfig, Config
+from config.config import VideoConfig, Config, get_video_script_name
+from config.variables import VariableResolver
 
 
+def generate_bash(builders: List[BashCodeBuilder]) -> str:
+    fragments = [builder.build() for builder in builders]
+    return '\n'.join(fragments)
+
+
+def write_if_changed(file_path: str, code: str) -> bool:
+    try:
+        with open(file_path, 'r') as file:
+            if file.read() == code:
+                return False
+    except (OSError, UnicodeDecodeError):
+        pass
+
+    # replaced at once, so a script is never seen half written
+    temporary_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w') as file:
+        file.write(code)
+    os.replace(temporary_path, file_path)
+    return True
+
+
+# collects the code of a script and writes it once closed, scripts whose code
+# didn't change are left as they are
 @final
 class BashScriptWriter:
     def __init__(self, file_path: str):
         self._file_path = file_path
-        self._file = None
+        self._code: Optional[str] = None
+        self._changed = False
 
     def __del__(self):
         self.close_file()
@@ -22,30 +50,23 @@ class BashScriptWriter:
     def __exit__(self, a, b, c):
         self.close_file()
 
-    def _open_file(self) -> None:
-        if self._file is None:
-            self._file = open(self._file_path, 'w')
-
-    @staticmethod
-    def _generate_bash(builders: List[BashCodeBuilder]) -> str:
-        fragments = [builder.build() for builder in builders]
-        return '\n'.join(fragments)
-
     def write(self, builders: List[BashCodeBuilder]) -> None:
-        bash = self._generate_bash(builders)
-        self._open_file()
-        self._file.write(bash)
+        self._code = (self._code or '') + generate_bash(builders)
+
+    def is_changed(self) -> bool:
+        return self._changed
 
     def close_file(self) -> None:
-        if self._file is not None:
-            self._file.close()
+        if self._code is not None:
+            code, self._code = self._code, None
+            self._changed = write_if_changed(self._file_path, code)
 
 
 class VideoBuilderListBuilder:
     def get_regeneration_check_builder(self) -> BashCodeBuilder:
         raise NotImplementedError()
 
-    def get_command_builder(self, options) -> BashCodeBuilder:
+    def get_command_builder(self, video: VideoConfig) -> BashCodeBuilder:
         raise NotImplementedError()
 
     @staticmethod
@@ -60,14 +81,14 @@ class VideoBuilderListBuilder:
     def _get_exit_builders():
         return [
             StaticBashCodeBuilder(bash_code.metadata_writer),
-            StaticBashCodeBuilder(bash_code.video_script_output)
+            StaticBashCodeBuilder(bash_code.video_length_output)
         ]
 
     def get_builders(self, video: VideoConfig) -> List[BashCodeBuilder]:
         return [
             *self._get_setup_builders(video),
             self.get_regeneration_check_builder(),
-            self.get_command_builder(video.get_options()),
+            self.get_command_builder(video),
             *self._get_exit_builders()
         ]
 
@@ -76,46 +97,73 @@ class VideoGenerationBuilderListBuilder(VideoBuilderListBuilder):
     def get_regeneration_check_builder(self) -> BashCodeBuilder:
         return StaticBashCodeBuilder(bash_code.skip_regenerate_existing_video)
 
-    def get_command_builder(self, options) -> BashCodeBuilder:
-        return FFmpegGenerateBuilder(options)
+    def get_command_builder(self, video: VideoConfig) -> BashCodeBuilder:
+        return FFmpegGenerateBuilder(video.get_options())
 
 
 class VideoConcatenationBuilderListBuilder(VideoBuilderListBuilder):
+    def __init__(self, always_stream_copy: bool = False):
+        self._always_stream_copy = always_stream_copy
+
     def get_regeneration_check_builder(self) -> BashCodeBuilder:
-        code = bash_code.concat_video_md5 + bash_code.skip_regenerate_existing_video
-        return StaticBashCodeBuilder(code)
+        return StaticBashCodeBuilder(bash_code.skip_regenerate_existing_video)
 
-    def get_command_builder(self, options) -> BashCodeBuilder:
-        return FFmpegConcatBuilder(options)
+    def get_command_builder(self, video: VideoConfig) -> BashCodeBuilder:
+        return FFmpegConcatBuilder(video.get_options(), video.get_part_files(), self._always_stream_copy,
+                                   video.get_split_parts())
 
 
 def get_video_script_builders(video: VideoConfig):
     if video.is_combination():
-        writer = VideoConcatenationBuilderListBuilder()
+        writer = VideoConcatenationBuilderListBuilder(video.is_always_stream_copied())
     else:
         writer = VideoGenerationBuilderListBuilder()
 
     return writer.get_builders(video)
 
 
-def write_video_script(video: VideoConfig) -> None:
+def generate_video_script(video: VideoConfig) -> str:
+    return generate_bash(get_video_script_builders(video))
+
+
+def write_video_script(video: VideoConfig) -> bool:
     builders = get_video_script_builders(video)
 
     with BashScriptWriter(video.get_script_path()) as writer:
         writer.write(builders)
+    return writer.is_changed()
+
 
+# returns the names of the scripts which changed
+def write_video_scripts(videos: List[VideoConfig]) -> List[str]:
+    return [video.get_script_name() for video in videos if write_video_script(video)]
 
-def write_video_scripts(videos: List[VideoConfig]) -> None:
-    for video in videos:
-        write_video_script(video)
+
+# removes the scripts of videos which are no longer part of the config
+def remove_orphaned_scripts(export_path: str, titles: Container[str], namespace: str = '') -> List[str]:
+    # every script is looked up by its title, so listing all videos isn't needed.
+    # Titles are names of bash variables, scripts of other namespaces never match.
+    prefix, suffix = get_video_script_name('*', namespace).split('*')
+    script_names = [
+        os.path.basename(path) for path in glob.glob(os.path.join(glob.escape(export_path), prefix + '*' + suffix))
+    ]
+    script_titles = {script_name: script_name[len(prefix):-len(suffix)] for script_name in script_names}
+    orphaned = sorted(
+        script_name for script_name, title in script_titles.items()
+        if re.fullmatch(r'\w+', title) and title not in titles
+    )
+    for script_name in orphaned:
+        os.unlink(os.path.join(export_path, script_name))
+    return orphaned
 
 
-def write_main_script(config: Config, videos: List[VideoConfig]) -> None:
+def write_main_script(config: Config, videos: List[VideoConfig]) -> bool:
     code_builders = [
         StaticBashCodeBuilder(bash_code.script_beginning),
-        BashVariableBuilder(config.get_variables()),
+        BashVariableBuilder(VariableResolver(config.get_variables()).resolve_variables()),
         VideoScriptCallBuilder(videos)
     ]
 
     with BashScriptWriter(config.get_script_path()) as writer:
         writer.write(code_builders)
+    return writer.is_changed()
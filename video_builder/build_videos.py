@@ -4,18 +4,53 @@
 #
 # example usage
 # python generate_video.py prestream.yaml ../export
+# python generate_video.py prestream.yaml ../export -j 8
+# python generate_video.py prestream.yaml ../export prestream
+# python generate_video.py prestream.yaml ../export prestream --preview
 #
 # see usage.md for more info
 
+import argparse
 import os
 from sys import argv
 
 from builder import build_videos
+from config.config import VideoConfigError
+from executor.cache import ArtifactCache
+from executor.resources import parse_size
+
+
+def parse_cli_arguments(arguments: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog=arguments[0] if arguments else None)
+    parser.add_argument('yaml_file_path')
+    parser.add_argument('export_path')
+    parser.add_argument('targets', nargs='*',
+                        help='videos to build along with the videos they combine, builds all videos by default')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='how many videos may be encoded at the same time')
+    parser.add_argument('--memory-limit', type=parse_size, default=None,
+                        help='only start videos while their memory use from earlier builds fits under this, e.g. 8G')
+    parser.add_argument('--executor', choices=['python', 'bash'], default='python',
+                        help='run ffmpeg directly (python) or through the generated bash scripts (bash)')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory to share built videos in between export directories')
+    parser.add_argument('--preview', action='store_true',
+                        help='quickly build low resolution previews, next to the final videos')
+    parser.add_argument('--cache-size', type=parse_size, default=parse_size('20G'),
+                        help='size the cache directory is kept under, e.g. 50G')
+    return parser.parse_args(arguments[1:])
 
 
 def build_videos_from_cli(arguments: list) -> int:
-    [_, yaml_file_path, export_path] = arguments
-    return build_videos(yaml_file_path, export_path)
+    parsed = parse_cli_arguments(arguments)
+    cache = ArtifactCache(parsed.cache_dir, parsed.cache_size) if parsed.cache_dir else None
+    try:
+        return build_videos(parsed.yaml_file_path, parsed.export_path, parsed.targets, jobs=parsed.jobs,
+                            executor=parsed.executor, memory_limit=parsed.memory_limit, cache=cache,
+                            preview=parsed.preview)
+    except VideoConfigError as error:
+        print(f'Invalid video config: {error}')
+        return 1
 
 
 def are_cli_arguments_valid(arguments: list) -> bool:
@@ -23,11 +58,17 @@ def are_cli_arguments_valid(arguments: list) -> bool:
         print('Please pass the config yaml and export path.')
         return False
 
-    if not os.path.exists(arguments[1]):
+    # options may come before the paths, so they are only known once parsed
+    try:
+        parsed = parse_cli_arguments(arguments)
+    except SystemExit:
+        return False
+
+    if not os.path.exists(parsed.yaml_file_path):
         print('Passed yaml file does not exist!')
         return False
 
-    if not os.path.exists(arguments[2]):
+    if not os.path.exists(parsed.export_path):
         print('Passed export directory does not exist!')
         return False
 
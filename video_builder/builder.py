@@ -1,65 +1,235 @@
 import os
-from typing import List, Dict
+import sys
+from typing import List, Dict, Optional, Sequence, Tuple
 
 import yaml
 
-from bash_writer.writers import write_video_scripts, write_main_script
-from config.builder import build_video_configs_from_config
-from config.config import Config, VideoConfig
+from bash_writer.writers import write_video_scripts, write_main_script, remove_orphaned_scripts
+from config.builder import build_video_configs_from_config, select_target_videos
+from config.chunks import expand_chunked_videos
+from config.compiled import CompiledConfig, CompiledConfigCache, compiled_config_file_name, get_compiled_config_key
+from config.config import Config, VideoConfig, VideoConfigError, get_namespaced_file_name, get_video_file_name, \
+    preview_namespace
+from config.includes import ConfigShard, ShardParseCache, shard_cache_file_name
 from config.preprocessors import VideoConfigListPreprocessor, VideoConfigOptionReferenceReplacer, \
     VideoConfigOptionPrepender, VideoConfigVariablePrepender, VideoConfigScriptDirAdder, VideoConfigTitleAdder, \
-    VideoConfigVariableAppender
+    VideoConfigVariableAppender, VideoConfigInputFingerprintAdder, VideoConfigIntermediateProfileAdder, \
+    VideoConfigChunkOptionAdder, VideoConfigNamespaceAdder, VideoConfigOutputOptionAppender, \
+    VideoConfigRenderRateAdder, VideoConfigStreamOptionAdder
+from config.profiles import get_video_profiles
+from config.streams import expand_split_videos
+from executor.cache import ArtifactCache
+from executor.fingerprint import InputFingerprinter, VideoFingerprinter
+from executor.graph import VideoDependencyGraph
+from executor.manifest import BuildManifest, manifest_file_name
+from executor.probes import ProbeCache
+from executor.resources import ThreadBudget, MemoryGate, get_available_cores
+from executor.result import VideoBuildResult
+from executor.runners import BashScriptRunner, FFmpegRunner
+from executor.scheduler import JobScheduler, VideoJob
+
+# changed scripts are named as long as there are at most this many
+listed_script_count = 10
+
+
+def build_videos(yaml_file_path: str, export_path: str, targets: Optional[List[str]] = None, jobs: int = 1,
+                 executor: str = 'python', memory_limit: Optional[int] = None,
+                 cache: Optional[ArtifactCache] = None, preview: bool = False) -> int:
+    config, videos = load_video_configs(yaml_file_path, export_path, targets, preview)
+    try:
+        # only the python executor looks at the probed sources
+        if executor == 'python':
+            prefetch_video_media(config, videos)
+        graph = write_scripts(config, videos)
+        results = run_videos(config, graph, jobs, executor, memory_limit, cache)
+    finally:
+        close_media_prober(config)
+    return 0 if all(result.is_successful() for result in results.values()) else 1
+
+
+def generate_scripts(config: Config, targets: Optional[List[str]] = None) -> VideoDependencyGraph:
+    return write_scripts(config, generate_video_configs(config, targets))
+
+
+def write_scripts(config: Config, videos: List[VideoConfig]) -> VideoDependencyGraph:
+    graph = VideoFingerprinter(VideoDependencyGraph(videos)).fingerprint()
+    changed = write_video_scripts(graph.get_videos())
+    if write_main_script(config, graph.get_videos()):
+        changed.append(config.get_script_name())
+    removed = remove_orphaned_scripts(config.get_export_path(), config.get_videos(), config.get_namespace())
+    report_script_changes(changed, removed, len(graph.get_videos()) + 1)
+    return graph
+
+
+def _list_script_names(script_names: List[str]) -> str:
+    # big configs change thousands of scripts at once, only a few are worth naming
+    if not script_names or len(script_names) > listed_script_count:
+        return ''
+    return f': {", ".join(script_names)}'
+
+
+def report_script_changes(changed: List[str], removed: List[str], script_count: int) -> None:
+    print(f'Updated {len(changed)} of {script_count} scripts{_list_script_names(changed)}', file=sys.stderr)
+    if removed:
+        print(f'Removed {len(removed)} orphaned scripts{_list_script_names(removed)}', file=sys.stderr)
+
+
+def generate_video_configs(config: Config, targets: Optional[List[str]] = None) -> List[VideoConfig]:
+    preprocessors = get_static_video_config_preprocessors(config, targets)
+    return build_video_configs_from_config(config, preprocessors, targets)
+
+
+def prefetch_video_media(config: Config, videos: List[VideoConfig]) -> None:
+    # probe all sources in the background, for whatever needs them later on
+    config.prefetch_media([source for video in videos for source in video.get_inputs()])
+
+
+def close_media_prober(config: Config) -> None:
+    # sources still waiting to be probed aren't needed anymore
+    if config.get_media_prober() is not None:
+        config.get_media_prober().close()
+
+
+def load_video_configs(yaml_file_path: str, export_path: str, targets: Optional[List[str]] = None,
+                       preview: bool = False) -> Tuple[Config, List[VideoConfig]]:
+    with open(yaml_file_path, 'rb') as file:
+        yaml_contents = file.read()
+    # previews are compiled apart, switching between them and final videos compiles neither again
+    namespace = preview_namespace if preview else ''
+    cache_name = get_namespaced_file_name(compiled_config_file_name, namespace)
+    cache = CompiledConfigCache(os.path.join(export_path, cache_name))
+    key = get_compiled_config_key(yaml_contents, export_path, targets, preview)
+
+    compiled = cache.load(key)
+    if compiled is None or not compiled.is_current():
+        raw_config = parse_yaml_config(yaml_contents)
+        shards = get_config_shards(raw_config, yaml_file_path, export_path)
+        compiled = compile_config(raw_config, export_path, targets, shards, preview)
+        cache.store(key, compiled)
+    else:
+        shards = get_config_shards(compiled.get_raw_config(), yaml_file_path, export_path)
+
+    main_script_name = get_namespaced_file_name('generate.bash', namespace)
+    config = create_config(compiled.get_raw_config(), export_path, main_script_name, shards, preview)
+    # inputs may change without the yaml changing, they are fingerprinted on every build
+    input_fingerprint_adder = get_input_fingerprint_adder(config)
+    videos = [
+        VideoConfig(input_fingerprint_adder.process(contents, contents['title']), config.get_media_prober())
+        for contents in compiled.get_videos()
+    ]
+    return config, videos
+
+
+def compile_config(raw_config: dict, export_path: str, targets: Optional[List[str]] = None,
+                   shards: Sequence[ConfigShard] = (), preview: bool = False) -> CompiledConfig:
+    raw_config['videos'] = expand_split_videos(expand_chunked_videos(raw_config.get('videos', {})))
+    config = Config(raw_config, export_path, 'generate.bash', shards=shards, preview=preview)
+    preprocessors = get_compiled_video_config_preprocessors(config, targets)
+    videos = [video.get_contents() for video in build_video_configs_from_config(config, preprocessors, targets)]
+    shard_stats = {shard.get_path(): shard.get_stat() for shard in shards}
+    return CompiledConfig(raw_config, videos, export_path, config.get_videos().get_glob_matches(), shard_stats)
+
 
+def create_config(raw_config: dict, export_path: str, main_script_name: str,
+                  shards: Sequence[ConfigShard] = (), preview: bool = False) -> Config:
+    media_prober = ProbeCache(export_path, InputFingerprinter(export_path), get_available_cores())
+    return Config(raw_config, export_path, main_script_name, media_prober, shards, preview)
 
-def build_videos(yaml_file_path: str, export_path: str) -> int:
-    config = create_config(yaml_file_path, export_path, main_script_name='generate.bash')
-    generate_scripts(config)
-    return run_script(config.get_export_path(), config.get_script_name())
 
+def get_config_shards(raw_config: dict, yaml_file_path: str, export_path: str) -> List[ConfigShard]:
+    # included files are relative to the yaml including them
+    includes = raw_config.get('include', [])
+    if isinstance(includes, str):
+        includes = [includes]
+    if not isinstance(includes, list) or not all(isinstance(include, str) for include in includes):
+        raise VideoConfigError('include has to be a file or a list of files')
 
-def generate_scripts(config: Config) -> None:
-    video_configs = generate_video_configs(config)
-    write_video_scripts(video_configs)
-    write_main_script(config, video_configs)
+    directory = os.path.dirname(os.path.abspath(yaml_file_path))
+    cache = ShardParseCache(os.path.join(export_path, shard_cache_file_name))
+    return [ConfigShard(os.path.join(directory, include), cache, parse_yaml_config) for include in includes]
 
 
-def generate_video_configs(config: Config) -> List[VideoConfig]:
-    preprocessors = get_static_video_config_preprocessors(config)
-    return build_video_configs_from_config(config, preprocessors)
+# the C parser of libyaml is a lot faster, if pyyaml was built with it
+yaml_loader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
 
 
-def create_config(yaml_file_path: str, export_path: str, main_script_name: str) -> Config:
-    raw_config = load_yaml_config_from_file(yaml_file_path)
-    return Config(raw_config, export_path, main_script_name)
+def parse_yaml_config(contents: bytes) -> dict:
+    return yaml.load(contents, Loader=yaml_loader) or {}
 
 
 def load_yaml_config_from_file(filename: str) -> dict:
     with open(filename, 'r') as file:
-        return yaml.load(file, Loader=yaml.FullLoader)
+        return yaml.load(file, Loader=yaml_loader)
+
+
+def get_thread_budget(graph: VideoDependencyGraph, jobs: int, executor: str) -> Optional[ThreadBudget]:
+    # only the python executor passes thread counts to ffmpeg
+    if executor != 'python':
+        return None
+    return ThreadBudget(get_available_cores(), jobs, len(graph.get_titles()))
+
 
+def get_video_runner(config: Config, executor: str, memory_gate: Optional[MemoryGate],
+                     cache: Optional[ArtifactCache] = None, thread_budget: Optional[ThreadBudget] = None) -> VideoJob:
+    if executor == 'bash':
+        return BashScriptRunner(config.get_export_path(), memory_gate).run
+    if executor == 'python':
+        manifest = BuildManifest(config.get_export_path() + manifest_file_name)
+        return FFmpegRunner(config.get_export_path(), manifest, thread_budget, memory_gate, cache).run
+    raise ValueError(f'unknown executor "{executor}"')
 
-def run_script(path: str, name: str) -> int:
-    os.chdir(path)
-    os.system('chmod +x *.bash')
-    return os.system(f'bash {name}')
 
+def get_memory_gate(config: Config, memory_limit: Optional[int]) -> Optional[MemoryGate]:
+    if memory_limit is None:
+        return None
+    return MemoryGate(config.get_export_path() + '.memory_usage.json', memory_limit)
 
-def get_static_video_config_preprocessors(config: Config) -> List[VideoConfigListPreprocessor]:
+
+def run_videos(config: Config, graph: VideoDependencyGraph, jobs: int = 1, executor: str = 'python',
+               memory_limit: Optional[int] = None,
+               cache: Optional[ArtifactCache] = None) -> Dict[str, VideoBuildResult]:
+    memory_gate = get_memory_gate(config, memory_limit)
+    thread_budget = get_thread_budget(graph, jobs, executor)
+    runner = get_video_runner(config, executor, memory_gate, cache, thread_budget)
+    return JobScheduler(graph, jobs, memory_gate, thread_budget and thread_budget.skip).run(runner)
+
+
+def get_static_video_config_preprocessors(config: Config,
+                                          targets: Optional[List[str]] = None) -> List[VideoConfigListPreprocessor]:
+    return [*get_compiled_video_config_preprocessors(config, targets), get_input_fingerprint_adder(config)]
+
+
+# everything that follows from the yaml alone
+def get_compiled_video_config_preprocessors(config: Config,
+                                            targets: Optional[List[str]] = None) -> List[VideoConfigListPreprocessor]:
+    if targets:
+        # loads only the included shards the targets need, profiles of other shards don't apply to them
+        select_target_videos(config.get_videos(), targets)
     return [
         VideoConfigTitleAdder(),
         VideoConfigScriptDirAdder(config.get_export_path()),
+        VideoConfigNamespaceAdder(config.get_namespace()),
         VideoConfigVariablePrepender(config.get_variables()),
-        VideoConfigVariableAppender(get_static_video_variables()),
+        VideoConfigVariableAppender(get_static_video_variables(config.get_namespace())),
         VideoConfigOptionPrepender(config.get_options()),
         VideoConfigOptionReferenceReplacer(config.get_option_templates()),
+        VideoConfigIntermediateProfileAdder(get_video_profiles(config, loaded_only=bool(targets))),
+        VideoConfigOutputOptionAppender(config.get_output_options()),
+        VideoConfigRenderRateAdder(),
+        VideoConfigChunkOptionAdder(),
+        VideoConfigStreamOptionAdder(),
     ]
 
 
-def get_static_video_variables() -> Dict[str, str]:
+def get_input_fingerprint_adder(config: Config) -> VideoConfigInputFingerprintAdder:
+    return VideoConfigInputFingerprintAdder(InputFingerprinter(config.get_export_path()).get_fingerprint)
+
+
+def get_static_video_variables(namespace: str = '') -> Dict[str, str]:
     return {
         'video_title': '{video_title}',
-        'output_file': '$video_title.mp4',
-        'script_path': '$(readlink --canonicalize-existing "$0")',
-        'script_md5': '$(md5sum $script_path | cut -d" " -f1)',
-        'video_md5': '$(exiftool $output_file | grep Artist | cut -d":" -f2 | xargs)'
+        'output_file': get_video_file_name('$video_title', namespace),
+        'fingerprint': '',
+        'static_duration': '',
+        'manifest': manifest_file_name,
     }
@@ -1,14 +1,23 @@
-from typing import List, Dict
+from typing import List, Dict, Mapping, Optional
 
-from config.config import Config, VideoConfig
+from config.config import Config, VideoConfig, VideoConfigError
+from config.matrix import VideoDefinitions
+from config.media import MediaProber
 from config.preprocessors import VideoConfigListPreprocessor, VideoConfigVariableReferenceReplacer
 
 
+# the config of a video is copied once, every preprocessor then updates the
+# copy in place instead of copying it again
+def copy_video_config(config: dict) -> dict:
+    return {key: value.copy() if isinstance(value, (dict, list)) else value for key, value in config.items()}
+
+
 class VideoConfigBuilder:
-    def __init__(self, video_title: str, config: Dict[str, dict]):
+    def __init__(self, video_title: str, config: Dict[str, dict], media_prober: Optional[MediaProber] = None):
         self._preprocessors = []
-        self._config = config
+        self._config = copy_video_config(config)
         self._video_title = video_title
+        self._media_prober = media_prober
 
     def set_preprocessors(self, preprocessors: List[VideoConfigListPreprocessor]) -> None:
         self._preprocessors = preprocessors
@@ -19,11 +28,12 @@ class VideoConfigBuilder:
 
     def build(self) -> VideoConfig:
         self._execute_preprocessors()
-        return VideoConfig(self._config)
+        return VideoConfig(self._config, self._media_prober)
 
 
-def build_video_config(title: str, config: dict, preprocessors: List[VideoConfigListPreprocessor]) -> VideoConfig:
-    builder = VideoConfigBuilder(title, config)
+def build_video_config(title: str, config: dict, preprocessors: List[VideoConfigListPreprocessor],
+                       media_prober: Optional[MediaProber] = None) -> VideoConfig:
+    builder = VideoConfigBuilder(title, config, media_prober)
     preprocessors = [
         *preprocessors,
         VideoConfigVariableReferenceReplacer({'{video_title}': title})
@@ -32,9 +42,34 @@ def build_video_config(title: str, config: dict, preprocessors: List[VideoConfig
     return builder.build()
 
 
-def build_video_configs_from_config(config: Config, preprocessors: List[VideoConfigListPreprocessor]) -> List[
-    VideoConfig]:
+def select_target_videos(videos: Mapping[str, dict], targets: List[str]) -> Dict[str, dict]:
+    selected = set()
+    pending = [*targets]
+
+    while pending:
+        title = pending.pop()
+        if title in selected:
+            continue
+        if title not in videos:
+            raise VideoConfigError(f'unknown video "{title}"')
+
+        selected.add(title)
+        dependencies = VideoConfig({**videos[title], 'title': title}).get_dependencies(videos.keys())
+        pending += dependencies
+
+    # keep the order the videos were declared in, without creating every video of
+    # a matrix or loading included shards no target needs
+    titles = videos.get_loaded_titles() if isinstance(videos, VideoDefinitions) else videos
+    return {title: videos[title] for title in titles if title in selected}
+
+
+def build_video_configs_from_config(config: Config, preprocessors: List[VideoConfigListPreprocessor],
+                                    targets: Optional[List[str]] = None) -> List[VideoConfig]:
+    videos = config.get_videos()
+    if targets:
+        videos = select_target_videos(videos, targets)
+
     return [
-        build_video_config(video_title, video_config, preprocessors)
-        for video_title, video_config in config.get_videos().items()
+        build_video_config(video_title, video_config, preprocessors, config.get_media_prober())
+        for video_title, video_config in videos.items()
     ]
@@ -0,0 +1,120 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+from config.errors import VideoConfigError
+from config.media import parse_time
+from config.variables import VariableResolver
+
+_input_option = re.compile(r'(^|\s)-i\s')
+_duration_option = re.compile(r'(^|\s)-t\s+(\S+)')
+_length_reference = re.compile(r'\$\{?(\w+_length)\b')
+
+
+def get_chunk_title(title: str, index: int) -> str:
+    return f'{title}_chunk{index}'
+
+
+def _get_chunk_count(title: str, video: dict) -> int:
+    count = video.get('chunks', 1)
+    if not isinstance(count, int) or count < 1:
+        raise VideoConfigError(f'{title} has to be split into a positive number of chunks')
+    if count > 1 and video.get('combine'):
+        raise VideoConfigError(f'{title} combines other videos, only single videos can be encoded in chunks')
+    return count
+
+
+def expand_chunked_videos(videos: Dict[str, dict]) -> Dict[str, dict]:
+    # a video encoded in chunks becomes a video for every chunk and a
+    # combination of all chunks, which is always stream copied
+    expanded = {}
+    for title, video in videos.items():
+        # videos of a matrix can't be encoded in chunks
+        if 'matrix' in video:
+            expanded[title] = video
+            continue
+        count = _get_chunk_count(title, video)
+        video = {key: value for key, value in video.items() if key != 'chunks'}
+        if count == 1:
+            expanded[title] = video
+            continue
+
+        # variables keep referring to the whole video, only the output differs
+        variables = {
+            name: str(value).replace('{video_title}', title)
+            for name, value in video.get('variables', {}).items()
+        }
+        chunk_titles = [get_chunk_title(title, index) for index in range(count)]
+        for index, chunk_title in enumerate(chunk_titles):
+            expanded[chunk_title] = {**video, 'variables': variables, 'chunk': [index, count]}
+        expanded[title] = {'combine': chunk_titles, 'chunked': True}
+
+    return expanded
+
+
+def get_option_text(option) -> str:
+    # like FFmpegOptionBuilder, only the first value of dict options is used
+    while type(option) is dict:
+        option = list(option.values())[0]
+    return str(option)
+
+
+def _find_duration(title: str, options: List[str]) -> Tuple[Optional[int], str]:
+    # the output duration after the inputs, or else the only input duration,
+    # like the one of a generated audio track the video is cut short to
+    input_lines = [index for index, option in enumerate(options) if _input_option.search(option)]
+    first_output_line = input_lines[-1] + 1 if input_lines else 0
+    for index in range(first_output_line, len(options)):
+        match = _duration_option.search(options[index])
+        if match:
+            return index, match.group(2)
+
+    input_durations = [match.group(2) for option in options[:first_output_line]
+                       for match in _duration_option.finditer(option)]
+    if len(input_durations) == 1:
+        return None, input_durations[0]
+    raise VideoConfigError(f'{title} needs a "-t" duration after its inputs to be encoded in chunks')
+
+
+def _format_seconds(seconds: float) -> str:
+    return f'{seconds:.3f}'.rstrip('0').rstrip('.')
+
+
+def _get_chunk_times(title: str, duration: str, variables: Dict[str, str], index: int,
+                     count: int) -> Dict[str, str]:
+    # chunks start at whole seconds, which add up to the duration of the video
+    start = f'({duration}) * {index} / {count}'
+    end = f'({duration}) * {index + 1} / {count}'
+    # the lengths of other videos are only known while building
+    dynamic = {name for value in [duration, *variables.values()] for name in _length_reference.findall(str(value))}
+    resolved = VariableResolver(variables, run_commands=False, dynamic=dynamic).expand(duration)
+    if '$' in resolved:
+        # left to bash, which only knows whole numbers
+        return {'chunk_start': f'$(( {start} ))', 'chunk_end': f'$(( {end} ))'}
+
+    try:
+        seconds = parse_time(resolved)
+    except ValueError:
+        raise VideoConfigError(f'{title} has no valid duration to be encoded in chunks: "{resolved}"')
+    chunk_start = int(seconds * index / count)
+    chunk_end = seconds if index + 1 == count else int(seconds * (index + 1) / count)
+    return {'chunk_start': str(chunk_start), 'chunk_end': _format_seconds(chunk_end)}
+
+
+def get_chunk_options(title: str, options: List[str], variables: Dict[str, str], index: int,
+                      count: int) -> Tuple[List[str], Dict[str, str]]:
+    # every input is read from the start of the chunk on, timestamps are kept so
+    # time based filter expressions see the same time as without chunks. The
+    # kept timestamps make the end of the chunk an absolute position (-to), a
+    # -t length would end the chunk before its first frame. Generated (lavfi)
+    # inputs can't seek, they are generated from the start and dropped up to it.
+    options = [get_option_text(option) for option in options]
+    duration_line, duration = _find_duration(title, options)
+    chunk_options = ['-copyts']
+    for line, option in enumerate(options):
+        option = _input_option.sub(r'\1-ss $chunk_start -i ', option)
+        if line == duration_line:
+            option = _duration_option.sub('', option, count=1).strip()
+        if option:
+            chunk_options.append(option)
+    chunk_options.append('-to $chunk_end')
+    return chunk_options, _get_chunk_times(title, duration, variables, index, count)
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple, final
+
+from config.errors import VideoConfigError
+from config.includes import get_shard_stat
+from config.matrix import find_glob_matches
+
+# change whenever the same yaml compiles to different video configs
+compiled_config_version = 4
+compiled_config_file_name = '.compiled_config.json'
+
+
+def get_compiled_config_key(yaml_contents: bytes, export_path: str, targets: Optional[List[str]],
+                            preview: bool = False) -> str:
+    digest = hashlib.sha256(yaml_contents)
+    digest.update(json.dumps([compiled_config_version, export_path, sorted(targets or []), preview]).encode())
+    return digest.hexdigest()
+
+
+# the parsed yaml and the preprocessed configs of the videos to build, along
+# with the files video matrices found and the state of the included files
+@final
+class CompiledConfig:
+    def __init__(self, raw_config: dict, videos: List[dict], export_path: str,
+                 glob_matches: Optional[Dict[str, List[str]]] = None,
+                 shard_stats: Optional[Dict[str, Tuple[int, int]]] = None):
+        self._raw_config = raw_config
+        self._videos = videos
+        self._export_path = export_path
+        self._glob_matches = glob_matches or {}
+        self._shard_stats = shard_stats or {}
+
+    def get_raw_config(self) -> dict:
+        return self._raw_config
+
+    def get_videos(self) -> List[dict]:
+        return self._videos
+
+    def _are_shards_unchanged(self) -> bool:
+        try:
+            return all(get_shard_stat(path) == stat for path, stat in self._shard_stats.items())
+        except VideoConfigError:
+            return False
+
+    # files added or removed change the videos of a matrix, included files may change
+    def is_current(self) -> bool:
+        return self._are_shards_unchanged() and all(
+            find_glob_matches(self._export_path, pattern) == matches
+            for pattern, matches in self._glob_matches.items()
+        )
+
+    def get_contents(self) -> dict:
+        return {
+            'raw_config': self._raw_config,
+            'videos': self._videos,
+            'export_path': self._export_path,
+            'glob_matches': self._glob_matches,
+            'shard_stats': self._shard_stats,
+        }
+
+
+def load_compiled_config(contents: dict) -> CompiledConfig:
+    # json keeps the stat tuples as lists
+    shard_stats = {path: tuple(stat) for path, stat in dict(contents['shard_stats']).items()}
+    return CompiledConfig(contents['raw_config'], contents['videos'], contents['export_path'],
+                          contents['glob_matches'], shard_stats)
+
+
+# keeps the last compiled config of an export directory, so building again
+# with an unchanged yaml skips parsing and preprocessing it
+@final
+class CompiledConfigCache:
+    def __init__(self, path: str):
+        self._path = path
+
+    # kept as json, loading a file others can write to mustn't run any code
+    def load(self, key: str) -> Optional[CompiledConfig]:
+        try:
+            with open(self._path, 'r') as file:
+                cached = json.load(file)
+            return load_compiled_config(cached['compiled']) if cached['key'] == key else None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def store(self, key: str, compiled: CompiledConfig) -> None:
+        try:
+            contents = json.dumps({'key': key, 'compiled': compiled.get_contents()})
+        except (TypeError, ValueError):
+            # yaml values json has no type for, like dates, are compiled on every build
+            return
+        temporary_path = f'{self._path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as file:
+            file.write(contents)
+        os.replace(temporary_path, self._path)
@@ -1,11 +1,46 @@
-from typing import List, Dict
+import os
+import re
+from typing import List, Dict, Collection, Optional, Sequence
+
+from config.errors import VideoConfigError
+from config.includes import ConfigShard
+from config.matrix import VideoDefinitions
+from config.media import MediaProber, MediaInfo
+
+
+preview_namespace = 'preview'
+
+# output options of previews, later options win in ffmpeg so these replace the
+# resolution, frame rate and encoder settings of every video
+default_preview_options = ['-s 640x360', '-r 12', '-preset ultrafast', '-crf 30']
+
+
+def get_namespaced_file_name(name: str, namespace: str = '') -> str:
+    # files of other namespaces, like previews, are kept next to the final ones
+    if not namespace:
+        return name
+    stem, extension = os.path.splitext(name)
+    return f'{stem}.{namespace}{extension}'
+
+
+def get_video_script_name(title: str, namespace: str = '') -> str:
+    return get_namespaced_file_name(f'export_{title}.bash', namespace)
+
+
+def get_video_file_name(title: str, namespace: str = '') -> str:
+    return get_namespaced_file_name(f'{title}.mp4', namespace)
 
 
 class Config:
-    def __init__(self, config: dict, export_path: str, script_name: str):
+    def __init__(self, config: dict, export_path: str, script_name: str, media_prober: Optional[MediaProber] = None,
+                 shards: Sequence[ConfigShard] = (), preview: bool = False):
         self._contents = config
         self._export_dir = self._add_trailing_slash(export_path)
         self._script_name = script_name
+        self._media_prober = media_prober
+        self._shards = shards
+        self._preview = preview
+        self._videos: Optional[VideoDefinitions] = None
 
     @staticmethod
     def _add_trailing_slash(directory: str):
@@ -17,13 +52,44 @@ class Config:
         return self._contents.get('shared_variables', {})
 
     def get_options(self) -> List[str]:
-        return self._contents.get('shared_options', [])
+        options = self._contents.get('shared_options', [])
+        return [*options, *self._get_preview_settings().get('shared_options', [])] if self._preview else options
 
-    def get_videos(self) -> Dict[str, dict]:
-        return self._contents.get('videos', {})
+    # video matrices are expanded into their videos and included shards are
+    # loaded only once those are used
+    def get_videos(self) -> VideoDefinitions:
+        if self._videos is None:
+            self._videos = VideoDefinitions(self._contents.get('videos', {}), self._export_dir, self.get_variables(),
+                                            self._shards)
+        return self._videos
+
+    def get_shards(self) -> Sequence[ConfigShard]:
+        return self._shards
 
     def get_option_templates(self) -> dict:
-        return self._contents.get('option_templates', {})
+        templates = self._contents.get('option_templates', {})
+        return {**templates, **self._get_preview_settings().get('option_templates', {})} if self._preview else templates
+
+    def _get_preview_settings(self) -> dict:
+        settings = self._contents.get('preview') or {}
+        unknown = [key for key in settings if key not in ('options', 'shared_options', 'option_templates')]
+        if unknown:
+            raise VideoConfigError(f'unknown preview settings {", ".join(unknown)}')
+        return settings
+
+    def is_preview(self) -> bool:
+        return self._preview
+
+    # previews are built under their own names, final videos are never replaced by them
+    def get_namespace(self) -> str:
+        return preview_namespace if self._preview else ''
+
+    # appended to the options of every video which isn't a combination
+    def get_output_options(self) -> List[str]:
+        return self._get_preview_settings().get('options', default_preview_options) if self._preview else []
+
+    def get_intermediate_profiles(self) -> Dict[str, dict]:
+        return self._contents.get('intermediate_profiles', {})
 
     def get_export_path(self) -> str:
         return self._export_dir
@@ -34,28 +100,108 @@ class Config:
     def get_script_path(self) -> str:
         return self._export_dir + self.get_script_name()
 
+    def get_media_prober(self) -> Optional[MediaProber]:
+        return self._media_prober
+
+    def prefetch_media(self, paths: List[str]) -> None:
+        if self._media_prober is not None:
+            self._media_prober.prefetch(paths)
+
+    def probe_media(self, path: str) -> Optional[MediaInfo]:
+        return self._media_prober.probe(path) if self._media_prober is not None else None
+
 
+# a built video config, which is never changed afterwards - the with_ methods
+# return new configs. The fields used most are looked up once.
 class VideoConfig:
-    def __init__(self, config_dict):
+    __slots__ = ('_contents', '_media_prober', '_title', '_variables', '_options', '_combine', '_mux')
+
+    # other videos can be referenced through the exported "<title>_length"
+    # variables, e.g. "$(expr $cd_dur - $intro_length)"
+    _length_reference = re.compile(r'\$\{?(\w+)_length\b')
+
+    def __init__(self, config_dict, media_prober: Optional[MediaProber] = None):
         self._contents = config_dict
+        self._media_prober = media_prober
+        self._title = config_dict.get('title')
+        self._variables = config_dict.get('variables', {})
+        self._options = config_dict.get('options', [])
+        self._combine = config_dict.get('combine', [])
+        self._mux = config_dict.get('mux', [])
 
     def get_variables(self) -> Dict[str, str]:
-        return self._contents.get('variables', {})
+        return self._variables
 
     def get_options(self) -> List[str]:
-        return self._contents.get('options', [])
+        return self._options
+
+    def get_inputs(self) -> List[str]:
+        return self._contents.get('inputs', [])
+
+    def get_input_media(self) -> Dict[str, Optional[MediaInfo]]:
+        if self._media_prober is None:
+            return {}
+        return {source: self._media_prober.probe(source) for source in self.get_inputs()}
 
     def get_combine(self) -> List[str]:
-        return self._contents.get('combine', [])
+        return self._combine
+
+    # the videos whose streams are muxed into this one
+    def get_mux(self) -> List[str]:
+        return self._mux
+
+    def get_part_files(self) -> List[str]:
+        return [get_video_file_name(title, self.get_namespace()) for title in self._combine]
+
+    # the part files which are decoded once and split for all of their uses
+    def get_split_parts(self) -> List[str]:
+        return self._contents.get('split_parts', [])
+
+    def get_namespace(self) -> str:
+        return self._contents.get('namespace', '')
 
     def is_combination(self) -> bool:
-        return len(self.get_combine()) > 0
+        return len(self._combine) > 0
+
+    def get_intermediate_profile(self) -> Optional[str]:
+        return self._contents.get('intermediate_profile')
+
+    def is_chunked(self) -> bool:
+        return self._contents.get('chunked', False)
+
+    # combinations whose parts are known to match are never re-encoded
+    def is_always_stream_copied(self) -> bool:
+        return self.is_combination() and (self.get_intermediate_profile() is not None or self.is_chunked())
+
+    def _get_referenced_lengths(self) -> List[str]:
+        texts = [*map(str, self.get_variables().values()), *map(str, self.get_options())]
+        return [title for text in texts for title in self._length_reference.findall(text)]
+
+    def get_dependencies(self, titles: Collection[str]) -> List[str]:
+        dependencies = [*self.get_combine(), *self.get_mux()]
+        dependencies += [title for title in self._get_referenced_lengths() if title in titles]
+        return [title for title in dict.fromkeys(dependencies) if title != self.get_title()]
 
     def get_title(self) -> str:
-        return self._contents.get('title')
+        return self._title
+
+    def get_fingerprint(self) -> Optional[str]:
+        return self.get_variables().get('fingerprint') or None
+
+    def with_variables(self, variables: Dict[str, str]) -> 'VideoConfig':
+        return VideoConfig({**self._contents, 'variables': {**self.get_variables(), **variables}}, self._media_prober)
+
+    def with_resolved_variables(self, variables: Dict[str, str]) -> 'VideoConfig':
+        return VideoConfig({**self._contents, 'variables': variables}, self._media_prober)
+
+    def with_split_parts(self, split_parts: List[str]) -> 'VideoConfig':
+        return VideoConfig({**self._contents, 'split_parts': split_parts}, self._media_prober)
+
+    def get_contents(self) -> dict:
+        return self._contents
 
     def get_script_name(self) -> str:
-        return f'export_{self.get_title()}.bash'
+        return get_video_script_name(self.get_title(), self.get_namespace())
 
     def get_script_path(self) -> str:
         return self._contents.get('script_dir') + self.get_script_name()
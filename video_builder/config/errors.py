@@ -0,0 +1,2 @@
+class VideoConfigError(ValueError):
+    pass
@@ -0,0 +1,126 @@
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, final
+
+from config.chunks import expand_chunked_videos
+from config.errors import VideoConfigError
+from config.streams import expand_split_videos
+
+shard_cache_file_name = '.config_shards.sqlite'
+
+shard_cache_schema = """\
+CREATE TABLE IF NOT EXISTS shards (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    titles TEXT NOT NULL,
+    videos TEXT NOT NULL
+);\
+"""
+
+
+def get_shard_stat(path: str) -> Tuple[int, int]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise VideoConfigError(f'included config {path} does not exist')
+    return stat.st_size, stat.st_mtime_ns
+
+
+# parsed included configs by their path, as long as the file doesn't change.
+# The titles are kept apart from the videos, so listing them is cheap.
+@final
+class ShardParseCache:
+    def __init__(self, path: str):
+        self._path = path
+        self._initialized = False
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self._path, timeout=30)
+        try:
+            with connection:
+                if not self._initialized:
+                    connection.executescript(shard_cache_schema)
+                    self._initialized = True
+                yield connection
+        finally:
+            connection.close()
+
+    def get_titles(self, path: str, stat: Tuple[int, int]) -> Optional[List[str]]:
+        with self._connect() as connection:
+            row = connection.execute('SELECT titles FROM shards WHERE path = ? AND size = ? AND mtime = ?',
+                                     (path, *stat)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_videos(self, path: str, stat: Tuple[int, int]) -> Optional[Dict[str, dict]]:
+        with self._connect() as connection:
+            row = connection.execute('SELECT videos FROM shards WHERE path = ? AND size = ? AND mtime = ?',
+                                     (path, *stat)).fetchone()
+        try:
+            return json.loads(row[0]) if row else None
+        except ValueError:
+            # videos which aren't json, like those pickled by earlier versions, are parsed again
+            return None
+
+    def store(self, path: str, stat: Tuple[int, int], videos: Dict[str, dict]) -> None:
+        try:
+            encoded_videos = json.dumps(videos)
+        except (TypeError, ValueError):
+            # yaml values json has no type for, like dates, are parsed on every build
+            return
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO shards (path, size, mtime, titles, videos) VALUES (?, ?, ?, ?, ?)',
+                (path, *stat, json.dumps([*videos]), encoded_videos)
+            )
+
+
+# an included config file defining more videos. It is only parsed once its
+# videos are needed, and only if it changed since it was parsed last.
+@final
+class ConfigShard:
+    def __init__(self, path: str, cache: ShardParseCache, parse: Callable[[bytes], dict]):
+        self._path = path
+        self._cache = cache
+        self._parse = parse
+        self._stat: Optional[Tuple[int, int]] = None
+        self._titles: Optional[List[str]] = None
+        self._videos: Optional[Dict[str, dict]] = None
+
+    def get_path(self) -> str:
+        return self._path
+
+    def get_stat(self) -> Tuple[int, int]:
+        if self._stat is None:
+            self._stat = get_shard_stat(self._path)
+        return self._stat
+
+    def _parse_videos(self) -> Dict[str, dict]:
+        with open(self._path, 'rb') as file:
+            contents = self._parse(file.read())
+        unknown = [key for key in contents if key != 'videos']
+        if unknown:
+            raise VideoConfigError(f'included config {self._path} may only define videos, not {", ".join(unknown)}')
+
+        videos = expand_split_videos(expand_chunked_videos(contents.get('videos') or {}))
+        self._cache.store(self._path, self.get_stat(), videos)
+        return videos
+
+    # titles as they are declared, including the titles of video matrices
+    def get_titles(self) -> List[str]:
+        if self._titles is None:
+            if self._videos is None:
+                self._titles = self._cache.get_titles(self._path, self.get_stat())
+            if self._titles is None:
+                self._titles = [*self.get_videos()]
+        return self._titles
+
+    def get_videos(self) -> Dict[str, dict]:
+        if self._videos is None:
+            self._videos = self._cache.get_videos(self._path, self.get_stat())
+            if self._videos is None:
+                self._videos = self._parse_videos()
+        return self._videos
@@ -0,0 +1,240 @@
+import glob
+import os
+import re
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Optional, Pattern, Sequence, Tuple, final
+
+from config.errors import VideoConfigError
+from config.includes import ConfigShard
+from config.variables import VariableResolver
+
+_parameter = re.compile(r'\{(\w+)\}')
+
+
+def find_glob_matches(export_path: str, pattern: str) -> List[str]:
+    # relative patterns match files relative to the export directory, where ffmpeg runs
+    matches = glob.glob(os.path.join(glob.escape(export_path), pattern))
+    if not os.path.isabs(pattern):
+        matches = [os.path.relpath(path, export_path) for path in matches]
+    return sorted(matches)
+
+
+def get_title_pattern(title_template: str) -> Pattern:
+    # matches every title a video matrix could create
+    parts = _parameter.split(title_template)
+    return re.compile(''.join(re.escape(part) if index % 2 == 0 else '.+' for index, part in enumerate(parts)))
+
+
+# one video definition shared by a list of parameter sets, or by every file
+# matching a glob. Parameters become variables of the videos and fill in the
+# "{parameter}" placeholders of the title.
+@final
+class VideoMatrix:
+    def __init__(self, title_template: str, definition: dict, export_path: str, variables: Dict[str, str]):
+        if not _parameter.search(title_template):
+            raise VideoConfigError(f'video matrix {title_template} needs a parameter in its title, e.g. "{{name}}"')
+        if 'chunks' in definition or 'split_streams' in definition:
+            raise VideoConfigError(
+                f'videos of the video matrix {title_template} can\'t be encoded in chunks or streams'
+            )
+        self._title_template = title_template
+        self._matrix = definition['matrix']
+        self._definition = {key: value for key, value in definition.items() if key != 'matrix'}
+        self._export_path = export_path
+        self._variables = variables
+        self._glob_matches: Optional[Dict[str, List[str]]] = None
+        self._parameter_sets: Optional[Dict[str, dict]] = None
+
+    def _get_title(self, parameters: dict) -> str:
+        try:
+            return _parameter.sub(lambda match: str(parameters[match.group(1)]), self._title_template)
+        except KeyError as error:
+            raise VideoConfigError(f'video matrix {self._title_template} is missing the parameter {error}')
+
+    def _find_files(self) -> List[dict]:
+        # the pattern may use shared variables and variables of the definition
+        resolver = VariableResolver({**self._variables, **self._definition.get('variables', {})})
+        pattern = resolver.expand(str(self._matrix['glob']))
+        matches = find_glob_matches(self._export_path, pattern)
+        self._glob_matches = {pattern: matches}
+
+        variable = self._matrix.get('variable', 'file')
+        return [
+            {'name': re.sub(r'\W', '_', os.path.splitext(os.path.basename(path))[0]), variable: path}
+            for path in matches
+        ]
+
+    def _get_parameter_list(self) -> List[dict]:
+        if isinstance(self._matrix, dict) and 'glob' in self._matrix:
+            return self._find_files()
+        if isinstance(self._matrix, list) and all(isinstance(parameters, dict) for parameters in self._matrix):
+            return self._matrix
+        raise VideoConfigError(f'video matrix {self._title_template} needs a list of parameters or a glob')
+
+    def get_parameter_sets(self) -> Dict[str, dict]:
+        if self._parameter_sets is None:
+            parameter_sets = {}
+            for parameters in self._get_parameter_list():
+                title = self._get_title(parameters)
+                if title in parameter_sets:
+                    raise VideoConfigError(f'video matrix {self._title_template} defines {title} more than once')
+                parameter_sets[title] = parameters
+            self._parameter_sets = parameter_sets
+        return self._parameter_sets
+
+    def get_titles(self) -> List[str]:
+        return [*self.get_parameter_sets()]
+
+    def get_glob_matches(self) -> Dict[str, List[str]]:
+        self.get_parameter_sets()
+        return self._glob_matches or {}
+
+    def get_video(self, title: str) -> dict:
+        parameters = {name: str(value) for name, value in self.get_parameter_sets()[title].items()}
+        return {**self._definition, 'variables': {**self._definition.get('variables', {}), **parameters}}
+
+
+# the videos of a config by their title. Videos of a matrix are only created
+# when they are looked up, so building a few targets doesn't create all of them.
+# Videos of included config shards are looked up after the videos of the config
+# itself, a shard is only loaded once one of its videos is needed.
+@final
+class VideoDefinitions(Mapping):
+    def __init__(self, videos: Dict[str, dict], export_path: str, variables: Dict[str, str],
+                 shards: Sequence[ConfigShard] = ()):
+        self._videos = videos
+        self._matrices = {
+            title: VideoMatrix(title, video, export_path, variables)
+            for title, video in videos.items() if 'matrix' in video
+        }
+        self._matrix_titles: Optional[Dict[str, VideoMatrix]] = None
+        self._matrix_videos: Dict[str, dict] = {}
+        self._export_path = export_path
+        self._variables = variables
+        self._shards = shards
+        self._indexed_shards: List[ConfigShard] = []
+        self._shard_titles: Dict[str, ConfigShard] = {}
+        self._shard_matrices: List[Tuple[Pattern, ConfigShard]] = []
+        self._shard_videos: Dict[str, VideoDefinitions] = {}
+
+    def _get_matrix_titles(self) -> Dict[str, VideoMatrix]:
+        if self._matrix_titles is None:
+            matrix_titles = {}
+            for matrix in self._matrices.values():
+                for title in matrix.get_titles():
+                    if title in matrix_titles or self._is_plain_video(title):
+                        raise VideoConfigError(f'video {title} is defined more than once')
+                    matrix_titles[title] = matrix
+            self._matrix_titles = matrix_titles
+        return self._matrix_titles
+
+    def _is_plain_video(self, title: str) -> bool:
+        return title in self._videos and title not in self._matrices
+
+    def _is_own_video(self, title: str) -> bool:
+        return self._is_plain_video(title) or (bool(self._matrices) and title in self._get_matrix_titles())
+
+    def _index_next_shard(self) -> ConfigShard:
+        # the titles of a shard come from its parse cache, the shard is not loaded
+        shard = self._shards[len(self._indexed_shards)]
+        for title in shard.get_titles():
+            if _parameter.search(title):
+                self._shard_matrices.append((get_title_pattern(title), shard))
+            elif title in self._shard_titles or self._is_own_video(title):
+                raise VideoConfigError(f'video {title} is defined more than once')
+            else:
+                self._shard_titles[title] = shard
+        self._indexed_shards.append(shard)
+        return shard
+
+    def _load_shard(self, shard: ConfigShard) -> 'VideoDefinitions':
+        path = shard.get_path()
+        if path not in self._shard_videos:
+            videos = VideoDefinitions(shard.get_videos(), self._export_path, self._variables)
+            self._shard_videos[path] = videos
+            # videos of its matrices can't be known before the shard is loaded
+            for title in videos.get_matrix_titles():
+                if self._is_own_video(title) or self._shard_titles.get(title, shard) is not shard or any(
+                        title in other for other_path, other in self._shard_videos.items() if other_path != path):
+                    raise VideoConfigError(f'video {title} is defined more than once')
+        return self._shard_videos[path]
+
+    def _find_in_shard_matrices(self, title: str,
+                                matrices: List[Tuple[Pattern, ConfigShard]]) -> Optional['VideoDefinitions']:
+        for pattern, shard in matrices:
+            if pattern.fullmatch(title):
+                videos = self._load_shard(shard)
+                if title in videos:
+                    return videos
+        return None
+
+    def _find_shard_videos(self, title: str) -> Optional['VideoDefinitions']:
+        # shards are indexed in the order they are included, until one defines the video
+        if title in self._shard_titles:
+            return self._load_shard(self._shard_titles[title])
+        videos = self._find_in_shard_matrices(title, self._shard_matrices)
+        while videos is None and len(self._indexed_shards) < len(self._shards):
+            matrix_count = len(self._shard_matrices)
+            shard = self._index_next_shard()
+            if title in self._shard_titles:
+                return self._load_shard(shard)
+            videos = self._find_in_shard_matrices(title, self._shard_matrices[matrix_count:])
+        return videos
+
+    def __getitem__(self, title: str) -> dict:
+        if self._is_plain_video(title):
+            return self._videos[title]
+        if title not in self._matrix_videos:
+            matrix = self._get_matrix_titles().get(title) if self._matrices else None
+            if matrix is None:
+                shard_videos = self._find_shard_videos(title)
+                if shard_videos is None:
+                    raise KeyError(title)
+                return shard_videos[title]
+            self._matrix_videos[title] = matrix.get_video(title)
+        return self._matrix_videos[title]
+
+    def __contains__(self, title) -> bool:
+        return self._is_own_video(title) or self._find_shard_videos(title) is not None
+
+    def _iter_own_titles(self) -> Iterator[str]:
+        # videos of a matrix take its place in the order videos are declared in
+        if self._matrices:
+            self._get_matrix_titles()
+        for title in self._videos:
+            if title in self._matrices:
+                yield from self._matrices[title].get_titles()
+            else:
+                yield title
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._iter_own_titles()
+        while len(self._indexed_shards) < len(self._shards):
+            self._index_next_shard()
+        for shard in self._shards:
+            # only shards with a matrix have to be loaded to list their videos
+            if shard.get_path() in self._shard_videos or any(_parameter.search(title) for title in shard.get_titles()):
+                yield from self._load_shard(shard)
+            else:
+                yield from shard.get_titles()
+
+    def __len__(self) -> int:
+        if self._shards:
+            return sum(1 for _ in self)
+        return len(self._videos) - len(self._matrices) + len(self._get_matrix_titles() if self._matrices else {})
+
+    def get_matrix_titles(self) -> List[str]:
+        return [*self._get_matrix_titles()] if self._matrices else []
+
+    # videos which don't need any shard to be loaded, and those of loaded shards
+    def get_loaded_titles(self) -> List[str]:
+        loaded_shards = [self._shard_videos[shard.get_path()] for shard in self._shards
+                         if shard.get_path() in self._shard_videos]
+        return [*self._iter_own_titles(), *(title for videos in loaded_shards for title in videos)]
+
+    def get_glob_matches(self) -> Dict[str, List[str]]:
+        glob_matches = {pattern: matches for matrix in self._matrices.values()
+                        for pattern, matches in matrix.get_glob_matches().items()}
+        for videos in self._shard_videos.values():
+            glob_matches.update(videos.get_glob_matches())
+        return glob_matches
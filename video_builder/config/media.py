@@ -0,0 +1,86 @@
+from fractions import Fraction
+from typing import List, Optional, Tuple, final
+
+# the stream details bash_code.stream_signature compares
+stream_signature_keys = [
+    'codec_type', 'codec_name', 'profile', 'width', 'height', 'pix_fmt', 'r_frame_rate', 'time_base', 'sample_rate',
+    'channel_layout',
+]
+
+
+def parse_time(value: str) -> float:
+    # ffmpeg durations are either seconds or [HH:]MM:SS[.m...]
+    seconds = 0.0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+# stream and format data of a source file as reported by ffprobe
+@final
+class MediaInfo:
+    def __init__(self, probe: dict):
+        self._probe = probe
+
+    def get_probe(self) -> dict:
+        return self._probe
+
+    def get_streams(self) -> List[dict]:
+        return self._probe.get('streams', [])
+
+    def get_format(self) -> dict:
+        return self._probe.get('format', {})
+
+    def get_stream(self, codec_type: str) -> Optional[dict]:
+        streams = [stream for stream in self.get_streams() if stream.get('codec_type') == codec_type]
+        return streams[0] if streams else None
+
+    def get_codec(self, codec_type: str) -> Optional[str]:
+        stream = self.get_stream(codec_type)
+        return stream.get('codec_name') if stream else None
+
+    def get_resolution(self) -> Optional[Tuple[int, int]]:
+        stream = self.get_stream('video')
+        if not stream or 'width' not in stream or 'height' not in stream:
+            return None
+        return int(stream['width']), int(stream['height'])
+
+    def get_frame_rate(self) -> Optional[Fraction]:
+        stream = self.get_stream('video')
+        try:
+            rate = Fraction(stream['avg_frame_rate']) if stream else None
+        except (KeyError, ValueError, ZeroDivisionError):
+            return None
+        return rate or None
+
+    def get_audio_layout(self) -> Optional[str]:
+        stream = self.get_stream('audio')
+        return stream.get('channel_layout') if stream else None
+
+    # streams with equal signatures can be concatenated without re-encoding
+    def get_stream_signature(self) -> Tuple[Tuple[str, ...], ...]:
+        return tuple(
+            tuple(str(stream.get(key, '')) for key in stream_signature_keys)
+            for stream in self.get_streams()
+        )
+
+    def get_duration(self) -> Optional[float]:
+        try:
+            return float(self.get_format()['duration'])
+        except (KeyError, ValueError):
+            return None
+
+
+# looks up the media info of source files, relative to the export directory
+class MediaProber:
+    # starts probing the files in the background
+    def prefetch(self, paths: List[str]) -> None:
+        raise NotImplementedError()
+
+    # None for inputs which aren't files or couldn't be probed
+    def probe(self, path: str) -> Optional[MediaInfo]:
+        raise NotImplementedError()
+
+    # stops probing, files which aren't being probed yet never are
+    def close(self) -> None:
+        raise NotImplementedError()
@@ -1,5 +1,13 @@
+import re
 from abc import ABC
-from typing import List, Dict, final
+from typing import List, Dict, Callable, final
+
+from bash_writer.builders import FFmpegOptionBuilder, has_filter_options
+from config.chunks import get_chunk_options
+from config.config import VideoConfigError, get_video_file_name
+from config.profiles import IntermediateProfile
+from config.streams import get_mux_options, get_stream_options
+from config.variables import VariableResolver
 
 
 class VideoConfigListPreprocessor:
@@ -13,7 +21,8 @@ class VideoConfigListPreprocessor:
 @final
 class VideoConfigTitleAdder(VideoConfigListPreprocessor):
     def process_one(self, title: str, config: dict) -> dict:
-        return {**config, **{'title': title}}
+        config['title'] = title
+        return config
 
 
 @final
@@ -22,7 +31,19 @@ class VideoConfigScriptDirAdder(VideoConfigListPreprocessor):
         self._script_dir = script_dir
 
     def process_one(self, title: str, config: dict) -> dict:
-        return {**config, **{'script_dir': self._script_dir}}
+        config['script_dir'] = self._script_dir
+        return config
+
+
+@final
+class VideoConfigNamespaceAdder(VideoConfigListPreprocessor):
+    def __init__(self, namespace: str):
+        self._namespace = namespace
+
+    def process_one(self, title: str, config: dict) -> dict:
+        if self._namespace:
+            config['namespace'] = self._namespace
+        return config
 
 
 class VideoConfigVariablePreprocessor(VideoConfigListPreprocessor, ABC):
@@ -33,7 +54,7 @@ class VideoConfigVariablePreprocessor(VideoConfigListPreprocessor, ABC):
 @final
 class VideoConfigVariableAppender(VideoConfigVariablePreprocessor):
     def process_one(self, title: str, config: dict) -> dict:
-        config['variables'] = {**config.get('variables', {}), **self._variables}
+        config.setdefault('variables', {}).update(self._variables)
         return config
 
 
@@ -61,43 +82,184 @@ class VideoConfigReferenceReplacer(VideoConfigListPreprocessor, ABC):
 
 @final
 class VideoConfigVariableReferenceReplacer(VideoConfigReferenceReplacer):
-    @staticmethod
-    def _replace_reference(reference_name: str, reference_value: str, items: dict) -> dict:
-        for variable_name, variable_value in items.items():
-            items[variable_name] = str(variable_value).replace(reference_name, reference_value)
-        return items
+    def __init__(self, reference_map: Dict[str, str]):
+        super().__init__(reference_map)
+        # all references are replaced in a single scan of every variable
+        self._references = re.compile('|'.join(map(re.escape, reference_map))) if reference_map else None
+
+    def _replace_references(self, value) -> str:
+        value = str(value)
+        if self._references is None:
+            return value
+        return self._references.sub(lambda match: self._reference_map[match.group()], value)
 
     def process_one(self, title: str, config: dict) -> dict:
-        if config.get('variables', False):
-            for reference_name, reference_value in self._reference_map.items():
-                config['variables'] = self._replace_reference(reference_name, reference_value, config['variables'])
+        variables = config.get('variables')
+        if variables:
+            for name, value in variables.items():
+                variables[name] = self._replace_references(value)
         return config
 
 
 @final
 class VideoConfigOptionReferenceReplacer(VideoConfigReferenceReplacer):
+    def __init__(self, reference_map: Dict[str, str]):
+        super().__init__(reference_map)
+        # templates are split into options once for all videos
+        self._template_options = {name: text.splitlines(keepends=False) for name, text in reference_map.items()}
+
+    def process_one(self, title: str, config: dict) -> dict:
+        config['options'] = self._replace_template_names_with_options(config['options'])
+        return config
+
+    def _replace_template_names_with_options(self, option_list: List[str]) -> List[str]:
+        return [
+            option
+            for name in option_list
+            for option in (self._template_options.get(name, [name]) if isinstance(name, str) else [name])
+        ]
+
+
+@final
+class VideoConfigIntermediateProfileAdder(VideoConfigListPreprocessor):
+    def __init__(self, video_profiles: Dict[str, IntermediateProfile]):
+        self._video_profiles = video_profiles
+
+    def process_one(self, title: str, config: dict) -> dict:
+        profile = self._video_profiles.get(title)
+        # muxed videos only copy the streams of their parts
+        if profile is None or config.get('mux'):
+            return config
+        if config.get('combine'):
+            # combinations of parts encoded with the profile are always stream copied
+            if has_filter_options(FFmpegOptionBuilder(config.get('options', [])).build()):
+                raise VideoConfigError(f'{title} uses an intermediate profile, its parts can\'t be filtered when joined')
+            config['intermediate_profile'] = profile.get_name()
+            return config
+        config['options'] = [*config.get('options', []), *profile.get_options()]
+        return config
+
+
+@final
+class VideoConfigOutputOptionAppender(VideoConfigListPreprocessor):
+    def __init__(self, options: List[str]):
+        self._options = options
+
     def process_one(self, title: str, config: dict) -> dict:
-        config['options'] = self._replace_template_names_with_options(config['options'], self._reference_map)
+        # combinations and muxed videos only join their parts, which already got the options
+        if self._options and not config.get('combine') and not config.get('mux'):
+            config['options'] = [*config.get('options', []), *self._options]
         return config
 
-    @classmethod
-    def _replace_template_names_with_options(cls, option_list: List[str], templates: Dict[str, str]) -> List[str]:
-        replaced = []
-        for name in option_list:
-            options = cls._get_option_or_template_options_list(name, templates)
-            replaced = [*replaced, *options]
-        return replaced
-
-    @staticmethod
-    def _get_template_options_for_template_name(template_name: str, templates: Dict[str, str]) -> List[str]:
-        option_text = templates[template_name]
-        split_options = option_text.splitlines(keepends=False)
-        return split_options
-
-    @classmethod
-    def _get_option_or_template_options_list(cls, option: str, templates: Dict[str, str]) -> List[str]:
-        if option in templates:
-            preset_options = cls._get_template_options_for_template_name(option, templates)
-            return preset_options
-        else:
-            return [option]
+
+@final
+class VideoConfigRenderRateAdder(VideoConfigListPreprocessor):
+    # the video filter with the fps filter it may start with
+    _video_filter = re.compile(r'(^|\s)(-vf|-filter:v)(\s+)(["\']?)(fps=[^,"\'\s]*,)?')
+    _frame_rate_option = re.compile(r'(^|\s)-r\s')
+    # filters which aren't quoted end at the next space
+    _value_end = re.compile(r'\s|$')
+
+    def _get_render_rate(self, title: str, config: dict) -> str:
+        rate = config['render_fps']
+        if config.get('combine'):
+            raise VideoConfigError(f'{title} combines other videos, only single videos can be rendered at render_fps')
+        if isinstance(rate, bool) or (isinstance(rate, (int, float)) and rate <= 0):
+            raise VideoConfigError(f'{title} needs a positive render_fps')
+        return str(rate)
+
+    # the filters see each rendered frame a microsecond after the time it stands for, like the frames which follow
+    # it at the full rate, and the fps filter after them gives the frames back their times and durations
+    def _render_at_rate(self, title: str, options: list, rate: str) -> list:
+        options = list(options)
+        for index, option in enumerate(options):
+            match = self._video_filter.search(option) if isinstance(option, str) else None
+            if match is None:
+                continue
+            start = f'fps={rate},settb=AVTB,setpts=PTS+1,'
+            options[index] = option[:match.end(4)] + start + option[match.end():]
+            self._end_filter(title, options, index, match.end(4) + len(start), match[4], f',fps={rate}')
+        return options
+
+    # a quoted filter may go on over the lines which follow it, like those of a multi-line template
+    def _end_filter(self, title: str, options: list, index: int, position: int, quote: str, end: str) -> None:
+        for line in range(index, len(options)):
+            option = options[line]
+            if not isinstance(option, str):
+                break
+            start = position if line == index else 0
+            close = option.find(quote, start) if quote else self._value_end.search(option, start).start()
+            if close != -1:
+                options[line] = option[:close] + end + option[close:]
+                return
+        raise VideoConfigError(f'{title} has a "-vf" video filter without its closing {quote}')
+
+    def process_one(self, title: str, config: dict) -> dict:
+        if 'render_fps' not in config:
+            return config
+        # the filters only run for frames at the rate their output changes at,
+        # the frames are repeated up to the output frame rate when encoding
+        rate = self._get_render_rate(title, config)
+        options = [option for option in config.get('options', []) if isinstance(option, str)]
+        if not any(self._frame_rate_option.search(option) for option in options):
+            raise VideoConfigError(f'{title} needs an output frame rate "-r" to be rendered at render_fps')
+        if not any(self._video_filter.search(option) for option in options):
+            raise VideoConfigError(f'{title} needs a "-vf" video filter to be rendered at render_fps')
+
+        config['options'] = self._render_at_rate(title, config.get('options', []), rate)
+        return config
+
+
+@final
+class VideoConfigChunkOptionAdder(VideoConfigListPreprocessor):
+    def process_one(self, title: str, config: dict) -> dict:
+        if 'chunk' not in config:
+            return config
+        index, count = config['chunk']
+        options, variables = get_chunk_options(title, config.get('options', []), config.get('variables', {}), index,
+                                               count)
+        config['options'] = options
+        config['variables'] = {**config.get('variables', {}), **variables}
+        return config
+
+
+@final
+class VideoConfigStreamOptionAdder(VideoConfigListPreprocessor):
+    def process_one(self, title: str, config: dict) -> dict:
+        if 'stream' in config:
+            config['options'] = get_stream_options(title, config.get('options', []), config.get('variables', {}),
+                                                   config['stream'])
+        elif config.get('mux'):
+            part_files = [get_video_file_name(part, config.get('namespace', '')) for part in config['mux']]
+            config['options'] = [*config.get('options', []), *get_mux_options(part_files)]
+        return config
+
+
+@final
+class VideoConfigInputFingerprintAdder(VideoConfigListPreprocessor):
+    _input_option = re.compile(r'(^|\s)-i\s')
+
+    def __init__(self, fingerprint_inputs: Callable[[List[str]], str]):
+        self._fingerprint_inputs = fingerprint_inputs
+
+    def _get_inputs(self, title: str, config: dict) -> List[str]:
+        variables = {name: str(value).replace('{video_title}', title) for name, value in config['variables'].items()}
+        resolver = VariableResolver(variables)
+
+        # only options passing inputs are resolved, other variables may run commands
+        input_lines = [
+            line for line in FFmpegOptionBuilder(config.get('options', [])).build().splitlines()
+            if self._input_option.search(line)
+        ]
+        arguments = [argument for line in input_lines for argument in resolver.split(line.rstrip(' \\'))]
+        return [arguments[index + 1] for index, argument in enumerate(arguments[:-1]) if argument == '-i']
+
+    def process_one(self, title: str, config: dict) -> dict:
+        # the parts of combined and muxed videos are fingerprinted as videos of their own
+        if config.get('combine') or config.get('mux'):
+            return config
+        # changed inputs change the script and so the videos md5
+        inputs = self._get_inputs(title, config)
+        config['variables'] = {**config.get('variables', {}), 'input_md5': self._fingerprint_inputs(inputs)}
+        config['inputs'] = inputs
+        return config
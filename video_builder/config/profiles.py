@@ -0,0 +1,80 @@
+from typing import Dict, List, final
+
+from config.config import Config, VideoConfigError
+
+
+# encoding settings shared by all parts of a combined video, so the parts can
+# always be joined by copying their streams
+@final
+class IntermediateProfile:
+    _setting_options = {
+        'video_codec': '-c:v {}',
+        'video_profile': '-profile:v {}',
+        'pixel_format': '-pix_fmt {}',
+        'resolution': '-s {}',
+        'aspect': '-aspect {}',
+        'fps': '-r {}',
+        'audio_codec': '-c:a {}',
+        'sample_rate': '-ar {}',
+        'channel_layout': '-channel_layout {}',
+    }
+
+    def __init__(self, name: str, settings: dict):
+        unknown = [key for key in settings if key not in (*self._setting_options, 'keyframe_interval', 'options')]
+        if unknown:
+            raise VideoConfigError(f'unknown intermediate profile settings {", ".join(unknown)} in "{name}"')
+        self._name = name
+        self._settings = settings
+
+    def get_name(self) -> str:
+        return self._name
+
+    def _get_keyframe_options(self) -> List[str]:
+        # closed groups of pictures of a fixed length, every part starts with
+        # a keyframe of its own
+        interval = self._settings.get('keyframe_interval')
+        options = ['-flags +cgop']
+        if interval is not None:
+            options += [f'-g {interval}', f'-keyint_min {interval}', '-sc_threshold 0']
+        return options
+
+    def get_options(self) -> List[str]:
+        options = [
+            template.format(self._settings[setting])
+            for setting, template in self._setting_options.items()
+            if setting in self._settings
+        ]
+        return [*options, *self._get_keyframe_options(), *self._settings.get('options', [])]
+
+
+def get_intermediate_profiles(config: Config) -> Dict[str, IntermediateProfile]:
+    return {name: IntermediateProfile(name, settings) for name, settings in config.get_intermediate_profiles().items()}
+
+
+def get_video_profiles(config: Config, loaded_only: bool = False) -> Dict[str, IntermediateProfile]:
+    # maps combinations using an intermediate profile and all videos they are
+    # made of, directly or through other combinations, to the profile. Only
+    # combinations of included shards which are loaded already count, if asked.
+    profiles = get_intermediate_profiles(config)
+    videos = config.get_videos()
+    video_profiles: Dict[str, IntermediateProfile] = {}
+
+    def assign(title: str, profile: IntermediateProfile) -> None:
+        if video_profiles.get(title, profile) is not profile:
+            raise VideoConfigError(f'{title} is combined with different intermediate profiles')
+        if title in video_profiles or title not in videos:
+            return
+
+        video_profiles[title] = profile
+        for part in [*videos[title].get('combine', []), *videos[title].get('mux', [])]:
+            assign(part, profile)
+
+    for video_title in videos.get_loaded_titles() if loaded_only else videos:
+        name = videos[video_title].get('intermediate_profile')
+        if name is None:
+            continue
+        if name not in profiles:
+            raise VideoConfigError(f'{video_title} uses unknown intermediate profile "{name}"')
+        assign(video_title, profiles[name])
+
+    return video_profiles
@@ -0,0 +1,165 @@
+import os
+import re
+from typing import Dict, List, Optional
+
+from config.chunks import get_option_text
+from config.errors import VideoConfigError
+from config.variables import VariableResolver
+
+streams = ('video', 'audio')
+
+_input_option = re.compile(r'(^|\s)-i\s+(\S+)')
+_option_name = re.compile(r'^\s*(-[\w:-]+)')
+
+# options applying to the whole command, whichever input they are next to
+_global_options = {
+    '-y', '-n', '-v', '-loglevel', '-hide_banner', '-stats', '-nostats', '-nostdin', '-benchmark', '-report',
+    '-filter_threads', '-progress',
+}
+_stream_options = {
+    'video': {
+        '-vf', '-filter:v', '-c:v', '-codec:v', '-vcodec', '-b:v', '-r', '-s', '-pix_fmt', '-aspect', '-profile:v',
+        '-level', '-g', '-keyint_min', '-sc_threshold', '-preset', '-crf', '-tune', '-bf', '-flags', '-x264-params',
+        '-x265-params', '-vsync', '-fps_mode', '-frames:v', '-vframes', '-vn',
+    },
+    'audio': {
+        '-af', '-filter:a', '-c:a', '-codec:a', '-acodec', '-b:a', '-ar', '-ac', '-channel_layout', '-aq', '-q:a',
+        '-sample_fmt', '-an',
+    },
+}
+_audio_sources = ('anullsrc', 'sine', 'aevalsrc', 'anoisesrc')
+_audio_extensions = {'.mp3', '.wav', '.aac', '.flac', '.m4a', '.ogg', '.opus', '.wma'}
+_image_extensions = {'.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp', '.tif', '.tiff'}
+
+
+def get_stream_title(title: str, stream: str) -> str:
+    return f'{title}_{stream}'
+
+
+def expand_split_videos(videos: Dict[str, dict]) -> Dict[str, dict]:
+    # a video with split streams becomes a video for each stream and a video
+    # muxing both of them, which only copies their streams
+    expanded = {}
+    for title, video in videos.items():
+        if 'matrix' in video or not video.get('split_streams'):
+            expanded[title] = video
+            continue
+        if video.get('combine'):
+            raise VideoConfigError(f'{title} combines other videos, only single videos can split their streams')
+        if video.get('chunks', 1) != 1:
+            raise VideoConfigError(f'{title} is encoded in chunks, its streams can\'t be split as well')
+
+        video = {key: value for key, value in video.items() if key != 'split_streams'}
+        # variables keep referring to the whole video, only the output differs
+        variables = {
+            name: str(value).replace('{video_title}', title)
+            for name, value in video.get('variables', {}).items()
+        }
+        stream_titles = [get_stream_title(title, stream) for stream in streams]
+        for stream, stream_title in zip(streams, stream_titles):
+            if stream_title in videos:
+                raise VideoConfigError(f'video {stream_title} is defined more than once')
+            expanded[stream_title] = {**video, 'variables': variables, 'stream': stream}
+        expanded[title] = {'mux': stream_titles}
+
+    return expanded
+
+
+def _get_option_name(option: str) -> Optional[str]:
+    # options are told apart by the first option of their line
+    match = _option_name.match(option)
+    return match.group(1) if match else None
+
+
+def _get_option_stream(option: str) -> Optional[str]:
+    name = _get_option_name(option)
+    return next((stream for stream, names in _stream_options.items() if name in names), None)
+
+
+def _is_quote_open(text: str) -> bool:
+    # whether the text ends within a quote, as bash reads it
+    quote = None
+    position = 0
+    while position < len(text):
+        char = text[position]
+        if char == '\\' and quote != "'":
+            position += 1
+        elif char in '"\'' and quote in (None, char):
+            quote = None if quote else char
+        position += 1
+    return quote is not None
+
+
+def _join_option_lines(options: List[str]) -> List[List[str]]:
+    # lines of multi-line templates without an option of their own, or within
+    # a quote, belong to the option they go on from
+    joined = []
+    for option in options:
+        if joined and (_get_option_name(option) is None or _is_quote_open('\n'.join(joined[-1]))):
+            joined[-1].append(option)
+        else:
+            joined.append([option])
+    return joined
+
+
+def _get_input_stream(input_options: List[str], source: str, resolver: VariableResolver) -> Optional[str]:
+    # the stream of an input follows from its source, None for inputs with both
+    options = ' '.join(input_options)
+    source = resolver.expand(source)
+    if re.search(r'(^|\s)-f\s+lavfi(\s|$)', options):
+        return 'audio' if source.startswith(_audio_sources) else 'video'
+    if re.search(r'(^|\s)-loop\s+1(\s|$)', options):
+        return 'video'
+    extension = os.path.splitext(source)[1].lower()
+    if extension in _audio_extensions:
+        return 'audio'
+    if extension in _image_extensions:
+        return 'video'
+    return None
+
+
+def get_stream_options(title: str, options: list, variables: Dict[str, str], stream: str) -> List[str]:
+    # keeps the inputs and output options of one stream, the other stream is
+    # left out so changing it doesn't change this one
+    options = [get_option_text(option) for option in options]
+    if any(re.search(r'(^|\s)-(map|filter_complex|lavfi)(\s|$)', option) for option in options):
+        raise VideoConfigError(f'{title} maps or filters inputs together, its streams can\'t be split')
+
+    resolver = VariableResolver(variables, run_commands=False)
+    stream_options = []
+    input_options = []
+    has_input = False
+    dropped_duration = False
+    for lines in _join_option_lines(options):
+        option = '\n'.join(lines)
+        match = _input_option.search(option)
+        if match is None and _get_option_name(option) in _global_options:
+            stream_options += lines
+        elif match is None:
+            input_options.append(lines)
+        elif _get_input_stream([*map('\n'.join, input_options), option[:match.start()]], match.group(2).strip('"\''),
+                               resolver) in (None, stream):
+            stream_options += [line for kept_lines in [*input_options, lines] for line in kept_lines]
+            input_options = []
+            has_input = True
+        else:
+            dropped_duration = dropped_duration or any(
+                _get_option_name(dropped_lines[0]) == '-t' for dropped_lines in [*input_options, lines]
+            )
+            input_options = []
+
+    # options after the last input are output options
+    output_options = [
+        line for lines in input_options if _get_option_stream(lines[0]) in (None, stream) for line in lines
+    ]
+    if not has_input:
+        raise VideoConfigError(f'{title} has no {stream} input to encode apart')
+    if dropped_duration and not any(_get_option_name(option) == '-t' for option in output_options):
+        # the stream may only have ended with the input left out
+        raise VideoConfigError(f'{title} needs a "-t" duration after its inputs to split its streams')
+    return [*stream_options, *output_options, '-an' if stream == 'video' else '-vn']
+
+
+def get_mux_options(part_files: List[str]) -> List[str]:
+    video_file, audio_file = part_files
+    return [f'-i {video_file}', f'-i {audio_file}', '-map 0:v', '-map 1:a', '-c copy']
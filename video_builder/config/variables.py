@@ -0,0 +1,360 @@
+import os
+import re
+import shlex
+import subprocess
+from typing import Collection, Dict, List, Optional, Callable, Tuple, Union, final
+
+from config.errors import VideoConfigError
+
+_name = re.compile(r'[A-Za-z_]\w*')
+_word = re.compile(r'\w+')
+_reference = re.compile(r'\$\{?([A-Za-z_]\w*)')
+_special_characters = re.compile(r'[$\'"\\]')
+# runs of characters without any special meaning
+_unquoted_text = re.compile(r'[^$\'"\\]+')
+_unquoted_word = re.compile(r'[^$\'"\\\s]+')
+_double_quoted_text = re.compile(r'[^$"\\]+')
+
+
+def _find_closing_parenthesis(text: str, start: int) -> int:
+    depth = 0
+    quote = None
+    position = start
+    while position < len(text):
+        char = text[position]
+        if quote:
+            if char == '\\' and quote == '"':
+                position += 1
+            elif char == quote:
+                quote = None
+        elif char in '\'"':
+            quote = char
+        elif char == '\\':
+            position += 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                return position
+        position += 1
+    raise VideoConfigError(f'unterminated command substitution in "{text}"')
+
+
+# expands variable references, command substitutions and quotes of bash words
+# the same way bash does when running the generated scripts
+@final
+class BashWordExpander:
+    def __init__(self, lookup: Callable[[str], str], substitute: Callable[[str], str]):
+        self._lookup = lookup
+        self._substitute = substitute
+
+    def _read_expansion(self, text: str, position: int) -> Tuple[Optional[str], int]:
+        # position points at "$", returns the expanded value and the next position
+        following = text[position + 1:position + 2]
+
+        if following == '(':
+            end = _find_closing_parenthesis(text, position + 1)
+            return self._substitute(text[position:end + 1]), end + 1
+
+        if following == '{':
+            end = text.find('}', position)
+            if end < 0:
+                raise VideoConfigError(f'unterminated variable reference in "{text}"')
+            return self._lookup(text[position + 2:end]), end + 1
+
+        match = _name.match(text, position + 1)
+        if match:
+            return self._lookup(match.group()), match.end()
+
+        if following.isdigit():
+            return self._lookup(following), position + 2
+
+        return None, position + 1
+
+    def _read_double_quoted(self, text: str, position: int) -> Tuple[str, int]:
+        # position points right after the opening quote
+        value = ''
+        while position < len(text):
+            char = text[position]
+            if char == '"':
+                return value, position + 1
+            if char == '\\' and text[position + 1:position + 2] in ('$', '`', '"', '\\', '\n'):
+                if text[position + 1] != '\n':
+                    value += text[position + 1]
+                position += 2
+            elif char == '$':
+                expanded, position = self._read_expansion(text, position)
+                value += '$' if expanded is None else expanded
+            else:
+                # backslashes which don't escape anything are kept
+                match = _double_quoted_text.match(text, position)
+                end = match.end() if match else position + 1
+                value += text[position:end]
+                position = end
+        raise VideoConfigError(f'unterminated quote in "{text}"')
+
+    def _expand(self, text: str, split: bool) -> List[str]:
+        words = []
+        word = None
+        position = 0
+
+        def append(value: str) -> None:
+            nonlocal word
+            word = (word or '') + value
+
+        def finish() -> None:
+            nonlocal word
+            if word is not None:
+                words.append(word)
+            word = None
+
+        while position < len(text):
+            char = text[position]
+            if char.isspace() and split:
+                finish()
+                position += 1
+            elif char == "'":
+                end = text.find("'", position + 1)
+                if end < 0:
+                    raise VideoConfigError(f'unterminated quote in "{text}"')
+                append(text[position + 1:end])
+                position = end + 1
+            elif char == '"':
+                value, position = self._read_double_quoted(text, position + 1)
+                append(value)
+            elif char == '\\':
+                if text[position + 1:position + 2] != '\n':
+                    append(text[position + 1:position + 2])
+                position += 2
+            elif char == '$':
+                expanded, position = self._read_expansion(text, position)
+                if expanded is None:
+                    append('$')
+                elif not split:
+                    append(expanded)
+                else:
+                    # unquoted expansions are split into separate words
+                    if expanded[:1].isspace():
+                        finish()
+                    for index, fragment in enumerate(expanded.split()):
+                        if index > 0:
+                            finish()
+                        append(fragment)
+                    if expanded[-1:].isspace():
+                        finish()
+            else:
+                end = (_unquoted_word if split else _unquoted_text).match(text, position).end()
+                append(text[position:end])
+                position = end
+
+        finish()
+        return words
+
+    # most words are plain text, without anything to expand
+    @staticmethod
+    def _is_plain(text: str) -> bool:
+        return _special_characters.search(text) is None
+
+    def split(self, text: str) -> List[str]:
+        return text.split() if self._is_plain(text) else self._expand(text, split=True)
+
+    def expand(self, text: str) -> str:
+        return text if self._is_plain(text) else ''.join(self._expand(text, split=False))
+
+
+@final
+class _ArithmeticParser:
+    def __init__(self, tokens: List[Union[int, str]], lookup: Callable[[str], str]):
+        self._tokens = tokens
+        self._lookup = lookup
+        self._position = 0
+
+    def _peek(self) -> Union[int, str, None]:
+        return self._tokens[self._position] if self._position < len(self._tokens) else None
+
+    def _next(self) -> Union[int, str, None]:
+        token = self._peek()
+        self._position += 1
+        return token
+
+    def parse(self) -> int:
+        value = self._parse_sum()
+        if self._peek() is not None:
+            raise ValueError(f'unexpected "{self._peek()}"')
+        return value
+
+    def _parse_sum(self) -> int:
+        value = self._parse_product()
+        while self._peek() in ('+', '-'):
+            value = value + self._parse_product() if self._next() == '+' else value - self._parse_product()
+        return value
+
+    def _parse_product(self) -> int:
+        value = self._parse_factor()
+        while self._peek() in ('*', '/', '%'):
+            operator = self._next()
+            divisor = self._parse_factor()
+            if operator == '*':
+                value *= divisor
+                continue
+            # bash and expr round towards zero
+            quotient = abs(value) // abs(divisor)
+            quotient = quotient if (value < 0) == (divisor < 0) else -quotient
+            value = quotient if operator == '/' else value - divisor * quotient
+        return value
+
+    def _parse_factor(self) -> int:
+        token = self._next()
+        if token in ('+', '-'):
+            value = self._parse_factor()
+            return value if token == '+' else -value
+        if token == '(':
+            value = self._parse_sum()
+            if self._next() != ')':
+                raise ValueError('missing ")"')
+            return value
+        if isinstance(token, int):
+            return token
+        if isinstance(token, str) and _name.fullmatch(token):
+            return int(self._lookup(token).strip() or 0)
+        raise ValueError(f'unexpected "{token}"')
+
+
+_arithmetic_token = re.compile(r'\s*(\d+|[A-Za-z_]\w*|[-+*/%()])')
+_expr_operators = ('+', '-', '*', '/', '%', '(', ')')
+
+
+def _tokenize_arithmetic(expression: str) -> Optional[List[Union[int, str]]]:
+    tokens = []
+    position = 0
+    while expression[position:].strip():
+        match = _arithmetic_token.match(expression, position)
+        if not match:
+            return None
+        token = match.group(1)
+        tokens.append(int(token) if token.isdigit() else token)
+        position = match.end()
+    return tokens
+
+
+# evaluates the integer arithmetic of "$(( ... ))" and "$(expr ...)" without a
+# shell - sums, products, divisions and remainders with parentheses. None for
+# anything else, which is left to bash.
+def evaluate_arithmetic(code: str, expander: BashWordExpander, lookup: Callable[[str], str]) -> Optional[int]:
+    if code.startswith('$((') and code.endswith('))'):
+        tokens = _tokenize_arithmetic(expander.expand(code[3:-2]))
+    elif re.match(r'\$\(\s*expr\s', code):
+        arguments = expander.split(code[2:-1])[1:]
+        if not all(re.fullmatch(r'[-+]?\d+', argument) or argument in _expr_operators for argument in arguments):
+            return None
+        tokens = [argument if argument in _expr_operators else int(argument) for argument in arguments]
+    else:
+        return None
+
+    try:
+        return _ArithmeticParser(tokens, lookup).parse() if tokens else None
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+# resolves video variables in the order they depend on each other, whichever
+# order they are declared in. Names which aren't variables are looked up in the
+# environment. Arithmetic is evaluated natively, other command substitutions
+# run in bash unless run_commands is off. Dynamic names only get their values
+# while building (the lengths of other videos) - variables depending on them
+# can't be resolved up front and keep their bash code.
+@final
+class VariableResolver:
+    def __init__(self, variables: Dict[str, str], environment: Optional[Dict[str, str]] = None,
+                 run_commands: bool = True, dynamic: Collection[str] = ()):
+        self._values = {name: str(value) for name, value in variables.items()}
+        # the process environment is only read for names which aren't variables
+        self._environment = environment or {}
+        self._run_commands = run_commands
+        self._dynamic_names = set(dynamic) - set(environment or {})
+        self._resolved: Dict[str, str] = {}
+        self._order: List[str] = []
+        self._resolving: List[str] = []
+        self._dynamic_variables = set()
+        self._unresolved_dependencies: Dict[str, str] = {}
+
+    def _mark_dynamic(self) -> None:
+        # everything currently being resolved depends on the dynamic value
+        self._dynamic_variables.update(self._resolving)
+
+    def _is_dynamic(self, name: str) -> bool:
+        return name in self._dynamic_variables or (name not in self._values and name in self._dynamic_names)
+
+    def _lookup(self, name: str) -> str:
+        if name in self._values:
+            return self._resolve_variable(name)
+        if name in self._environment:
+            return self._environment[name]
+        if name in self._dynamic_names:
+            self._mark_dynamic()
+            return f'${name}'
+        return os.environ.get(name, '')
+
+    def _substitute(self, code: str) -> str:
+        value = evaluate_arithmetic(code, self._get_expander(), self._lookup)
+        if value is not None:
+            return str(value)
+
+        # arithmetic may name variables without "$"
+        names = _word.findall(code) if code.startswith('$((') else _reference.findall(code)
+        names = sorted({name for name in names if name in self._values or name in self._dynamic_names})
+        variables = {name: self._lookup(name) for name in names}
+        if not self._run_commands or any(self._is_dynamic(name) for name in names):
+            # the code is left to bash as it is, the values it depends on are kept for fingerprints
+            self._unresolved_dependencies.update(variables)
+            return code
+
+        process = subprocess.run(
+            ['bash', '-c', f'printf "%s" "{code}"'],
+            env={**os.environ, **self._environment, **variables},
+            stdout=subprocess.PIPE,
+            universal_newlines=True
+        )
+        return process.stdout
+
+    def _get_expander(self) -> BashWordExpander:
+        return BashWordExpander(self._lookup, self._substitute)
+
+    def _resolve_variable(self, name: str) -> str:
+        if name in self._resolving:
+            cycle = ' -> '.join([*self._resolving[self._resolving.index(name):], name])
+            raise VideoConfigError(f'circular variable reference: {cycle}')
+        if name not in self._resolved:
+            self._resolving.append(name)
+            try:
+                self._resolved[name] = self._get_expander().expand(self._values[name])
+            finally:
+                self._resolving.pop()
+            self._order.append(name)
+        if name in self._dynamic_variables:
+            self._mark_dynamic()
+        return self._resolved[name]
+
+    def resolve(self, name: str) -> str:
+        return self._lookup(name)
+
+    def expand(self, text: str) -> str:
+        return self._get_expander().expand(text)
+
+    def split(self, text: str) -> List[str]:
+        return self._get_expander().split(text)
+
+    # the values of the variables which command substitutions left to bash depend on
+    def get_unresolved_dependencies(self) -> Dict[str, str]:
+        return dict(sorted(self._unresolved_dependencies.items()))
+
+    # bash code of every variable in dependency order, resolved values are
+    # quoted so bash takes them as they are
+    def resolve_variables(self) -> Dict[str, str]:
+        for name in self._values:
+            self._resolve_variable(name)
+        return {
+            name: self._values[name] if name in self._dynamic_variables else shlex.quote(self._resolved[name])
+            for name in self._order
+        }
@@ -0,0 +1,141 @@
+import fcntl
+import os
+import shutil
+import sqlite3
+import stat
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional, final
+
+cache_index_name = 'index.sqlite'
+
+cache_schema = """\
+CREATE TABLE IF NOT EXISTS artifacts (
+    fingerprint TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    duration INTEGER,
+    last_used REAL NOT NULL
+);\
+"""
+
+# ioctl cloning a whole file on copy on write file systems (btrfs, xfs)
+_ficlone = 0x40049409
+
+
+def reflink(source: str, destination: str) -> None:
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        fcntl.ioctl(destination_file.fileno(), _ficlone, source_file.fileno())
+
+
+# returns whether the destination is a hard link of the source
+def materialize(source: str, destination: str) -> bool:
+    # prefer sharing the data of the file over copying it, reflinks are
+    # independent copies while hard links share the same file
+    for link in (reflink, os.link, shutil.copyfile):
+        try:
+            link(source, destination)
+            return link is os.link
+        except OSError:
+            if os.path.exists(destination):
+                os.unlink(destination)
+    raise OSError(f'could not materialize {source} as {destination}')
+
+
+def replace_file(source: str, destination: str) -> bool:
+    # the old file is unlinked instead of being overwritten, it may be a hard
+    # link of a cached video
+    temporary_path = f'{destination}.{os.getpid()}.tmp'
+    linked = materialize(source, temporary_path)
+    os.replace(temporary_path, destination)
+    return linked
+
+
+@final
+class CachedArtifact:
+    def __init__(self, path: str, duration: Optional[int]):
+        self._path = path
+        self._duration = duration
+
+    def get_path(self) -> str:
+        return self._path
+
+    def get_duration(self) -> Optional[int]:
+        return self._duration
+
+
+# videos shared between export directories, stored by their fingerprint. Least
+# recently used videos are evicted once the cache grows past its size limit.
+@final
+class ArtifactCache:
+    def __init__(self, path: str, size_limit: int):
+        self._path = path
+        self._size_limit = size_limit
+        os.makedirs(path, exist_ok=True)
+        with self._connect() as connection:
+            connection.executescript(cache_schema)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # several builds may use the same cache at once
+        connection = sqlite3.connect(os.path.join(self._path, cache_index_name), timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _get_artifact_path(self, fingerprint: str) -> str:
+        return os.path.join(self._path, fingerprint[:2], fingerprint + '.mp4')
+
+    def get(self, fingerprint: str) -> Optional[CachedArtifact]:
+        path = self._get_artifact_path(fingerprint)
+        with self._connect() as connection:
+            row = connection.execute('SELECT duration FROM artifacts WHERE fingerprint = ?', (fingerprint,)).fetchone()
+            if row is None or not os.path.isfile(path):
+                return None
+            connection.execute('UPDATE artifacts SET last_used = ? WHERE fingerprint = ?', (time.time(), fingerprint))
+        return CachedArtifact(path, row[0])
+
+    def restore(self, fingerprint: str, destination: str) -> Optional[CachedArtifact]:
+        artifact = self.get(fingerprint)
+        if artifact is None:
+            return None
+        try:
+            replace_file(artifact.get_path(), destination)
+        except OSError:
+            # evicted by another build in the meantime
+            return None
+        return artifact
+
+    def store(self, fingerprint: str, source: str, duration: Optional[int]) -> None:
+        path = self._get_artifact_path(fingerprint)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # copies are made read only, a hard link is the users video as well and
+        # is only protected by never writing through the links of old videos
+        if not replace_file(source, path):
+            os.chmod(path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO artifacts (fingerprint, size, duration, last_used) VALUES (?, ?, ?, ?)',
+                (fingerprint, os.path.getsize(path), duration, time.time())
+            )
+        self.evict()
+
+    def get_size(self) -> int:
+        with self._connect() as connection:
+            return connection.execute('SELECT COALESCE(SUM(size), 0) FROM artifacts').fetchone()[0]
+
+    def evict(self) -> None:
+        with self._connect() as connection:
+            rows = connection.execute('SELECT fingerprint, size FROM artifacts ORDER BY last_used DESC').fetchall()
+            kept_size = 0
+            for fingerprint, size in rows:
+                if kept_size + size <= self._size_limit:
+                    kept_size += size
+                    continue
+                connection.execute('DELETE FROM artifacts WHERE fingerprint = ?', (fingerprint,))
+                try:
+                    os.unlink(self._get_artifact_path(fingerprint))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,252 @@
+import math
+import re
+from fractions import Fraction
+from typing import List, Optional, final
+
+from bash_writer.builders import FFmpegOptionBuilder, has_filter_options, get_concat_filter, get_concat_inputs
+from config.config import VideoConfig, get_namespaced_file_name
+from config.media import parse_time
+from config.variables import VariableResolver
+
+
+def get_part_files(video: VideoConfig) -> List[str]:
+    return video.get_part_files()
+
+
+def get_concat_list(video: VideoConfig) -> str:
+    return ''.join([f"file '{part}'\n" for part in get_part_files(video)])
+
+
+def get_concat_list_file(video: VideoConfig) -> str:
+    return f'.{video.get_title()}.concat'
+
+
+# the segments of a still image video and the list joining them
+def get_still_image_files(video: VideoConfig) -> List[str]:
+    names = [f'.{video.get_title()}.still.mp4', f'.{video.get_title()}.still_end.mp4', f'.{video.get_title()}.still']
+    return [get_namespaced_file_name(name, video.get_namespace()) for name in names]
+
+
+def get_expected_duration(command: List[str]) -> Optional[float]:
+    durations = [command[index + 1] for index, argument in enumerate(command[:-1]) if argument == '-t']
+    try:
+        return parse_time(durations[-1]) if durations else None
+    except ValueError:
+        return None
+
+
+def _get_option(options: List[str], name: str) -> Optional[str]:
+    return options[options.index(name) + 1] if name in options[:-1] else None
+
+
+def _get_input_duration(options: List[str], source: str) -> Optional[float]:
+    # only looped images and generated sources without a duration of their
+    # own last until the "-t" of the input or forever
+    looped = _get_option(options, '-loop') == '1'
+    generated = _get_option(options, '-f') == 'lavfi' and not re.search(r'[=:](d|duration)=', source)
+    if not looped and not generated:
+        return None
+
+    duration = _get_option(options, '-t')
+    return math.inf if duration is None else parse_time(duration)
+
+
+def get_static_duration(command: List[str]) -> Optional[int]:
+    duration = _get_static_seconds(command)
+    return None if duration is None else int(duration)
+
+
+def _get_static_seconds(command: List[str]) -> Optional[float]:
+    # the duration of videos made of looped images and generated sources is
+    # known without looking at the encoded video
+    if any(option in command for option in ('-ss', '-to', '-frames', '-frames:v', '-vframes', '-stream_loop')):
+        return None
+
+    inputs = [index for index, argument in enumerate(command[:-1]) if argument == '-i']
+    if not inputs:
+        return None
+
+    durations = []
+    previous_end = 1
+    try:
+        for index in inputs:
+            durations.append(_get_input_duration(command[previous_end:index], command[index + 1]))
+            previous_end = index + 2
+        if None in durations:
+            return None
+
+        duration = min(durations) if '-shortest' in command[previous_end:] else max(durations)
+        output_duration = _get_option(command[previous_end:-1], '-t')
+        if output_duration is not None:
+            duration = min(duration, parse_time(output_duration))
+    except ValueError:
+        return None
+    return None if math.isinf(duration) else duration
+
+
+# seconds of a still image which are encoded once, and repeated to the full duration
+still_segment_length = 2
+
+
+def _get_last_option(options: List[str], name: str) -> Optional[str]:
+    # later output options replace earlier ones
+    return next((options[index + 1] for index in range(len(options) - 2, -1, -1) if options[index] == name), None)
+
+
+def _get_frame_rate(output_options: List[str], image_options: List[str]) -> Optional[Fraction]:
+    # the output frame rate, or the one the image is read with
+    rate = _get_last_option(output_options, '-r') or _get_option(image_options, '-framerate') or '25'
+    try:
+        return Fraction(rate)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def _without_duration_options(options: List[str]) -> List[str]:
+    return [
+        option for index, option in enumerate(options)
+        if option not in ('-t', '-shortest') and (index == 0 or options[index - 1] != '-t')
+    ]
+
+
+@final
+class StillImageEncoding:
+    def __init__(self, segment_commands: List[List[str]], segment_files: List[str], mux_command: List[str]):
+        self._segment_commands = segment_commands
+        self._segment_files = segment_files
+        self._mux_command = mux_command
+
+    # encode the distinct segments, each one only once
+    def get_segment_commands(self) -> List[List[str]]:
+        return self._segment_commands
+
+    def get_concat_list(self) -> str:
+        return ''.join([f"file '{segment}'\n" for segment in self._segment_files])
+
+    def get_mux_command(self) -> List[str]:
+        return self._mux_command
+
+
+def get_still_image_encoding(command: List[str], segment_file: str, end_file: str,
+                             concat_list_file: str) -> Optional[StillImageEncoding]:
+    # every frame of a looped image without filters is the same, so a short
+    # segment of it is encoded once and joined with itself to the full length.
+    # Silence is cheap to encode and is encoded again for the whole video.
+    if has_filter_options(' '.join(command[:-1])) or '-map' in command or '-itsoffset' in command:
+        return None
+    duration = _get_static_seconds(command)
+    inputs = [index for index, argument in enumerate(command[:-1]) if argument == '-i']
+    if duration is None or not 1 <= len(inputs) <= 2:
+        return None
+
+    image, audio = None, None
+    previous_end = 1
+    for index in inputs:
+        options = command[previous_end:index]
+        if _get_option(options, '-loop') == '1' and image is None:
+            image = options, index
+        elif _get_option(options, '-f') == 'lavfi' and command[index + 1].startswith('anullsrc') and audio is None:
+            audio = options, index
+        else:
+            return None
+        previous_end = index + 2
+    if image is None:
+        return None
+
+    output_options = command[previous_end:-1]
+    frame_rate = _get_frame_rate(output_options, image[0])
+    if frame_rate is None:
+        return None
+    segment_frames = max(1, round(frame_rate * still_segment_length))
+    segment_count, end_frames = divmod(round(frame_rate * Fraction(duration)), segment_frames)
+    if segment_count < 2:
+        return None
+
+    output_options = _without_duration_options(output_options)
+    encode_command = command[:previous_end] + output_options + ['-an', '-frames:v']
+    segment_commands = [[*encode_command, str(segment_frames), segment_file]]
+    segment_files = [segment_file] * segment_count
+    if end_frames:
+        segment_commands.append([*encode_command, str(end_frames), end_file])
+        segment_files.append(end_file)
+
+    audio_inputs = [*audio[0], '-i', command[audio[1] + 1]] if audio else []
+    mux_command = [
+        'ffmpeg',
+        '-y',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', concat_list_file,
+        *audio_inputs,
+        *output_options,
+        '-map', '0:v',
+        *(['-map', '1:a'] if audio else []),
+        '-c:v', 'copy',
+        '-t', str(float(duration)),
+        command[-1],
+    ]
+    return StillImageEncoding(segment_commands, segment_files, mux_command)
+
+
+def add_thread_options(command: List[str], threads: int) -> List[str]:
+    # explicit thread options of a video are always respected
+    global_options = []
+    if '-filter_threads' not in command:
+        global_options += ['-filter_threads', str(threads)]
+    if '-filter_complex' in command and '-filter_complex_threads' not in command:
+        global_options += ['-filter_complex_threads', str(threads)]
+
+    output_options = [] if '-threads' in command else ['-threads', str(threads)]
+    return [command[0], *global_options, *command[1:-1], *output_options, command[-1]]
+
+
+# builds the same ffmpeg command the generated bash script of a video runs
+@final
+class FFmpegCommandBuilder:
+    def __init__(self, video: VideoConfig, resolver: VariableResolver):
+        self._video = video
+        self._resolver = resolver
+
+    def get_output_file(self) -> str:
+        return self._resolver.resolve('output_file')
+
+    def _get_options(self) -> List[str]:
+        return self._resolver.split(FFmpegOptionBuilder(self._video.get_options()).build())
+
+    def _get_concat_arguments(self) -> List[str]:
+        parts = get_part_files(self._video)
+        split_parts = self._video.get_split_parts()
+        inputs = [argument for part in get_concat_inputs(parts, split_parts) for argument in ['-i', part]]
+        return [
+            '-y',
+            *inputs,
+            '-filter_complex', get_concat_filter(parts, split_parts),
+            '-map', '[v]',
+            '-map', '[a]',
+        ]
+
+    def must_stream_copy(self) -> bool:
+        return self._video.is_always_stream_copied()
+
+    def can_stream_copy(self) -> bool:
+        options = FFmpegOptionBuilder(self._video.get_options()).build()
+        return self._video.is_combination() and not has_filter_options(options)
+
+    def build(self) -> List[str]:
+        arguments = self._get_concat_arguments() if self._video.is_combination() else []
+        return ['ffmpeg', *arguments, *self._get_options(), self.get_output_file()]
+
+    def build_stream_copy(self) -> List[str]:
+        # joins the parts with the concat demuxer, like bash_code.concat_videos_copy
+        return [
+            'ffmpeg',
+            '-y',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', get_concat_list_file(self._video),
+            '-map', '0',
+            *self._get_options(),
+            '-c:v', 'copy',
+            '-c:a', 'copy',
+            self.get_output_file(),
+        ]
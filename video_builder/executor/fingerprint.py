@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, final
+
+from bash_writer.builders import get_unique_parts, split_part_max_duration
+from config.config import VideoConfig, get_video_file_name
+from config.variables import VariableResolver
+from executor.commands import FFmpegCommandBuilder, get_static_duration
+from executor.graph import VideoDependencyGraph
+from executor.manifest import BuildManifest, manifest_file_name
+
+# change whenever the commands generated for the same config change
+fingerprint_version = 3
+
+
+def get_file_digest(path: str) -> str:
+    digest = hashlib.md5()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# fingerprints the files passed to ffmpeg with "-i", file contents are only
+# hashed again when their inode, size or modification time change
+@final
+class InputFingerprinter:
+    def __init__(self, export_path: str):
+        self._export_path = export_path
+        self._manifest: Optional[BuildManifest] = None
+
+    def get_manifest(self) -> BuildManifest:
+        # only create the manifest once a file input is actually fingerprinted
+        if self._manifest is None:
+            self._manifest = BuildManifest(os.path.join(self._export_path, manifest_file_name))
+        return self._manifest
+
+    def get_digest(self, path: str) -> Optional[str]:
+        # inputs are relative to the export directory, where ffmpeg runs
+        path = os.path.realpath(os.path.join(self._export_path, path))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+
+        digest = self.get_manifest().get_input_digest(path, stat)
+        if digest is None:
+            digest = get_file_digest(path)
+            self.get_manifest().record_input_digest(path, stat, digest)
+        return digest
+
+    def get_fingerprint(self, inputs: List[str]) -> str:
+        # inputs which aren't files (e.g. lavfi sources) are fingerprinted by name
+        digests = [f'{source}:{self.get_digest(source) or ""}' for source in inputs]
+        return hashlib.md5('\n'.join(digests).encode()).hexdigest()
+
+
+# fingerprints every video from its own resolved ffmpeg command and the
+# fingerprints of the videos it depends on, so a change anywhere down a tree of
+# combined videos reaches every video above it without reading any scripts.
+# Durations which follow from the command alone are stored next to it, and the
+# variables of every video are resolved up front as far as possible.
+@final
+class VideoFingerprinter:
+    def __init__(self, graph: VideoDependencyGraph):
+        self._graph = graph
+        self._durations: Dict[str, Optional[int]] = {}
+
+    def _get_resolver(self, video: VideoConfig) -> VariableResolver:
+        # lengths of other videos are known up front if their commands tell
+        # them, the others are only known while building
+        dependencies = self._graph.get_dependencies(video.get_title())
+        lengths = {f'{title}_length': self._durations[title] for title in dependencies}
+        known = {name: str(duration) for name, duration in lengths.items() if duration is not None}
+        return VariableResolver(video.get_variables(), known, dynamic=lengths.keys())
+
+    def _get_split_parts(self, video: VideoConfig) -> List[str]:
+        # only parts known to be short are decoded once for all their uses
+        durations = {title: self._durations.get(title) for title in get_unique_parts(video.get_combine())}
+        return [
+            get_video_file_name(title, video.get_namespace()) for title, duration in durations.items()
+            if duration is not None and duration <= split_part_max_duration
+        ]
+
+    @staticmethod
+    def get_fingerprint(video: VideoConfig, command: List[str], dependency_fingerprints: List[str],
+                        unresolved_dependencies: Optional[Dict[str, str]] = None) -> str:
+        # code left to bash is in the command as it is, the values it uses are added
+        contents = [
+            fingerprint_version,
+            command,
+            unresolved_dependencies or {},
+            video.get_variables().get('input_md5', ''),
+            dependency_fingerprints,
+        ]
+        return hashlib.md5(json.dumps(contents).encode()).hexdigest()
+
+    def fingerprint(self) -> VideoDependencyGraph:
+        fingerprints: Dict[str, str] = {}
+        videos = []
+        for video in self._graph.get_videos():
+            title = video.get_title()
+            dependencies = [fingerprints[dependency] for dependency in self._graph.get_dependencies(title)]
+            if video.is_combination():
+                video = video.with_split_parts(self._get_split_parts(video))
+            resolver = self._get_resolver(video)
+            command = FFmpegCommandBuilder(video, resolver).build()
+            fingerprints[title] = self.get_fingerprint(video, command, dependencies,
+                                                       resolver.get_unresolved_dependencies())
+            self._durations[title] = get_static_duration(command)
+            videos.append(video.with_resolved_variables({
+                **resolver.resolve_variables(),
+                'fingerprint': fingerprints[title],
+                'static_duration': '' if self._durations[title] is None else str(self._durations[title]),
+            }))
+        return VideoDependencyGraph(videos)
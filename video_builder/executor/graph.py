@@ -0,0 +1,68 @@
+from typing import Dict, List, final
+
+from config.config import VideoConfig, VideoConfigError
+
+
+class VideoDependencyError(VideoConfigError):
+    pass
+
+
+@final
+class VideoDependencyGraph:
+    def __init__(self, videos: List[VideoConfig]):
+        self._videos = {video.get_title(): video for video in videos}
+        self._dependencies = {
+            title: video.get_dependencies(self._videos.keys())
+            for title, video in self._videos.items()
+        }
+        self._check_dependencies_exist()
+        self._order = self._sort_topologically()
+
+    def _check_dependencies_exist(self) -> None:
+        for title, dependencies in self._dependencies.items():
+            for dependency in dependencies:
+                if dependency not in self._videos:
+                    raise VideoDependencyError(f'{title} combines unknown video "{dependency}"')
+
+    def _sort_topologically(self) -> List[str]:
+        order = []
+        visiting = set()
+        visited = set()
+
+        def visit(title: str, path: List[str]) -> None:
+            if title in visited:
+                return
+            if title in visiting:
+                cycle = ' -> '.join([*path[path.index(title):], title])
+                raise VideoDependencyError(f'circular video dependency: {cycle}')
+
+            visiting.add(title)
+            for dependency in self._dependencies[title]:
+                visit(dependency, [*path, title])
+            visiting.remove(title)
+
+            visited.add(title)
+            order.append(title)
+
+        for video_title in self._videos:
+            visit(video_title, [])
+
+        return order
+
+    def get_video(self, title: str) -> VideoConfig:
+        return self._videos[title]
+
+    def get_videos(self) -> List[VideoConfig]:
+        return [self._videos[title] for title in self._order]
+
+    def get_titles(self) -> List[str]:
+        return [*self._order]
+
+    def get_dependencies(self, title: str) -> List[str]:
+        return self._dependencies[title]
+
+    def get_dependents(self, title: str) -> List[str]:
+        return [other for other in self._order if title in self._dependencies[other]]
+
+    def get_dependency_map(self) -> Dict[str, List[str]]:
+        return {title: self._dependencies[title] for title in self._order}
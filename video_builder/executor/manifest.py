@@ -0,0 +1,106 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+from typing import Iterator, Optional, final
+
+from manifest_schema import manifest_file_name, manifest_schema
+
+
+@final
+class ManifestEntry:
+    def __init__(self, output: str, fingerprint: str, size: int, mtime: int, duration: Optional[int]):
+        self._output = output
+        self._fingerprint = fingerprint
+        self._size = size
+        self._mtime = mtime
+        self._duration = duration
+
+    def get_output(self) -> str:
+        return self._output
+
+    def get_fingerprint(self) -> str:
+        return self._fingerprint
+
+    def get_size(self) -> int:
+        return self._size
+
+    def get_mtime(self) -> int:
+        return self._mtime
+
+    def get_duration(self) -> Optional[int]:
+        return self._duration
+
+    def matches_file(self, path: str) -> bool:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return stat.st_size == self._size and int(stat.st_mtime) == self._mtime
+
+
+# maps every video in the export directory to the fingerprint it was built
+# from, so up to date checks never have to read the video files
+@final
+class BuildManifest:
+    def __init__(self, path: str):
+        self._path = path
+        with self._connect() as connection:
+            connection.executescript(manifest_schema)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # the generated bash scripts write to the same database
+        connection = sqlite3.connect(self._path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, output: str) -> Optional[ManifestEntry]:
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT output, fingerprint, size, mtime, duration FROM outputs WHERE output = ?',
+                (output,)
+            ).fetchone()
+        return ManifestEntry(*row) if row else None
+
+    def get_up_to_date_entry(self, output: str, path: str, fingerprint: str) -> Optional[ManifestEntry]:
+        entry = self.get(output)
+        if entry is None or entry.get_fingerprint() != fingerprint or not entry.matches_file(path):
+            return None
+        return entry
+
+    def record(self, output: str, path: str, fingerprint: str, duration: Optional[int]) -> ManifestEntry:
+        stat = os.stat(path)
+        entry = ManifestEntry(output, fingerprint, stat.st_size, int(stat.st_mtime), duration)
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO outputs (output, fingerprint, size, mtime, duration) VALUES (?, ?, ?, ?, ?)',
+                (output, fingerprint, entry.get_size(), entry.get_mtime(), duration)
+            )
+        return entry
+
+    def get_input_digest(self, path: str, stat: os.stat_result) -> Optional[str]:
+        with self._connect() as connection:
+            row = connection.execute(
+                'SELECT digest FROM inputs WHERE path = ? AND inode = ? AND size = ? AND mtime = ?',
+                (path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            ).fetchone()
+        return row[0] if row else None
+
+    def record_input_digest(self, path: str, stat: os.stat_result, digest: str) -> None:
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO inputs (path, inode, size, mtime, digest) VALUES (?, ?, ?, ?, ?)',
+                (path, stat.st_ino, stat.st_size, stat.st_mtime_ns, digest)
+            )
+
+    def get_probe(self, digest: str) -> Optional[str]:
+        with self._connect() as connection:
+            row = connection.execute('SELECT probe FROM probes WHERE digest = ?', (digest,)).fetchone()
+        return row[0] if row else None
+
+    def record_probe(self, digest: str, probe: str) -> None:
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO probes (digest, probe) VALUES (?, ?)', (digest, probe))
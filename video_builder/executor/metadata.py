@@ -0,0 +1,19 @@
+import subprocess
+from typing import Optional
+
+
+def parse_duration(output: str) -> Optional[int]:
+    lines = output.strip().splitlines()
+    if lines and lines[-1].strip().isdigit():
+        return int(lines[-1].strip())
+    return None
+
+
+def probe_duration(path: str) -> Optional[int]:
+    process = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1',
+         path],
+        stdout=subprocess.PIPE,
+        universal_newlines=True
+    )
+    return parse_duration(process.stdout.split('.')[0])
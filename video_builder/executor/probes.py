@@ -0,0 +1,74 @@
+import json
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, List, Optional, final
+
+from config.media import MediaProber, MediaInfo
+from executor.fingerprint import InputFingerprinter
+
+
+def run_ffprobe(path: str) -> Optional[dict]:
+    process = subprocess.run(
+        ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_streams', '-show_format', path],
+        stdout=subprocess.PIPE,
+        universal_newlines=True
+    )
+    if process.returncode != 0:
+        return None
+    try:
+        return json.loads(process.stdout)
+    except ValueError:
+        return None
+
+
+# probes source files once per content, the results are kept in the build
+# manifest by the digest of the file so only new or changed files are probed
+@final
+class ProbeCache(MediaProber):
+    def __init__(self, export_path: str, fingerprinter: InputFingerprinter, workers: int = 4):
+        self._export_path = export_path
+        self._fingerprinter = fingerprinter
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._probes: Dict[str, Future] = {}
+
+    def _probe(self, path: str) -> Optional[MediaInfo]:
+        digest = self._fingerprinter.get_digest(path)
+        if digest is None:
+            return None
+
+        manifest = self._fingerprinter.get_manifest()
+        cached = manifest.get_probe(digest)
+        if cached is not None:
+            return MediaInfo(json.loads(cached))
+
+        try:
+            probe = run_ffprobe(os.path.realpath(os.path.join(self._export_path, path)))
+        except OSError:
+            return None
+        if probe is None:
+            return None
+        manifest.record_probe(digest, json.dumps(probe))
+        return MediaInfo(probe)
+
+    def _submit(self, path: str) -> Future:
+        with self._lock:
+            if path not in self._probes:
+                self._probes[path] = self._pool.submit(self._probe, path)
+            return self._probes[path]
+
+    def prefetch(self, paths: List[str]) -> None:
+        for path in paths:
+            self._submit(path)
+
+    def probe(self, path: str) -> Optional[MediaInfo]:
+        return self._submit(path).result()
+
+    def close(self) -> None:
+        with self._lock:
+            for future in self._probes.values():
+                future.cancel()
+        # running probes finish on their own, nothing waits for them
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,164 @@
+import json
+import os
+import subprocess
+import threading
+import time
+from typing import Dict, List, Optional, Set, final
+
+import psutil
+
+from executor.scheduler import JobAdmission
+
+
+def get_available_cores() -> int:
+    try:
+        return len(psutil.Process().cpu_affinity())
+    except (AttributeError, psutil.Error):
+        # cpu affinity is not available on every platform
+        return psutil.cpu_count() or 1
+
+
+# splits the available cores between the ffmpeg processes running at the same
+# time, videos expected to take longer (a higher weight) get more threads. The
+# threads never add up to more than the cores, unless more videos run at once
+# than there are cores.
+@final
+class ThreadBudget:
+    def __init__(self, cores: int, max_jobs: int, job_count: int):
+        self._cores = cores
+        self._max_jobs = max_jobs
+        self._job_count = job_count
+        self._lock = threading.Lock()
+        self._running: Dict[str, int] = {}
+        self._running_weights: Dict[str, float] = {}
+        self._seen_weights: List[float] = []
+        # videos which reserved threads or never will
+        self._settled: Set[str] = set()
+
+    def _get_expected_weight(self) -> float:
+        # videos without a known duration are expected to be average ones
+        return sum(self._seen_weights) / len(self._seen_weights) if self._seen_weights else 1.0
+
+    def skip(self, title: str) -> None:
+        # videos which are up to date, cancelled or failed never reserve (more) threads
+        with self._lock:
+            self._settled.add(title)
+
+    def reserve(self, title: str, weight: Optional[float]) -> int:
+        with self._lock:
+            weight = self._get_expected_weight() if weight is None else weight
+            self._seen_weights.append(weight)
+            self._settled.add(title)
+            free_cores = self._cores - sum(self._running.values())
+            not_started = self._job_count - len(self._settled)
+            free_slots = max(min(self._max_jobs - len(self._running) - 1, not_started), 0)
+
+            total_weight = weight + sum(self._running_weights.values()) + free_slots * self._get_expected_weight()
+            share = round(self._cores * weight / total_weight) if total_weight > 0 else 1
+            # every video which may still start next to this one keeps a core
+            threads = max(1, min(share, free_cores - free_slots))
+
+            self._running[title] = threads
+            self._running_weights[title] = weight
+            return threads
+
+    def release(self, title: str) -> None:
+        with self._lock:
+            self._running.pop(title, None)
+            self._running_weights.pop(title, None)
+
+
+def parse_size(size: str) -> int:
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = size.strip().upper().rstrip('B')
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def get_process_tree_memory(pid: int) -> int:
+    try:
+        process = psutil.Process(pid)
+        processes = [process, *process.children(recursive=True)]
+    except psutil.Error:
+        return 0
+
+    memory = 0
+    for process in processes:
+        try:
+            memory += process.memory_info().rss
+        except psutil.Error:
+            pass
+    return memory
+
+
+# only lets videos start when their memory usage from earlier builds fits under
+# the ceiling next to the videos which are already running
+@final
+class MemoryGate(JobAdmission):
+    poll_interval = 0.2
+
+    def __init__(self, history_path: str, ceiling: int):
+        self._history_path = history_path
+        self._ceiling = ceiling
+        self._lock = threading.Lock()
+        self._history: Dict[str, int] = self._load_history()
+        self._running: Dict[str, int] = {}
+
+    def _load_history(self) -> Dict[str, int]:
+        try:
+            with open(self._history_path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_history(self) -> None:
+        temporary_path = self._history_path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump(self._history, file)
+        os.replace(temporary_path, self._history_path)
+
+    def get_estimate(self, title: str) -> int:
+        # videos never built before are expected to need as much as the
+        # most memory hungry video seen so far
+        return self._history.get(title, max(self._history.values(), default=0))
+
+    def _get_running_usage(self) -> int:
+        return sum(max(self.get_estimate(title), usage) for title, usage in self._running.items())
+
+    def admit(self, title: str, force: bool = False) -> bool:
+        with self._lock:
+            estimate = self.get_estimate(title)
+            fits = self._get_running_usage() + estimate <= self._ceiling
+            if force or (fits and estimate <= psutil.virtual_memory().available):
+                self._running[title] = 0
+                return True
+            return False
+
+    def release(self, title: str) -> None:
+        with self._lock:
+            self._running.pop(title, None)
+
+    def _watch(self, title: str, process: subprocess.Popen) -> None:
+        while process.poll() is None:
+            usage = get_process_tree_memory(process.pid)
+            with self._lock:
+                self._running[title] = max(self._running.get(title, 0), usage)
+            time.sleep(self.poll_interval)
+
+    def run(self, title: str, command: List[str], **kwargs) -> subprocess.CompletedProcess:
+        process = subprocess.Popen(command, **kwargs)
+        watcher = threading.Thread(target=self._watch, args=(title, process), daemon=True)
+        watcher.start()
+        try:
+            stdout, stderr = process.communicate()
+        finally:
+            watcher.join()
+
+        with self._lock:
+            peak = self._running.get(title, 0)
+            if process.returncode == 0 and peak > 0:
+                self._history[title] = peak
+                self._save_history()
+
+        return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
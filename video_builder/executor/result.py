@@ -0,0 +1,34 @@
+from typing import Optional, final
+
+
+@final
+class VideoBuildResult:
+    BUILT = 'built'
+    SKIPPED = 'skipped'
+    CACHED = 'cached'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, title: str, status: str, duration: Optional[int] = None, elapsed: float = 0.0):
+        self._title = title
+        self._status = status
+        self._duration = duration
+        self._elapsed = elapsed
+
+    def __repr__(self) -> str:
+        return f'VideoBuildResult({self._title!r}, {self._status!r}, duration={self._duration!r})'
+
+    def get_title(self) -> str:
+        return self._title
+
+    def get_status(self) -> str:
+        return self._status
+
+    def get_duration(self) -> Optional[int]:
+        return self._duration
+
+    def get_elapsed(self) -> float:
+        return self._elapsed
+
+    def is_successful(self) -> bool:
+        return self._status in (self.BUILT, self.SKIPPED, self.CACHED)
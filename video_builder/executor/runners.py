@@ -0,0 +1,191 @@
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, final
+
+from bash_writer.builders import get_unique_parts
+from config.config import VideoConfig
+from config.media import MediaInfo
+from config.variables import VariableResolver
+from executor.cache import ArtifactCache
+from executor.commands import FFmpegCommandBuilder, add_thread_options, get_expected_duration, \
+    get_static_duration, get_part_files, get_concat_list, get_concat_list_file, get_still_image_encoding, \
+    get_still_image_files, StillImageEncoding
+from executor.manifest import BuildManifest
+from executor.metadata import parse_duration, probe_duration
+from executor.probes import run_ffprobe
+from executor.resources import ThreadBudget, MemoryGate
+from executor.result import VideoBuildResult
+
+
+def run_process(title: str, command: List[str], memory_gate: Optional[MemoryGate],
+                **kwargs) -> subprocess.CompletedProcess:
+    if memory_gate is None:
+        return subprocess.run(command, **kwargs)
+    return memory_gate.run(title, command, **kwargs)
+
+
+def get_length_variables(dependency_results: Dict[str, VideoBuildResult]) -> Dict[str, str]:
+    return {
+        f'{title}_length': str(result.get_duration())
+        for title, result in dependency_results.items()
+        if result.get_duration() is not None
+    }
+
+
+@final
+class BashScriptRunner:
+    def __init__(self, export_path: str, memory_gate: Optional[MemoryGate] = None):
+        self._export_path = export_path
+        self._memory_gate = memory_gate
+
+    def run(self, video: VideoConfig, dependency_results: Dict[str, VideoBuildResult]) -> VideoBuildResult:
+        started = time.monotonic()
+        process = run_process(
+            video.get_title(),
+            ['bash', video.get_script_name()],
+            self._memory_gate,
+            cwd=self._export_path,
+            env={**os.environ, **get_length_variables(dependency_results)},
+            stdout=subprocess.PIPE,
+            universal_newlines=True
+        )
+        elapsed = time.monotonic() - started
+
+        if process.returncode != 0:
+            return VideoBuildResult(video.get_title(), VideoBuildResult.FAILED, elapsed=elapsed)
+
+        return VideoBuildResult(video.get_title(), VideoBuildResult.BUILT, parse_duration(process.stdout), elapsed)
+
+
+# runs the ffmpeg commands of the generated scripts directly, without bash
+@final
+class FFmpegRunner:
+    def __init__(self, export_path: str, manifest: BuildManifest, thread_budget: Optional[ThreadBudget] = None,
+                 memory_gate: Optional[MemoryGate] = None, cache: Optional[ArtifactCache] = None):
+        self._export_path = export_path
+        self._manifest = manifest
+        self._thread_budget = thread_budget
+        self._memory_gate = memory_gate
+        self._cache = cache
+
+    @staticmethod
+    def _get_weight(video: VideoConfig, command: List[str],
+                    dependency_results: Dict[str, VideoBuildResult]) -> Optional[float]:
+        if video.is_combination():
+            durations = [dependency_results[title].get_duration() for title in video.get_combine()]
+            return sum(durations) if None not in durations else None
+        return get_expected_duration(command)
+
+    def _run_ffmpeg(self, video: VideoConfig, command: List[str],
+                    dependency_results: Dict[str, VideoBuildResult]) -> subprocess.CompletedProcess:
+        title = video.get_title()
+        if self._thread_budget is None:
+            return run_process(title, command, self._memory_gate, cwd=self._export_path, stdout=subprocess.DEVNULL)
+
+        weight = self._get_weight(video, command, dependency_results)
+        threads = self._thread_budget.reserve(title, weight)
+        try:
+            command = add_thread_options(command, threads)
+            return run_process(title, command, self._memory_gate, cwd=self._export_path, stdout=subprocess.DEVNULL)
+        finally:
+            self._thread_budget.release(video.get_title())
+
+    def _parts_match(self, video: VideoConfig) -> bool:
+        signatures = set()
+        for part in get_unique_parts(get_part_files(video)):
+            probe = run_ffprobe(os.path.join(self._export_path, part))
+            if probe is None:
+                return False
+            signatures.add(MediaInfo(probe).get_stream_signature())
+        return len(signatures) == 1 and () not in signatures
+
+    def _get_ffmpeg_command(self, video: VideoConfig, command: FFmpegCommandBuilder) -> List[str]:
+        # parts with matching streams are joined without re-encoding them
+        if not command.must_stream_copy() and (not command.can_stream_copy() or not self._parts_match(video)):
+            return command.build()
+
+        with open(os.path.join(self._export_path, get_concat_list_file(video)), 'w') as file:
+            file.write(get_concat_list(video))
+        return command.build_stream_copy()
+
+    @staticmethod
+    def _get_still_image_encoding(video: VideoConfig, ffmpeg_command: List[str]) -> Optional[StillImageEncoding]:
+        if video.is_combination():
+            return None
+        return get_still_image_encoding(ffmpeg_command, *get_still_image_files(video))
+
+    def _run_still_image_encoding(self, video: VideoConfig, encoding: StillImageEncoding,
+                                  dependency_results: Dict[str, VideoBuildResult]) -> subprocess.CompletedProcess:
+        paths = [os.path.join(self._export_path, name) for name in get_still_image_files(video)]
+        try:
+            for segment_command in encoding.get_segment_commands():
+                process = self._run_ffmpeg(video, segment_command, dependency_results)
+                if process.returncode != 0:
+                    return process
+            with open(paths[-1], 'w') as file:
+                file.write(encoding.get_concat_list())
+            return self._run_ffmpeg(video, encoding.get_mux_command(), dependency_results)
+        finally:
+            for path in paths:
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def run(self, video: VideoConfig, dependency_results: Dict[str, VideoBuildResult]) -> VideoBuildResult:
+        started = time.monotonic()
+        try:
+            return self._build(video, dependency_results, started)
+        except Exception as error:
+            # one broken video must not abort the encodes running next to it
+            print(f'Failed to build {video.get_title()}: {error}', file=sys.stderr)
+            return VideoBuildResult(video.get_title(), VideoBuildResult.FAILED, elapsed=time.monotonic() - started)
+        finally:
+            # whichever way it ended, the video won't ask for threads again
+            if self._thread_budget:
+                self._thread_budget.skip(video.get_title())
+
+    def _build(self, video: VideoConfig, dependency_results: Dict[str, VideoBuildResult],
+               started: float) -> VideoBuildResult:
+        resolver = VariableResolver(video.get_variables(), get_length_variables(dependency_results))
+        command = FFmpegCommandBuilder(video, resolver)
+        output_file = command.get_output_file()
+        output_path = os.path.join(self._export_path, output_file)
+        fingerprint = video.get_fingerprint()
+
+        # videos without a fingerprint are always regenerated
+        entry = fingerprint and self._manifest.get_up_to_date_entry(output_file, output_path, fingerprint)
+        if entry:
+            print(f'{output_file} already up to date, skipping it!', file=sys.stderr)
+            duration = entry.get_duration()
+            return VideoBuildResult(video.get_title(), VideoBuildResult.SKIPPED, duration, time.monotonic() - started)
+
+        artifact = fingerprint and self._cache and self._cache.restore(fingerprint, output_path)
+        if artifact:
+            print(f'{output_file} restored from the cache', file=sys.stderr)
+            duration = artifact.get_duration()
+            self._manifest.record(output_file, output_path, fingerprint, duration)
+            return VideoBuildResult(video.get_title(), VideoBuildResult.CACHED, duration, time.monotonic() - started)
+
+        print(f'Generating {output_file}...', file=sys.stderr)
+        if os.path.exists(output_path):
+            # the old video may be a hard link of a cached one, which must not be overwritten
+            os.unlink(output_path)
+        ffmpeg_command = self._get_ffmpeg_command(video, command)
+        # still images are encoded once and repeated instead of encoding every frame
+        still_image_encoding = self._get_still_image_encoding(video, ffmpeg_command)
+        if still_image_encoding is not None:
+            process = self._run_still_image_encoding(video, still_image_encoding, dependency_results)
+        else:
+            process = self._run_ffmpeg(video, ffmpeg_command, dependency_results)
+        if process.returncode != 0:
+            return VideoBuildResult(video.get_title(), VideoBuildResult.FAILED, elapsed=time.monotonic() - started)
+
+        duration = get_static_duration(ffmpeg_command)
+        if duration is None:
+            duration = probe_duration(output_path)
+        if fingerprint:
+            self._manifest.record(output_file, output_path, fingerprint, duration)
+            if self._cache:
+                self._cache.store(fingerprint, output_path, duration)
+        return VideoBuildResult(video.get_title(), VideoBuildResult.BUILT, duration, time.monotonic() - started)
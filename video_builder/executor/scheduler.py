@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Callable, Dict, Optional, final
+
+from config.config import VideoConfig
+from executor.graph import VideoDependencyGraph
+from executor.result import VideoBuildResult
+
+# runs a single video, receives the results of the videos it depends on
+VideoJob = Callable[[VideoConfig, Dict[str, VideoBuildResult]], VideoBuildResult]
+
+
+# decides whether a video may start next to the ones already running
+class JobAdmission:
+    # forced videos have to be admitted, nothing else is running
+    def admit(self, title: str, force: bool = False) -> bool:
+        raise NotImplementedError()
+
+    def release(self, title: str) -> None:
+        raise NotImplementedError()
+
+
+@final
+class JobScheduler:
+    # how often videos held back by the admission check are reconsidered
+    admission_interval = 1.0
+
+    # on_cancel is called with the title of every video which won't run
+    def __init__(self, graph: VideoDependencyGraph, max_jobs: int = 1, admission: Optional[JobAdmission] = None,
+                 on_cancel: Optional[Callable[[str], None]] = None):
+        if max_jobs < 1:
+            raise ValueError('at least one job has to be allowed to run')
+        self._graph = graph
+        self._max_jobs = max_jobs
+        self._admission = admission
+        self._on_cancel = on_cancel
+
+    def _admit(self, title: str, running_count: int) -> bool:
+        if self._admission is None:
+            return True
+        # with nothing running a video has to start, otherwise the build would never finish
+        return self._admission.admit(title, force=running_count == 0)
+
+    def _release(self, title: str) -> None:
+        if self._admission is not None:
+            self._admission.release(title)
+
+    def _get_dependency_results(self, title: str, results: Dict[str, VideoBuildResult]) -> Dict[str, VideoBuildResult]:
+        return {dependency: results[dependency] for dependency in self._graph.get_dependencies(title)}
+
+    def _is_ready(self, title: str, results: Dict[str, VideoBuildResult]) -> bool:
+        return all(dependency in results for dependency in self._graph.get_dependencies(title))
+
+    def _has_failed_dependency(self, title: str, results: Dict[str, VideoBuildResult]) -> bool:
+        dependency_results = self._get_dependency_results(title, results).values()
+        return not all(result.is_successful() for result in dependency_results)
+
+    def run(self, job: VideoJob) -> Dict[str, VideoBuildResult]:
+        results: Dict[str, VideoBuildResult] = {}
+        waiting = self._graph.get_titles()
+        running: Dict[Future, str] = {}
+
+        with ThreadPoolExecutor(max_workers=self._max_jobs) as pool:
+            while waiting or running:
+                held_back = False
+                for title in [title for title in waiting if self._is_ready(title, results)]:
+                    if len(running) >= self._max_jobs:
+                        break
+
+                    if self._has_failed_dependency(title, results):
+                        waiting.remove(title)
+                        results[title] = VideoBuildResult(title, VideoBuildResult.CANCELLED)
+                        if self._on_cancel is not None:
+                            self._on_cancel(title)
+                        continue
+
+                    if not self._admit(title, len(running)):
+                        held_back = True
+                        continue
+
+                    waiting.remove(title)
+                    video = self._graph.get_video(title)
+                    future = pool.submit(job, video, self._get_dependency_results(title, results))
+                    running[future] = title
+
+                if not running:
+                    continue
+
+                timeout = self.admission_interval if held_back else None
+                done, _ = wait(running.keys(), timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    title = running.pop(future)
+                    self._release(title)
+                    results[title] = future.result()
+
+        return {title: results[title] for title in self._graph.get_titles()}
@@ -0,0 +1,24 @@
+# the build manifest is written by the python executor and the generated bash
+# scripts alike, so its schema belongs to neither of them
+manifest_file_name = '.video_builder.sqlite'
+
+manifest_schema = """\
+CREATE TABLE IF NOT EXISTS outputs (
+    output TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    duration INTEGER
+);
+CREATE TABLE IF NOT EXISTS inputs (
+    path TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS probes (
+    digest TEXT PRIMARY KEY,
+    probe TEXT NOT NULL
+);\
+"""